@@ -25,12 +25,15 @@
 import logging
 import os
 import re
-import subprocess
 
 import nimp.system
 import nimp.sys.platform
 import nimp.sys.process
 
+# Visual Studio installations rarely change, distcc hosts may come and go
+_VSWHERE_CACHE_TTL = 24 * 60 * 60 # pylint: disable = invalid-name
+_DISTCC_CACHE_TTL = 5 * 60 # pylint: disable = invalid-name
+
 def msbuild(project_file, platform_name, configuration, project=None,
             vs_version='14', dotnet_version='4.6', additional_flags=None ):
     ''' Builds a project with MSBuild '''
@@ -119,7 +122,8 @@ def _find_msbuild_path(vs_version):
     # For VS2017 and later, there is vswhere
     vswhere_cmd = [ os.path.join(os.environ['ProgramFiles(x86)'], 'Microsoft Visual Studio/Installer/vswhere.exe') ]
     vswhere_cmd += [ '-products', '*', '-requires', 'Microsoft.Component.MSBuild', '-property', 'installationPath' ]
-    result, output, _ = nimp.sys.process.call(vswhere_cmd, capture_output=True, hide_output=True)
+    result, output, _ = nimp.sys.process.call(vswhere_cmd, capture_output=True, hide_output=True,
+                                              cache_ttl=_VSWHERE_CACHE_TTL)
     if result == 0:
         for line in output.split('\n'):
             line = line.strip()
@@ -167,7 +171,8 @@ def _find_devenv_path(vs_version):
     # For VS2017 and later, there is vswhere
     if not devenv_path:
         vswhere_path = os.path.join(os.environ['ProgramFiles(x86)'], 'Microsoft Visual Studio/Installer/vswhere.exe')
-        result, output, _ = nimp.sys.process.call([vswhere_path], capture_output=True, hide_output=True)
+        result, output, _ = nimp.sys.process.call([vswhere_path], capture_output=True, hide_output=True,
+                                                  cache_ttl=_VSWHERE_CACHE_TTL)
         if result == 0:
             for line in output.split('\n'):
                 line = line.strip()
@@ -218,14 +223,17 @@ def install_distcc_and_ccache():
     if os.path.exists(distcc_dir):
         # Set DISTCC_HOSTS if necessary
         if not os.getenv('DISTCC_HOSTS'):
-            hosts = subprocess.Popen(['lsdistcc'], stdout=subprocess.PIPE).communicate()[0].decode('utf-8')
+            _, hosts, _ = nimp.sys.process.call(['lsdistcc'], capture_output=True, hide_output=True,
+                                                cache_ttl=_DISTCC_CACHE_TTL)
             hosts = ' '.join(hosts.split())
             logging.debug('Setting DISTCC_HOSTS=%s', hosts)
             os.environ['DISTCC_HOSTS'] = hosts
 
         # Compute a reasonable number of workers for UBT
         if not os.getenv('UBT_PARALLEL'):
-            workers = subprocess.Popen(['distcc', '-j'], stdout=subprocess.PIPE).communicate()[0].decode('utf-8')
+            _, workers, _ = nimp.sys.process.call(['distcc', '-j'], capture_output=True, hide_output=True,
+                                                  cache_ttl=_DISTCC_CACHE_TTL, cache_env=['DISTCC_HOSTS'])
+            workers = workers.strip()
             logging.debug('Setting UBT_PARALLEL=%s', workers)
             os.environ['UBT_PARALLEL'] = workers
 
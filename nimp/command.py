@@ -88,6 +88,12 @@ def load_arguments(env):
 
     return True
 
+def get_command_name(command):
+    ''' Returns the command line name of a command, e.g. "revert-workspace"
+        for an instance of _RevertWorkspace '''
+    name_array = re.findall('[A-Z][^A-Z]*', type(command).__name__)
+    return '-'.join([it.lower() for it in name_array])
+
 def add_commands_subparser(commands, parser, env, required = False):
     ''' Adds a list of commands to a subparser '''
     command_description = ('Commands marked with /!\\ are currently unavailable.'
@@ -97,8 +103,7 @@ def add_commands_subparser(commands, parser, env, required = False):
 
     for command_it in commands:
         command_class = type(command_it)
-        name_array = re.findall('[A-Z][^A-Z]*', command_class.__name__)
-        command_name = '-'.join([it.lower() for it in name_array])
+        command_name = get_command_name(command_it)
 
         try:
             enabled, reason = command_it.is_available(env)
@@ -24,6 +24,7 @@
 
 __all__ = [
     'build',
+    'cache',
     'check',
     'commandlet',
     'dev',
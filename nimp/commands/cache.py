@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Commands related to nimp's on-disk command cache '''
+
+import datetime
+import logging
+import time
+
+import nimp.command
+import nimp.sys.cache
+
+
+class Cache(nimp.command.CommandGroup):
+    ''' Inspects or clears cached command results '''
+    def __init__(self):
+        super(Cache, self).__init__([_List(),
+                                     _Clear()])
+
+    def is_available(self, env):
+        return True, ''
+
+
+class _List(nimp.command.Command):
+    ''' Lists cached command results '''
+
+    def configure_arguments(self, env, parser):
+        pass
+
+    def is_available(self, env):
+        return True, ''
+
+    def run(self, env):
+        now = time.time()
+        entries = nimp.sys.cache.get_entries()
+        for entry in entries:
+            created = datetime.datetime.fromtimestamp(entry['created'])
+            remaining = int(entry['expires'] - now)
+            status = 'expires in %ds' % remaining if remaining >= 0 else 'expired'
+            logging.info('%s %s (%s, exit code %d) %s', entry['key'][:12],
+                         created.strftime('%Y-%m-%d %H:%M:%S'), status,
+                         entry['exit_code'], ' '.join(entry['command']))
+        logging.info('%d entries in %s', len(entries), nimp.sys.cache.get_directory())
+        return True
+
+
+class _Clear(nimp.command.Command):
+    ''' Removes cached command results '''
+
+    def configure_arguments(self, env, parser):
+        parser.add_argument('--expired',
+                            help = 'Only remove expired entries',
+                            action = 'store_true')
+
+    def is_available(self, env):
+        return True, ''
+
+    def run(self, env):
+        removed = nimp.sys.cache.clear(expired_only = env.expired)
+        logging.info('Removed %d entries from %s', removed, nimp.sys.cache.get_directory())
+        return True
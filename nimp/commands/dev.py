@@ -22,14 +22,40 @@
 
 ''' Dev & Testing related commands '''
 
+import concurrent.futures
+import itertools
 import logging
+import marshal
+import mmap
+import os
+import re
+import sys
+import tempfile
+import time
 
 import nimp.command
+import nimp.environment
+import nimp.log
+import nimp.summary
+import nimp.sys.platform
+import nimp.utils.p4_backend
+
+# Context lines kept before and after errors when replaying logs partially,
+# which covers what summary handlers show
+_GAP_CONTEXT_LINES = 4 # pylint: disable = invalid-name
+
+# Minimum size of the parts of a log file analyzed in parallel
+_MIN_CHUNK_SIZE = 4 * 1024 * 1024 # pylint: disable = invalid-name
+
+# ProcessPoolExecutor can't wait on more worker processes on Windows
+_MAX_WINDOWS_JOBS = 61 # pylint: disable = invalid-name
 
 class Dev(nimp.command.CommandGroup):
     ''' Dev and test related commands. '''
     def __init__(self):
-        super(Dev, self).__init__([_TestLogPatterns()])
+        super(Dev, self).__init__([_AnalyzeLog(),
+                                   _BenchmarkP4Parse(),
+                                   _TestLogPatterns()])
 
     def configure_arguments(self, env, parser):
         super(Dev, self).configure_arguments(env, parser)
@@ -56,9 +82,233 @@ class _TestLogPatterns(nimp.command.Command):
         return True
 
     def run(self, env):
-        logger = logging.getLogger('child_processes')
+        lines = []
         with open(env.input_file) as file:
             for line in file:
-                line = line[:-1]
-                logger.info(line)
+                lines.append(line[:-1])
+                if len(lines) >= 1024:
+                    nimp.log.log_child_lines(lines)
+                    lines = []
+        nimp.log.log_child_lines(lines)
+        return True
+
+
+class _AnalyzeLog(nimp.command.Command):
+    ''' Outputs the summary of a log file, analyzing it in parallel '''
+    def __init__(self):
+        super(_AnalyzeLog, self).__init__()
+
+    def is_available(self, env):
+        return True, ''
+
+    def configure_arguments(self, env, parser):
+        parser.add_argument('input_file',
+                            help = 'Log file to analyze')
+
+        parser.add_argument('-o', '--output',
+                            help = 'Write the summary to this file instead of stdout',
+                            metavar = '<file>')
+
+        parser.add_argument('-j', '--jobs',
+                            help = 'Number of worker processes',
+                            metavar = '<count>',
+                            type = int,
+                            default = _get_default_jobs())
+
         return True
+
+    def run(self, env):
+        # The summary format is chosen with nimp's --summary-format option
+        handler = nimp.environment.create_summary_handler(env)
+        patterns = [ (pattern.pattern, pattern.flags) for pattern in handler.get_filter_patterns() ]
+
+        jobs = max(1, env.jobs)
+        if nimp.sys.platform.is_windows():
+            jobs = min(jobs, _MAX_WINDOWS_JOBS)
+
+        chunks = _split_file(env.input_file, jobs)
+        logging.info('Analyzing %s in %d parts', env.input_file, len(chunks))
+        with concurrent.futures.ProcessPoolExecutor(max_workers = jobs) as executor:
+            # Results come back in order, and are fed to the handler as if
+            # the log was replayed, minus lines it would not use
+            arguments = [ (env.input_file, start, end, patterns, index == 0)
+                          for index, (start, end) in enumerate(chunks) ]
+            _replay(handler, executor.map(_analyze_chunk, arguments))
+
+        if env.output is None:
+            handler.write_summary(sys.stdout)
+        else:
+            with open(env.output, 'w') as output:
+                handler.write_summary(output)
+        return True
+
+
+def _get_default_jobs():
+    jobs = os.cpu_count() or 1
+    if nimp.sys.platform.is_windows():
+        jobs = min(jobs, _MAX_WINDOWS_JOBS)
+    return jobs
+
+def _split_file(path, jobs):
+    # Returns (start, end) offsets of parts of the file ending on line breaks
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    chunk_size = max(_MIN_CHUNK_SIZE, size // (max(1, jobs) * 4) + 1)
+    chunks = []
+    with open(path, 'rb') as log_file, mmap.mmap(log_file.fileno(), 0, access = mmap.ACCESS_READ) as data:
+        start = 0
+        while start < size:
+            end = data.find(b'\n', min(start + chunk_size, size) - 1)
+            end = size if end < 0 else end + 1
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+_CHUNK_MATCHERS = {} # pylint: disable = invalid-name
+
+def _analyze_chunk(arguments):
+    # Runs in worker processes: returns the number of lines in a part of the
+    # file, and the (index, line) tuples a summary handler needs among them
+    path, start, end, patterns, is_first = arguments
+    matcher = _CHUNK_MATCHERS.get(tuple(patterns))
+    if matcher is None:
+        matcher = nimp.summary.PatternMatcher([ re.compile(pattern, flags) for pattern, flags in patterns ])
+        _CHUNK_MATCHERS[tuple(patterns)] = matcher
+
+    with open(path, 'rb') as log_file, mmap.mmap(log_file.fileno(), 0, access = mmap.ACCESS_READ) as data:
+        text = data[start:end].decode('utf-8', errors = 'replace')
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    if is_first and lines and lines[0].startswith('\ufeff'):
+        lines[0] = lines[0][1:]
+    lines = [ line.strip('\r') for line in lines ]
+
+    notable = [ index for index, line in enumerate(lines) if matcher.match(line) is not None ]
+    kept = set(notable)
+    boundaries = [ -1 ] + notable + [ len(lines) ]
+    for previous, following in zip(boundaries, boundaries[1:]):
+        kept.update(range(previous + 1, min(previous + 1 + _GAP_CONTEXT_LINES, following)))
+        kept.update(range(max(previous + 1, following - _GAP_CONTEXT_LINES), following))
+    return len(lines), [ (index, lines[index]) for index in sorted(kept) ]
+
+def _replay(handler, results):
+    # Feeds kept lines to the handler in order, telling it how many lines
+    # were left out in between
+    position = 0
+    accounted = 0
+    for line_count, kept_lines in results:
+        batch = []
+        for index, line in kept_lines:
+            if position + index > accounted + len(batch):
+                handler.emit_lines(batch)
+                accounted += len(batch)
+                batch = []
+                handler.skip_lines(position + index - accounted)
+                accounted = position + index
+            batch.append(line)
+        handler.emit_lines(batch)
+        accounted += len(batch)
+        position += line_count
+    handler.skip_lines(position - accounted)
+
+
+class _BenchmarkP4Parse(nimp.command.Command):
+    ''' Compares parsing times of tagged and marshalled p4 fstat output '''
+    def __init__(self):
+        super(_BenchmarkP4Parse, self).__init__()
+
+    def is_available(self, env):
+        return True, ''
+
+    def configure_arguments(self, env, parser):
+        parser.add_argument('input_file',
+                            help = 'Output of "p4 -G fstat" to parse, synthetic records are used if omitted',
+                            nargs = '?')
+
+        parser.add_argument('--records',
+                            help = 'Number of synthetic fstat records',
+                            metavar = '<count>',
+                            type = int,
+                            default = 1000000)
+
+        return True
+
+    def run(self, env):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            marshal_path = env.input_file
+            if marshal_path is None:
+                marshal_path = os.path.join(temp_dir, 'fstat.bin')
+                _write_fstat_records(marshal_path, env.records)
+            tagged_path = os.path.join(temp_dir, 'fstat.txt')
+            _write_tagged_output(marshal_path, tagged_path)
+
+            for name, parse, path in [ ('tagged', _parse_tagged_fstat, tagged_path),
+                                       ('marshal', _parse_marshal_fstat, marshal_path) ]:
+                start = time.monotonic()
+                count = parse(path)
+                elapsed = time.monotonic() - start
+                logging.info('%s: parsed %d records in %.2fs (%.0f records/s)',
+                             name, count, elapsed, count / max(elapsed, 1e-6))
+        return True
+
+
+def _write_fstat_records(path, count):
+    with open(path, 'wb') as output:
+        for i in range(count):
+            client_file = b'/p4/Content/Folder%d/Asset%d.uasset' % (i // 1000, i)
+            record = { b'code': b'stat',
+                       b'depotFile': b'//depot' + client_file[3:],
+                       b'clientFile': client_file,
+                       b'isMapped': b'',
+                       b'headAction': b'edit',
+                       b'headType': b'binary+l',
+                       b'headTime': b'1462880462',
+                       b'headRev': b'%d' % (i % 7 + 1),
+                       b'headChange': b'%d' % (400000 + i),
+                       b'headModTime': b'1454408928',
+                       b'haveRev': b'%d' % (i % 7 + 1) }
+            if i % 10 == 0:
+                record[b'action'] = b'edit'
+            marshal.dump(record, output, 0)
+
+def _write_tagged_output(marshal_path, tagged_path):
+    # Writes the same records the way "p4 -z tag" would
+    with open(marshal_path, 'rb') as records, \
+         open(tagged_path, 'w', encoding = 'utf-8', errors = 'surrogateescape') as output:
+        for record in nimp.utils.p4_backend.read_marshal_records(records):
+            for key, value in record.items():
+                if key != 'code':
+                    output.write('... %s %s\n' % (key, value))
+            output.write('\n')
+
+def _parse_tagged_fstat(path):
+    # Decodes lines as process output is, then runs per-record regular
+    # expressions, as nimp used to parse fstat output
+    count = 0
+    with open(path, 'rb') as output:
+        record_lines = []
+        for line in itertools.chain(output, [b'']):
+            line = line.decode('utf-8-sig').strip()
+            if line != '':
+                record_lines.append(line)
+                continue
+            if not record_lines:
+                continue
+            file_info = '\n'.join(record_lines)
+            record_lines = []
+            re.search(r"\.\.\.\s*clientFile\s*(.*)", file_info)
+            re.search(r"\.\.\.\s*headAction\s*(\w*)", file_info)
+            re.search(r"\.\.\.\s*action\s*(\w*)", file_info)
+            count += 1
+    return count
+
+def _parse_marshal_fstat(path):
+    count = 0
+    with open(path, 'rb') as output:
+        fields = [ 'clientFile', 'headAction', 'action' ]
+        for record in nimp.utils.p4_backend.read_marshal_records(output, fields):
+            _ = (record['clientFile'], record.get('headAction'), record.get('action'))
+            count += 1
+    return count
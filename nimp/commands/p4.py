@@ -23,7 +23,9 @@
 ''' Perforce related commands. '''
 
 import abc
+import functools
 import shutil
+import sys
 
 import nimp.command
 import nimp.utils.p4
@@ -54,7 +56,9 @@ class P4Command(nimp.command.Command):
 class P4(nimp.command.CommandGroup):
     ''' P4 related commands. '''
     def __init__(self):
-        super(P4, self).__init__([_RevertWorkspace(),
+        super(P4, self).__init__([_ChangedFiles(),
+                                  _Fetch(),
+                                  _RevertWorkspace(),
                                   _Submit(),
                                   _Fileset()])
 
@@ -65,6 +69,88 @@ class P4(nimp.command.CommandGroup):
     def is_available(self, env):
         return _is_p4_available()
 
+class _ChangedFiles(P4Command):
+    ''' Lists workspace files changed since a changelist '''
+    def __init__(self):
+        super(_ChangedFiles, self).__init__()
+
+    def configure_arguments(self, env, parser):
+        super(_ChangedFiles, self).configure_arguments(env, parser)
+
+        parser.add_argument('--since',
+                            metavar = '<cl>',
+                            help = 'List files changed by changelists submitted after this one',
+                            type = int,
+                            required = True)
+
+        parser.add_argument('--until',
+                            metavar = '<cl>',
+                            help = 'Last changelist to consider, defaults to the last submitted one',
+                            type = int)
+
+        parser.add_argument('--root',
+                            metavar = '<path>',
+                            help = 'Only list files under this path',
+                            default = '//...')
+
+        parser.add_argument('--actions',
+                            help = 'Prefix files with the action of their last revision',
+                            action = 'store_true')
+
+        parser.add_argument('-o', '--output',
+                            metavar = '<file>',
+                            help = 'Write the file list to this file instead of stdout')
+
+        return True
+
+    def is_available(self, env):
+        return _is_p4_available()
+
+    def run(self, env):
+        # Output of p4 commands would be mixed with the list otherwise
+        p4 = nimp.utils.p4.get_client(env)
+        p4.hide_output = env.output is None
+        if not nimp.utils.p4.check_for_p4(env):
+            return False
+
+        changed_files = p4.get_changed_files(env.since, env.until, root = env.root)
+        lines = [ ('%s %s' % (action, path) if env.actions else path) + '\n' for path, action in changed_files ]
+        if env.output is None:
+            sys.stdout.writelines(lines)
+        else:
+            with open(env.output, 'w') as output:
+                output.writelines(lines)
+        return True
+
+class _Fetch(P4Command):
+    ''' Fetches depot files at a revision without a workspace '''
+    def __init__(self):
+        super(_Fetch, self).__init__()
+
+    def configure_arguments(self, env, parser):
+        super(_Fetch, self).configure_arguments(env, parser)
+
+        parser.add_argument('file_spec',
+                            metavar = '<depot-spec>',
+                            help = 'Depot files to fetch, e.g. //depot/Tools/...@1234')
+
+        parser.add_argument('destination',
+                            metavar = '<dest>',
+                            help = 'Directory to write files to, relative to the directory of the depot spec')
+
+        return True
+
+    def is_available(self, env):
+        return _is_p4_available()
+
+    def run(self, env):
+        # Depot files are fetched without any workspace
+        if not nimp.utils.p4.check_for_p4_server(env):
+            return False
+
+        p4 = nimp.utils.p4.get_client(env)
+        return not p4.fetch_files(env.file_spec, env.destination)
+
 class _RevertWorkspace(P4Command):
     ''' Reverts and deletes all pending changelists '''
     def __init__(self):
@@ -102,6 +188,10 @@ class _Fileset(P4Command):
                             metavar = '<description>',
                             help = 'Changelist description format, will be interpolated with environment value.')
 
+        parser.add_argument('--parallel',
+                            metavar = '<settings>',
+                            help = 'Parallel file transfer settings for sync, e.g. threads=4,batch=8')
+
         nimp.command.add_common_arguments(parser, 'platform', 'configuration',
                                           'target', 'revision', 'free_parameters')
         return True
@@ -121,7 +211,7 @@ class _Fileset(P4Command):
         operations = { 'checkout' : [p4.edit, True],
                        'reconcile' : [p4.reconcile, True],
                        'revert' : [p4.revert, False],
-                       'sync' : [p4.sync, False], }
+                       'sync' : [functools.partial(p4.sync, parallel = env.parallel), False], }
 
         files = nimp.system.map_files(env)
         if files.load_set(env.fileset) is None:
@@ -31,16 +31,14 @@ import sys
 import time
 
 import nimp.command
+import nimp.log
 import nimp.summary
 import nimp.system
 import nimp.unreal
 
-_LOG_FORMATS = { # pylint: disable = invalid-name
-    'standard': '%(asctime)s [%(levelname)s] %(message)s'
-}
-
 _SUMMARY_HANDLERS = { # pylint: disable = invalid-name
     'default': nimp.summary.DefaultSummaryHandler,
+    'json': nimp.summary.JsonSummaryHandler,
     'unreal': nimp.unreal.UnrealSummaryHandler
 }
 
@@ -100,6 +98,36 @@ class Environment:
                                choices = list(_SUMMARY_HANDLERS.keys()),
                                default='default')
 
+        log_group.add_argument('--log-format',
+                               metavar='<format>',
+                               help='Log output format: standard text, or one JSON object per line',
+                               choices=nimp.log.LOG_FORMATS,
+                               default='standard')
+
+        log_group.add_argument('--summary-live',
+                               help='Writes the summary file while the command runs, '
+                                    'instead of at the end (default summary format only)',
+                               action='store_true')
+
+        log_group.add_argument('--console-rate-limit',
+                               metavar='<lines>',
+                               help='Maximum number of child process output lines printed '
+                                    'to the console per second (log files get all lines)',
+                               type=int,
+                               default=None)
+
+        log_group.add_argument('--log-queue-size',
+                               metavar='<count>',
+                               help='Maximum number of messages waiting for the logging thread '
+                                    '(0 to log synchronously)',
+                               type=int,
+                               default=nimp.log.LOG_QUEUE_SIZE)
+
+        log_group.add_argument('--log-queue-policy',
+                               help='What to do when the log queue is full: wait, or drop '
+                                    'messages below warning level',
+                               choices=['block', 'drop'],
+                               default='block')
 
         log_group.add_argument('--do-nothing',
                                help='Just parses arguments and exits (used for CIS tests)',
@@ -146,12 +174,7 @@ class Environment:
         for key, value in vars(arguments).items():
             setattr(self, key, value)
 
-        summary_format = getattr(self, 'summary_format')
-        with _SUMMARY_HANDLERS[summary_format](self) as log_handler:
-            if "NIMP_LOG_FILE" in os.environ:
-                # PATCHING ROOT LOGGER
-                logging.getLogger().addHandler(log_handler.log_all_handler)
-
+        with create_summary_handler(self) as log_handler:
             if hasattr(self, 'environment'):
                 for key, val in self.environment.items():
                     os.environ[key] = val
@@ -169,7 +192,8 @@ class Environment:
                 success = True
             else:
                 try:
-                    success = self.command.run(self)
+                    with nimp.log.phase(nimp.command.get_command_name(self.command)):
+                        success = self.command.run(self)
                 #pylint: disable=broad-except
                 except Exception as exception:
                     logging.exception(exception)
@@ -249,6 +273,10 @@ class Environment:
 
         return True
 
+def create_summary_handler(env):
+    ''' Returns the summary handler selected by --summary-format '''
+    return _SUMMARY_HANDLERS[getattr(env, 'summary_format', 'default')](env)
+
 def execute_hook(hook_name, *args):
     ''' Executes a hook in the .nimp/hooks directory '''
     hook_module = nimp.system.try_import('hooks.' + hook_name)
@@ -0,0 +1,607 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Logging handlers and helpers used to output nimp and child processes logs '''
+
+import atexit
+import contextlib
+import json
+import logging
+import logging.handlers
+import os
+import os.path
+import queue
+import re
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHILD_PROCESSES_LOGGER = 'child_processes' # pylint: disable = invalid-name
+
+# Values of --log-format
+LOG_FORMATS = [ 'standard', 'jsonl' ] # pylint: disable = invalid-name
+STANDARD_FORMAT = '%(asctime)s [%(levelname)s] %(message)s' # pylint: disable = invalid-name
+
+# Compressed size after which command logs continue in a new file
+COMMAND_LOG_MAX_SIZE = 64 * 1024 * 1024 # pylint: disable = invalid-name
+
+# Default number of records or batches of lines waiting to be logged
+LOG_QUEUE_SIZE = 4096 # pylint: disable = invalid-name
+
+# Maximum number of queued entries processed at once by the logging thread
+_LOG_QUEUE_BATCH_SIZE = 256 # pylint: disable = invalid-name
+
+_COMMAND_LOG_LOCK = threading.Lock() # pylint: disable = invalid-name
+_COMMAND_LOG_COUNTER = [0] # pylint: disable = invalid-name
+
+_PHASES = [ [ None ] ] # pylint: disable = invalid-name
+
+
+def create_formatter(log_format='standard'):
+    ''' Returns the formatter to use for given --log-format value '''
+    if log_format == 'jsonl':
+        return JsonFormatter()
+    return logging.Formatter(STANDARD_FORMAT)
+
+
+def get_phase():
+    ''' Returns the name of the current phase of the nimp run '''
+    return _PHASES[-1][0]
+
+
+@contextlib.contextmanager
+def phase(name):
+    ''' Names the phase of the nimp run logged records belong to, e.g. the
+        running command or one of its steps '''
+    entry = [ name ]
+    _PHASES.append(entry)
+    try:
+        yield
+    finally:
+        _PHASES.remove(entry)
+
+
+def log_child_lines(lines, pid=None, argv=None):
+    ''' Logs a batch of lines output by a child process. Handlers implementing
+        emit_lines receive the whole batch at once, log records are only built
+        for the other handlers. '''
+    logger = logging.getLogger(CHILD_PROCESSES_LOGGER)
+    if not lines or not logger.isEnabledFor(logging.INFO):
+        return
+
+    # Describes where the lines come from, for structured log formats
+    source = { 'time': time.time(), 'pid': pid, 'argv': argv, 'phase': get_phase() }
+
+    if logger.filters:
+        for line in lines:
+            logger.info(line, extra = { 'child': source })
+        return
+
+    _emit_lines(logger, _get_handlers(logger), lines, source)
+
+
+def _emit_lines(logger, handlers, lines, source):
+    records = None
+    for handler in handlers:
+        if handler.level > logging.INFO:
+            continue
+        emit_lines = getattr(handler, 'emit_lines', None)
+        if emit_lines is not None and not handler.filters:
+            emit_lines(lines, source)
+            continue
+        if records is None:
+            records = [ logger.makeRecord(logger.name, logging.INFO, __file__, 0, line, None, None,
+                                          extra = { 'child': source })
+                        for line in lines ]
+        for record in records:
+            handler.handle(record)
+
+
+def _get_handlers(logger):
+    while logger is not None:
+        yield from logger.handlers
+        logger = logger.parent if logger.propagate else None
+
+
+class LogQueue():
+    ''' Runs the handlers of attached loggers on a background thread. Records
+        and batches of child process lines go through a bounded queue, and
+        are handled in order.
+
+        When the queue is full, the emitting thread waits, unless drop is set:
+        then lines and records below WARNING are dropped, and their count is
+        reported later. stop() processes all queued entries; it is also
+        called at exit. '''
+    def __init__(self, max_size=LOG_QUEUE_SIZE, drop=False):
+        self._queue = queue.Queue(max_size)
+        self._drop = drop
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._attached = []
+        self._thread = None
+
+    def attach(self, logger):
+        ''' Moves the current handlers of a logger behind the queue '''
+        handlers = list(logger.handlers)
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(_QueueHandler(self, logger, handlers))
+        self._attached.append((logger, handlers))
+
+    def start(self):
+        ''' Starts the logging thread '''
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        ''' Handles all queued entries, then gives loggers back their
+            handlers, so that logging is synchronous again '''
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        atexit.unregister(self.stop)
+        self._queue.put(None)
+        thread.join()
+        for logger, handlers in self._attached:
+            for handler in list(logger.handlers):
+                if isinstance(handler, _QueueHandler):
+                    logger.removeHandler(handler)
+            for handler in handlers:
+                logger.addHandler(handler)
+        self._attached = []
+
+    def flush(self):
+        ''' Waits until all queued entries are handled '''
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            self._queue.join()
+
+    def put(self, entry, levelno=logging.INFO):
+        ''' Queues a (logger, handlers, record or list of lines, source)
+            entry '''
+        if self._thread is None:
+            _handle_entry(*entry)
+            return
+        if not self._drop or levelno >= logging.WARNING:
+            self._queue.put(entry)
+            return
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            with self._dropped_lock:
+                self._dropped += 1
+
+    def _worker(self):
+        while True:
+            entries = [ self._queue.get() ]
+            while len(entries) < _LOG_QUEUE_BATCH_SIZE:
+                try:
+                    entries.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._handle_entries(entries)
+            # Logging errors would come back to this queue
+            except Exception: # pylint: disable = broad-except
+                sys.excepthook(*sys.exc_info())
+            finally:
+                for _ in entries:
+                    self._queue.task_done()
+            if entries[-1] is None:
+                return
+
+    def _handle_entries(self, entries):
+        # Consecutive batches of lines for the same handlers are merged, the
+        # pending batch is empty when there's none
+        pending = []
+        for entry in entries:
+            if entry is None:
+                continue
+            if (isinstance(entry[2], list) and pending and
+                    pending[1] is entry[1] and _is_same_source(pending[3], entry[3])):
+                pending[2].extend(entry[2])
+                continue
+            if pending:
+                _handle_entry(*pending)
+                pending = []
+            if isinstance(entry[2], list):
+                pending = [ entry[0], entry[1], list(entry[2]), entry[3] ]
+            else:
+                _handle_entry(*entry)
+        if pending:
+            _handle_entry(*pending)
+
+        with self._dropped_lock:
+            dropped, self._dropped = self._dropped, 0
+        if dropped > 0 and self._attached:
+            logger, handlers = self._attached[0]
+            record = logger.makeRecord(logger.name, logging.WARNING, __file__, 0,
+                                       '%d log messages were dropped (log queue full)', (dropped,), None)
+            _handle_entry(logger, handlers, record, None)
+
+
+class _QueueHandler(logging.Handler):
+    def __init__(self, log_queue, logger, handlers):
+        super().__init__()
+        self._log_queue = log_queue
+        self._logger = logger
+        self._handlers = handlers
+
+    def emit(self, record):
+        # Records are formatted by other threads, so they must not depend on
+        # objects that may change in the meantime
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if not hasattr(record, 'phase'):
+                record.phase = get_phase()
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+        except Exception: # pylint: disable = broad-except
+            self.handleError(record)
+            return
+        self._log_queue.put((self._logger, self._handlers, record, None), record.levelno)
+
+    def emit_lines(self, lines, source=None):
+        ''' Queues a batch of child process lines '''
+        self._log_queue.put((self._logger, self._handlers, list(lines), source))
+
+
+def _handle_entry(logger, handlers, payload, source):
+    if isinstance(payload, list):
+        _emit_lines(logger, handlers, payload, source)
+        return
+    for handler in handlers:
+        if payload.levelno >= handler.level:
+            handler.handle(payload)
+
+
+def _is_same_source(source, other_source):
+    if source is None or other_source is None:
+        return source is other_source
+    return source['pid'] == other_source['pid'] and source['phase'] == other_source['phase']
+
+
+class JsonFormatter(logging.Formatter):
+    ''' Formats records as one JSON object per line, with time, level,
+        source ("nimp", or "child" with the pid and argv of the process),
+        phase and message fields '''
+    def format(self, record):
+        child = getattr(record, 'child', None)
+        if child is None:
+            entry = { 'time': record.created,
+                      'level': record.levelname,
+                      'source': 'nimp',
+                      'phase': getattr(record, 'phase', get_phase()) }
+        else:
+            entry = _get_child_entry(child, record.levelname)
+        entry['message'] = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+    def format_lines(self, lines, source=None):
+        ''' Formats a batch of child process lines, serializing the fields
+            they have in common only once '''
+        entry = _get_child_entry(source, 'INFO')
+        prefix = json.dumps(entry)[:-1] + ', "message": '
+        return [ prefix + json.dumps(line) + '}' for line in lines ]
+
+
+def _get_child_entry(source, level):
+    source = source or {}
+    return { 'time': source.get('time') or time.time(),
+             'level': level,
+             'source': 'child',
+             'pid': source.get('pid'),
+             'argv': source.get('argv'),
+             'phase': source.get('phase') }
+
+
+class ChildStreamHandler(logging.StreamHandler):
+    ''' Writes child processes output as is to a stream, optionally limiting
+        the number of lines written per second '''
+    def __init__(self, stream=None, max_lines_per_second=None):
+        super().__init__(stream)
+        self.setFormatter(logging.Formatter('%(message)s'))
+        self._max_lines_per_second = max_lines_per_second
+        self._window_start = time.monotonic()
+        self._window_lines = 0
+        self._dropped_lines = 0
+
+    def emit(self, record):
+        if self._get_allowed_lines(1) == 1:
+            super().emit(record)
+
+    def emit_lines(self, lines, source=None):
+        ''' Writes a batch of lines with a single write call '''
+        with self.lock:
+            allowed = self._get_allowed_lines(len(lines))
+            if allowed == 0:
+                return
+            lines = lines[:allowed]
+            if hasattr(self.formatter, 'format_lines'):
+                lines = self.formatter.format_lines(lines, source)
+            try:
+                self.stream.write(self.terminator.join(lines) + self.terminator)
+                self.flush()
+            except Exception: # pylint: disable = broad-except
+                self.handleError(logging.makeLogRecord({ 'msg': lines[0] }))
+
+    def close(self):
+        with self.lock:
+            self._report_dropped_lines()
+        super().close()
+
+    def _get_allowed_lines(self, count):
+        if self._max_lines_per_second is None:
+            return count
+        now = time.monotonic()
+        if now - self._window_start >= 1:
+            self._report_dropped_lines()
+            self._window_start = now
+            self._window_lines = 0
+        allowed = max(0, min(count, self._max_lines_per_second - self._window_lines))
+        self._window_lines += allowed
+        self._dropped_lines += count - allowed
+        return allowed
+
+    def _report_dropped_lines(self):
+        if self._dropped_lines == 0:
+            return
+        try:
+            self.stream.write('[nimp] %d lines not shown on the console (rate limit)%s'
+                              % (self._dropped_lines, self.terminator))
+            self.flush()
+        except Exception: # pylint: disable = broad-except
+            pass
+        self._dropped_lines = 0
+
+
+class BatchFileHandler(logging.handlers.WatchedFileHandler):
+    ''' WatchedFileHandler checking the log file and formatting the record
+        prefix once per batch of child processes lines '''
+    def emit_lines(self, lines, source=None):
+        ''' Writes a batch of lines with a single write call '''
+        formatter = self.formatter or logging.Formatter()
+        record = logging.makeLogRecord({ 'name': CHILD_PROCESSES_LOGGER,
+                                         'levelno': logging.INFO,
+                                         'levelname': 'INFO',
+                                         'msg': '',
+                                         'child': source })
+        if hasattr(formatter, 'format_lines'):
+            content = ''.join(line + self.terminator for line in formatter.format_lines(lines, source))
+        elif getattr(formatter, '_fmt', '').endswith('%(message)s'):
+            prefix = self.format(record)
+            content = ''.join(prefix + line + self.terminator for line in lines)
+        else:
+            for line in lines:
+                self.handle(logging.makeLogRecord({ 'name': CHILD_PROCESSES_LOGGER,
+                                                    'levelno': logging.INFO,
+                                                    'levelname': 'INFO',
+                                                    'msg': line,
+                                                    'child': source }))
+            return
+
+        with self.lock:
+            try:
+                self.reopenIfNeeded()
+                if self.stream is None:
+                    self.stream = self._open()
+                self.stream.write(content)
+                self.flush()
+            except Exception: # pylint: disable = broad-except
+                self.handleError(record)
+
+
+def open_command_log(command, path=None):
+    ''' Returns a CompressedLogWriter for the output of given command, writing
+        to path if set, otherwise to a new file in the directory set by the
+        NIMP_COMMAND_LOG_DIR environment variable. Returns None if no path is
+        set or if the file can't be created. '''
+    if path is None:
+        directory = os.environ.get('NIMP_COMMAND_LOG_DIR')
+        if not directory:
+            return None
+        with _COMMAND_LOG_LOCK:
+            _COMMAND_LOG_COUNTER[0] += 1
+            counter = _COMMAND_LOG_COUNTER[0]
+        name = re.sub(r'[^\w.-]', '_', os.path.basename(command[0]))
+        path = os.path.join(directory, '%s-%d-%d-%s.log' % (time.strftime('%Y%m%d-%H%M%S'),
+                                                           os.getpid(), counter, name))
+
+    compression = os.environ.get('NIMP_COMMAND_LOG_COMPRESSION')
+    try:
+        return CompressedLogWriter(path, compression)
+    except (OSError, ValueError) as ex:
+        logging.warning('Unable to write command log %s: %s', path, ex)
+        return None
+
+
+class CompressedLogWriter():
+    ''' Writes lines to gzip or zstd compressed log files from a background
+        thread.
+
+        Compressed data is flushed every flush_interval seconds, so that logs
+        can be read while the command runs. Once a file reaches max_size
+        compressed bytes, the log continues in a new file named path.1.gz,
+        path.2.gz, etc. Every flush point is recorded in a JSON lines index
+        next to each file (e.g. path.gz.idx) with the number of lines written
+        before it, and its uncompressed and compressed offsets in the file.
+        Decompression can start at any of these compressed offsets: gzip
+        streams are fully flushed (use raw deflate from there), and zstd
+        streams start a new frame. '''
+    def __init__(self, path, compression=None, max_size=COMMAND_LOG_MAX_SIZE, flush_interval=5.0):
+        if compression is None:
+            compression = 'zstd' if zstandard is not None else 'gzip'
+        if compression not in [ 'gzip', 'zstd' ]:
+            raise ValueError('Unknown log compression "%s"' % compression)
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('Module zstandard is required for zstd compression')
+
+        self.path = path
+        self.compression = compression
+        self._extension = '.gz' if compression == 'gzip' else '.zst'
+        self._max_size = max_size
+        self._flush_interval = flush_interval
+
+        self._condition = threading.Condition()
+        self._pending = []
+        self._closed = False
+
+        self._part = 0
+        self._line_count = 0
+        self._file = None
+        self._index_file = None
+        self._compressor = None
+        self._offset = 0
+        self._flushed_offset = 0
+        self._compressed_offset = 0
+        self._open_part()
+
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    @property
+    def file_path(self):
+        ''' Returns the path of the file currently written '''
+        suffix = '.%d' % self._part if self._part > 0 else ''
+        return self.path + suffix + self._extension
+
+    def write(self, line):
+        ''' Queues a line for writing. Lines should end with a newline. '''
+        with self._condition:
+            self._pending.append(line)
+
+    def close(self):
+        ''' Writes pending lines, then closes the log files '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _worker(self):
+        next_flush = time.monotonic() + self._flush_interval
+        closed = False
+        while not closed:
+            with self._condition:
+                if not self._closed:
+                    self._condition.wait(0.1)
+                lines, self._pending = self._pending, []
+                closed = self._closed
+            try:
+                if lines:
+                    self._write(''.join(lines).encode('utf-8', errors='surrogateescape'), len(lines))
+                if closed:
+                    self._close_part()
+                elif time.monotonic() >= next_flush:
+                    self._flush()
+                    next_flush = time.monotonic() + self._flush_interval
+            except OSError as ex:
+                logging.warning('Unable to write %s, discarding further output: %s', self.file_path, ex)
+                self._discard()
+                return
+
+    def _open_part(self):
+        # pylint: disable = consider-using-with
+        self._file = open(self.file_path, 'wb')
+        self._index_file = open(self.file_path + '.idx', 'w')
+        self._offset = 0
+        self._flushed_offset = 0
+        self._compressed_offset = 0
+        self._compressor = self._create_compressor()
+        self._write_index()
+
+    def _close_part(self):
+        if self.compression == 'gzip':
+            self._write_compressed(self._compressor.flush(zlib.Z_FINISH))
+        else:
+            self._write_compressed(self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH))
+        self._file.close()
+        self._index_file.close()
+        self._file = None
+        self._index_file = None
+
+    def _discard(self):
+        with self._condition:
+            self._pending = []
+        for stream in [ self._file, self._index_file ]:
+            if stream is not None:
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+        self._file = None
+        self._index_file = None
+
+    def _create_compressor(self):
+        if self.compression == 'gzip':
+            return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return zstandard.ZstdCompressor(level=3).compressobj()
+
+    def _write(self, data, line_count):
+        self._write_compressed(self._compressor.compress(data))
+        self._offset += len(data)
+        self._line_count += line_count
+        if self._compressed_offset >= self._max_size:
+            self._close_part()
+            self._part += 1
+            self._open_part()
+
+    def _write_compressed(self, data):
+        self._file.write(data)
+        self._compressed_offset += len(data)
+
+    def _flush(self):
+        if self._offset == self._flushed_offset:
+            return
+        self._flushed_offset = self._offset
+        if self.compression == 'gzip':
+            self._write_compressed(self._compressor.flush(zlib.Z_FULL_FLUSH))
+        else:
+            # Ending the frame makes the next one decodable on its own
+            self._write_compressed(self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH))
+            self._compressor = self._create_compressor()
+        self._file.flush()
+        self._write_index()
+
+    def _write_index(self):
+        self._index_file.write(json.dumps({ 'line': self._line_count,
+                                            'offset': self._offset,
+                                            'compressed_offset': self._compressed_offset }) + '\n')
+        self._index_file.flush()
@@ -34,6 +34,7 @@ import nimp.commands
 import nimp.environment
 import nimp.system
 import nimp.sys.process
+import nimp.sys.scheduling
 import nimp.unreal
 
 sys.dont_write_bytecode = 1
@@ -73,7 +74,8 @@ def main(argv = sys.argv):
 
         _clean_environment_variables()
 
-        nimp.environment.Environment.config_loaders += [nimp.unreal.load_config]
+        nimp.environment.Environment.config_loaders += [nimp.unreal.load_config,
+                                                        nimp.sys.scheduling.load_config]
 
         argument_loaders = [nimp.system.load_arguments,
                             nimp.command.load_arguments,
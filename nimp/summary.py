@@ -24,11 +24,169 @@
 values and command line parameters set for this nimp execution '''
 
 import collections
+import importlib
+import json
 import logging
-from logging.handlers import WatchedFileHandler
 import os
+import queue
 import re
 import sys
+import threading
+
+import nimp.log
+import nimp.sys.process
+
+# Summary size kept in memory before moving it to a temporary file
+SUMMARY_MEMORY_LIMIT = 4 * 1024 * 1024 # pylint: disable = invalid-name
+
+# Members of the private regular expression parser module used to find
+# keywords of patterns, see _get_regex_parser
+_REGEX_PARSER_MEMBERS = [ 'parse', 'LITERAL', 'SUBPATTERN', 'MAX_REPEAT', 'MIN_REPEAT', 'SRE_FLAG_IGNORECASE' ] # pylint: disable = invalid-name
+
+# Maximum number of messages or batches of lines waiting to be summarized
+SUMMARY_QUEUE_SIZE = 1024 # pylint: disable = invalid-name
+
+
+class PatternMatcher():
+    ''' Finds the first of a list of compiled patterns matching the beginning
+        of a string, like calling match on each of them in turn would.
+
+        Strings containing none of the literal keywords required by the
+        patterns (e.g. "error" or "[Warn]") are rejected without running any
+        regular expression. Other strings are matched against a single
+        alternation of all patterns, telling which one matched. '''
+    def __init__(self, patterns):
+        self._patterns = list(patterns)
+        self._keywords = _get_keywords(self._patterns)
+        self._combined = None
+        self._group_patterns = {}
+
+        alternatives = []
+        for index, pattern in enumerate(self._patterns):
+            # Named groups must be unique in the combined expression
+            source = _rename_groups(pattern, '_p%d_' % index)
+            if pattern.flags != re.compile('').flags or _has_group_references(pattern) or source is None:
+                alternatives = None
+                break
+            alternatives.append('(?P<_p%d>%s)' % (index, source))
+
+        if alternatives:
+            try:
+                self._combined = re.compile('|'.join(alternatives))
+                self._group_patterns = { self._combined.groupindex['_p%d' % index]: index
+                                         for index in range(len(self._patterns)) }
+            except (re.error, RecursionError, OverflowError) as ex:
+                logging.debug('Unable to combine summary patterns: %s', ex)
+                self._combined = None
+
+    def match(self, msg):
+        ''' Returns a (pattern index, match object) tuple for the first pattern
+            matching msg, or None '''
+        if self._keywords is not None:
+            for keyword in self._keywords:
+                if keyword in msg:
+                    break
+            else:
+                return None
+
+        if self._combined is None:
+            for index, pattern in enumerate(self._patterns):
+                match = pattern.match(msg)
+                if match is not None:
+                    return index, match
+            return None
+
+        combined_match = self._combined.match(msg)
+        if combined_match is None:
+            return None
+        # The outer group of the matching alternative is the last one closed
+        index = self._group_patterns[combined_match.lastindex]
+        return index, self._patterns[index].match(msg)
+
+
+def _get_keywords(patterns):
+    # Returns literal substrings at least one of which is contained in any
+    # string matched by the patterns, or None if a pattern can match without
+    # any known literal
+    parser = _get_regex_parser()
+    if parser is None:
+        return None
+
+    keywords = set()
+    for pattern in patterns:
+        if pattern.flags & re.IGNORECASE:
+            return None
+        # Parsed patterns are an implementation detail that may change
+        try:
+            literals = _get_required_literals(parser, parser.parse(pattern.pattern, pattern.flags))
+        except Exception: # pylint: disable = broad-except
+            return None
+        if not literals:
+            return None
+        keywords.add(max(literals, key = len))
+
+    # A keyword containing another one is redundant
+    return sorted(keyword for keyword in keywords
+                  if not any(other != keyword and other in keyword for other in keywords))
+
+
+def _get_regex_parser():
+    # Returns the private module of the re package parsing patterns, or None
+    # if it is missing or doesn't have what is needed, in which case strings
+    # aren't prefiltered
+    for module_name in [ 're._parser', 'sre_parse' ]:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        if all(hasattr(module, member) for member in _REGEX_PARSER_MEMBERS):
+            return module
+        return None
+    return None
+
+
+def _get_required_literals(parser, parsed):
+    # Returns runs of literal characters appearing in every match
+    literals = []
+    current = []
+    for opcode, argument in parsed:
+        if opcode is parser.LITERAL:
+            current.append(chr(argument))
+            continue
+        if current:
+            literals.append(''.join(current))
+            current = []
+        if opcode is parser.SUBPATTERN:
+            _, add_flags, _, sub_pattern = argument
+            if not add_flags & parser.SRE_FLAG_IGNORECASE:
+                literals += _get_required_literals(parser, sub_pattern)
+        elif opcode in (parser.MAX_REPEAT, parser.MIN_REPEAT) and argument[0] >= 1:
+            literals += _get_required_literals(parser, argument[2])
+    if current:
+        literals.append(''.join(current))
+    return literals
+
+
+def _rename_groups(pattern, prefix):
+    # Returns the source of pattern with prefix added to its group names, or
+    # None if some of them couldn't be found. Escaped characters and sets,
+    # where parentheses are literals, are kept as is.
+    renamed = []
+    def _rename(match):
+        if match.group(1) is None:
+            return match.group(0)
+        renamed.append(match.group(1))
+        return '(?P<%s%s>' % (prefix, match.group(1))
+    source = re.sub(r'\\.|\[\^?\]?(?:\\.|[^\]\\])*\]|\(\?P<(\w+)>', _rename, pattern.pattern, flags = re.DOTALL)
+    if sorted(renamed) != sorted(pattern.groupindex):
+        return None
+    return source
+
+
+def _has_group_references(pattern):
+    return (re.search(r'\\[1-9]|\(\?P=|\(\?\(', pattern.pattern) is not None or
+            re.search(r'\(\?[aiLmsux]+\)', pattern.pattern) is not None)
+
 
 class SummaryHandler(logging.Handler):
     """ Base class for summary handler.
@@ -37,11 +195,9 @@ class SummaryHandler(logging.Handler):
     def __init__(self, env):
         super().__init__(logging.DEBUG)
 
-        if "NIMP_LOG_FILE" in os.environ:
-            self.log_all_handler = WatchedFileHandler(os.environ["NIMP_LOG_FILE"])
-            self.log_all_handler.setLevel(logging.DEBUG)
-            self.log_all_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
-
+        # Opened when entering the handler, as handlers can also be used to
+        # summarize existing logs
+        self.log_all_handler = None
         self._env = env
         self._ignore_patterns = []
         self._error_patterns = []
@@ -49,6 +205,16 @@ class SummaryHandler(logging.Handler):
         self._context_patterns = []
         self._has_errors = False
         self._has_warnings = False
+        # Number of child processes output lines processed so far, including
+        # the current one. Messages logged by nimp itself aren't counted, so
+        # that these match line numbers of the replayed output.
+        self._line_count = 0
+
+        # Lines are matched by a worker thread, so that slow patterns don't
+        # hold back the threads reading child processes output
+        self._queue = queue.Queue(SUMMARY_QUEUE_SIZE)
+        self._worker = None
+        self._log_queue = None
 
         error_patterns = [
             # GCC
@@ -109,6 +275,10 @@ class SummaryHandler(logging.Handler):
                                'context_patterns',
                                self._context_patterns)
 
+        self._line_matcher = PatternMatcher(self._ignore_patterns +
+                                            self._error_patterns +
+                                            self._warning_patterns)
+
     def _compile_patterns(self, patterns, key, destination):
         config_key = 'summary_%s' % key
         if hasattr(self._env, config_key):
@@ -136,26 +306,49 @@ class SummaryHandler(logging.Handler):
         for handler in list(logging.root.handlers):
             root_logger.removeHandler(handler)
 
-        logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s',
+        log_format = getattr(self._env, 'log_format', 'standard')
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(nimp.log.create_formatter(log_format))
+        logging.basicConfig(handlers=[stream_handler],
                             level=log_level)
 
-        child_processes_logger = logging.getLogger('child_processes')
+        child_processes_logger = logging.getLogger(nimp.log.CHILD_PROCESSES_LOGGER)
         child_processes_logger.propagate = False
         child_processes_logger.setLevel(logging.INFO)
-        handler = logging.StreamHandler(sys.stdout)
-        handler.setFormatter(logging.Formatter('%(message)s'))
+        handler = nimp.log.ChildStreamHandler(sys.stdout, getattr(self._env, 'console_rate_limit', None))
+        if log_format == 'jsonl':
+            handler.setFormatter(nimp.log.JsonFormatter())
         child_processes_logger.addHandler(handler)
 
+        if "NIMP_LOG_FILE" in os.environ:
+            self.log_all_handler = nimp.log.BatchFileHandler(os.environ["NIMP_LOG_FILE"])
+            self.log_all_handler.setLevel(logging.DEBUG)
+            self.log_all_handler.setFormatter(nimp.log.create_formatter(log_format))
+
         # Enables warnings and errors recording
         if self._env.summary is not None:
             root_logger.addHandler(self)
             child_processes_logger.addHandler(self)
-            if hasattr(self, "log_all_handler"):
+            if self.log_all_handler is not None:
                 child_processes_logger.addHandler(self.log_all_handler)
+            self._start_worker()
+
+        if self.log_all_handler is not None:
+            root_logger.addHandler(self.log_all_handler)
+
+        # Handlers run on a logging thread unless --log-queue-size is 0
+        log_queue_size = getattr(self._env, 'log_queue_size', None)
+        if log_queue_size:
+            drop = getattr(self._env, 'log_queue_policy', 'block') == 'drop'
+            self._log_queue = nimp.log.LogQueue(log_queue_size, drop)
+            self._log_queue.attach(root_logger)
+            self._log_queue.attach(child_processes_logger)
+            self._log_queue.start()
 
         return self
 
     def __exit__(self, ex_type, value, traceback):
+        self._stop_workers()
         if self._env.summary is not None:
             summary = self._env.summary
             # So we can print summary to stdout
@@ -167,48 +360,141 @@ class SummaryHandler(logging.Handler):
 
     def has_errors(self):
         ''' Returns true if errors were emitted during program execution '''
+        self.flush()
         return self._has_errors
 
     def has_warnings(self):
         ''' Returns true if warnings were emitted during program execution '''
+        self.flush()
         return self._has_warnings
 
     def emit(self, record):
         msg = record.getMessage()
+        formatted_msg = None
+        if record.levelno >= logging.WARNING:
+            formatted_msg = self.format(record)
 
-        for pattern in self._ignore_patterns:
-            if pattern.match(msg):
-                self._add_notif(msg)
-                return
+        is_child = record.name == nimp.log.CHILD_PROCESSES_LOGGER
+        if self._is_async():
+            self._queue.put((record.levelno, msg, formatted_msg, is_child))
+        else:
+            self._process_record(record.levelno, msg, formatted_msg, is_child)
 
-        if record.levelno == logging.CRITICAL or record.levelno == logging.ERROR:
-            self._add_error(self.format(record))
-            self._has_errors = True
+    def emit_lines(self, lines, source=None): # pylint: disable = unused-argument
+        ''' Processes a batch of child process output lines, without building
+            log records for them. Lines are summarized whatever their source. '''
+        if self._is_async():
+            self._queue.put(list(lines))
             return
-        if record.levelno == logging.WARNING:
-            self._add_warning(self.format(record))
-            self._has_warnings = True
+        with self.lock:
+            for line in lines:
+                self._process_line(line)
+
+    def skip_lines(self, count):
+        ''' Accounts for lines that were filtered out before reaching this
+            handler, e.g. when replaying part of a log file '''
+        self.flush()
+        self._line_count += count
+
+    def get_filter_patterns(self):
+        ''' Returns the patterns of lines this handler must always receive.
+            Other lines only matter as context for the closest errors and
+            warnings, i.e. up to four lines after and before them. '''
+        return self._error_patterns + self._warning_patterns
+
+    def write_summary(self, destination):
+        ''' Writes the summary of all processed messages to destination '''
+        self.flush()
+        self._write_summary(destination)
+
+    def flush(self):
+        ''' Waits until all queued messages are processed '''
+        if self._log_queue is not None:
+            self._log_queue.flush()
+        if self._is_async():
+            self._queue.join()
+
+    def _is_async(self):
+        # Messages logged by the worker itself would wait for it forever
+        worker = self._worker
+        return worker is not None and worker is not threading.current_thread()
+
+    def _start_worker(self):
+        self._worker = threading.Thread(target = self._summary_worker, daemon = True)
+        self._worker.start()
+
+    def _stop_workers(self):
+        if self._log_queue is not None:
+            self._log_queue.stop()
+            self._log_queue = None
+        worker, self._worker = self._worker, None
+        if worker is not None:
+            self._queue.put(None)
+            worker.join()
+
+    def _summary_worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if isinstance(item, list):
+                    for line in item:
+                        self._process_line(line)
+                else:
+                    self._process_record(*item)
+            # Logging errors from here would go back to this handler
+            except Exception: # pylint: disable = broad-except
+                sys.excepthook(*sys.exc_info())
+            finally:
+                self._queue.task_done()
+
+    def _process_record(self, levelno, msg, formatted_msg, is_child):
+        if is_child:
+            self._line_count += 1
+        if levelno in (logging.CRITICAL, logging.ERROR, logging.WARNING):
+            for pattern in self._ignore_patterns:
+                if pattern.match(msg):
+                    self._add_notif(msg)
+                    return
+
+            if levelno in (logging.CRITICAL, logging.ERROR):
+                self._add_error(formatted_msg)
+                self._has_errors = True
+                return
+            if levelno == logging.WARNING:
+                self._add_warning(formatted_msg)
+                self._has_warnings = True
+                return
+
+        self._match_line(msg)
+
+    def _process_line(self, msg):
+        self._line_count += 1
+        self._match_line(msg)
+
+    def _match_line(self, msg):
+        # Ignore, error and warning patterns are tried in this order
+        result = self._line_matcher.match(msg)
+        if result is None:
+            self._add_notif(msg)
             return
 
-        if SummaryHandler._match_message(self._error_patterns, msg, self._add_error):
-            self._has_errors = True
-        elif self._match_message(self._warning_patterns, msg, self._add_warning):
-            self._has_warnings = True
-        else:
+        index, match = result
+        if index < len(self._ignore_patterns):
             self._add_notif(msg)
+            return
 
-    @staticmethod
-    def _match_message(patterns, msg, add_callback):
-        for pattern in patterns:
-            match = pattern.match(msg)
-            if match is not None:
-                group_dict = match.groupdict()
-                if 'message' in group_dict:
-                    msg = group_dict['message']
+        group_dict = match.groupdict()
+        if 'message' in group_dict:
+            msg = group_dict['message']
 
-                add_callback(msg)
-                return True
-        return False
+        if index < len(self._ignore_patterns) + len(self._error_patterns):
+            self._add_error(msg)
+            self._has_errors = True
+        else:
+            self._add_warning(msg)
+            self._has_warnings = True
 
     def _add_notif(self, msg):
         pass
@@ -228,9 +514,26 @@ class DefaultSummaryHandler(SummaryHandler):
     adding three lines of context before / after errors """
     def __init__(self, env):
         super().__init__(env)
-        self._summary = ''
+        self._summary = nimp.sys.process.OutputBuffer(SUMMARY_MEMORY_LIMIT)
+        self._live_summary = None
         self._context = collections.deque([], 4)
 
+    def __enter__(self):
+        # With --summary-live, the summary file is written as messages come
+        summary = self._env.summary
+        if summary is not None and summary.lower() != 'stdout' and getattr(self._env, 'summary_live', False):
+            self._live_summary = open(summary, 'w')
+        return super().__enter__()
+
+    def __exit__(self, ex_type, value, traceback):
+        if self._live_summary is not None:
+            self._stop_workers()
+            self._live_summary.close()
+            self._live_summary = None
+        else:
+            super().__exit__(ex_type, value, traceback)
+        self._summary.close()
+
     def _add_notif(self, msg):
         for pattern in self._context_patterns:
             match = pattern.match(msg)
@@ -243,22 +546,71 @@ class DefaultSummaryHandler(SummaryHandler):
         show_context = len(self._context) < self._context.maxlen
         show_context = show_context and (self._has_errors or self._has_warnings)
         if show_context:
-            self._summary += '[  NOTIF  ] %s\n' % (msg,)
+            self._append('[  NOTIF  ] %s\n' % (msg,))
 
     def _add_warning(self, msg):
-        if len(self._context) == self._context.maxlen:
-            self._summary += '\n *********************************************\n'
-            while self._context:
-                self._summary += '[  NOTIF  ] %s\n' % (self._context.popleft(),)
-        self._summary += '[ WARNING ] %s\n' % (msg,)
+        self._append_context()
+        self._append('[ WARNING ] %s\n' % (msg,))
 
     def _add_error(self, msg):
+        self._append_context()
+        self._append('[  ERROR  ] %s\n' % (msg,))
+
+    def _append_context(self):
         if len(self._context) == self._context.maxlen:
-            self._summary += '\n *********************************************\n'
+            self._append('\n *********************************************\n')
             while self._context:
-                self._summary += '[  NOTIF  ] %s\n' % (self._context.popleft(),)
-        self._summary += '[  ERROR  ] %s\n' % (msg,)
+                self._append('[  NOTIF  ] %s\n' % (self._context.popleft(),))
+
+    def _append(self, text):
+        if self._live_summary is None:
+            self._summary.write(text)
+            return
+        self._live_summary.write(text)
+        self._live_summary.flush()
+
+    def _write_summary(self, destination):
+        ''' Writes summary to destination '''
+        destination.writelines(self._summary)
+
+
+class JsonSummaryHandler(SummaryHandler):
+    """ Summary handler writing one JSON object per line for each distinct
+    error or warning, with its number of occurrences, the numbers of the
+    first and last lines it appeared on, and the lines preceding its first
+    occurrence. Lines are numbered within the output of child processes,
+    messages logged by nimp itself get the number of the last line output
+    before them. """
+    def __init__(self, env):
+        super().__init__(env)
+        self._messages = collections.OrderedDict()
+        self._context = collections.deque([], 3)
+
+    def _add_notif(self, msg):
+        self._context.append(msg)
+
+    def _add_warning(self, msg):
+        self._add_message('warning', msg)
+
+    def _add_error(self, msg):
+        self._add_message('error', msg)
+
+    def _add_message(self, level, msg):
+        key = (level, msg)
+        entry = self._messages.get(key)
+        if entry is None:
+            entry = { 'level': level,
+                      'message': msg,
+                      'count': 0,
+                      'first_line': self._line_count,
+                      'last_line': self._line_count,
+                      'context': list(self._context) }
+            self._messages[key] = entry
+        entry['count'] += 1
+        entry['last_line'] = self._line_count
+        self._context.clear()
 
     def _write_summary(self, destination):
         ''' Writes summary to destination '''
-        destination.write(self._summary)
+        for entry in self._messages.values():
+            destination.write(json.dumps(entry) + '\n')
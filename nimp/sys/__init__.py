@@ -23,6 +23,10 @@
 ''' System functions '''
 
 __all__ = [
+    'cache',
+    'cgroup',
     'platform',
     'process',
+    'scheduling',
+    'usage',
 ]
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' On-disk cache of the results of read-only external commands '''
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import os.path
+import time
+
+# Arguments following these flags are not written in the cache files
+_SECRET_FLAGS = [ '-P', '--password' ] # pylint: disable = invalid-name
+
+
+def is_enabled():
+    ''' Returns False if the cache should be bypassed, i.e. when the
+        NIMP_NO_COMMAND_CACHE environment variable is set, or when running in
+        verbose mode so that every command is actually run '''
+    if os.environ.get('NIMP_NO_COMMAND_CACHE'):
+        return False
+    return not logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+def get_directory():
+    ''' Returns the directory in which nimp caches data between runs '''
+    if os.environ.get('NIMP_CACHE_DIR'):
+        return os.environ['NIMP_CACHE_DIR']
+    if os.environ.get('LOCALAPPDATA'):
+        return os.path.join(os.environ['LOCALAPPDATA'], 'nimp', 'cache')
+    if os.environ.get('XDG_CACHE_HOME'):
+        return os.path.join(os.environ['XDG_CACHE_HOME'], 'nimp')
+    return os.path.join(os.path.expanduser('~'), '.cache', 'nimp')
+
+
+def load(command, cwd, env_keys=(), stdin=None, extra_key=None):
+    ''' Returns the cached (exit code, stdout, stderr) tuple for given command,
+        or None if there is no valid entry '''
+    entry_path = _get_entry_path(command, cwd, env_keys, stdin, extra_key)
+    try:
+        with open(entry_path) as entry_file:
+            entry = json.load(entry_file)
+    except (OSError, ValueError):
+        return None
+
+    if entry['expires'] < time.time():
+        _remove(entry_path)
+        return None
+    return entry['exit_code'], entry['output'], entry['error']
+
+
+def store(command, cwd, ttl, result, env_keys=(), stdin=None, extra_key=None):
+    ''' Caches the (exit code, stdout, stderr) result of a command for ttl
+        seconds '''
+    entry_path = _get_entry_path(command, cwd, env_keys, stdin, extra_key)
+    now = time.time()
+    entry = { 'command': _mask_secrets(command),
+              'cwd': os.path.abspath(cwd),
+              'created': now,
+              'expires': now + ttl,
+              'exit_code': result[0],
+              'output': result[1],
+              'error': result[2] }
+    try:
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        # Write to a temporary file first, so that concurrent nimp instances
+        # never read partial entries
+        temp_path = '%s.%d.tmp' % (entry_path, os.getpid())
+        with open(temp_path, 'w') as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(temp_path, entry_path)
+    except OSError as ex:
+        logging.debug('Unable to write command cache entry %s: %s', entry_path, ex)
+
+
+def get_entries():
+    ''' Returns all cache entries as dictionaries, sorted by creation date '''
+    entries = []
+    for entry_path in glob.glob(os.path.join(get_directory(), 'commands', '*.json')):
+        try:
+            with open(entry_path) as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            continue
+        entry['key'] = os.path.splitext(os.path.basename(entry_path))[0]
+        entries.append(entry)
+    return sorted(entries, key = lambda entry: entry['created'])
+
+
+def clear(expired_only=False):
+    ''' Removes cache entries, returns the number of removed entries '''
+    removed = 0
+    now = time.time()
+    for entry in get_entries():
+        if expired_only and entry['expires'] >= now:
+            continue
+        if _remove(os.path.join(get_directory(), 'commands', entry['key'] + '.json')):
+            removed += 1
+    return removed
+
+
+def _get_entry_path(command, cwd, env_keys, stdin, extra_key):
+    key_data = [ list(command),
+                 os.path.abspath(cwd),
+                 { key: os.environ.get(key) for key in env_keys },
+                 stdin,
+                 extra_key ]
+    key = hashlib.sha256(json.dumps(key_data).encode('utf-8')).hexdigest()
+    return os.path.join(get_directory(), 'commands', key + '.json')
+
+
+def _mask_secrets(command):
+    result = []
+    for i, arg in enumerate(command):
+        result.append('******' if i > 0 and command[i - 1] in _SECRET_FLAGS else arg)
+    return result
+
+
+def _remove(entry_path):
+    try:
+        os.remove(entry_path)
+        return True
+    except OSError:
+        return False
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Linux control groups (v2) utilities '''
+
+import logging
+import os
+import os.path
+import re
+import threading
+
+_LOCK = threading.Lock() # pylint: disable = invalid-name
+_PARENT_CGROUP = {} # pylint: disable = invalid-name
+_COUNTER = [0] # pylint: disable = invalid-name
+
+
+def get_parent_cgroup():
+    ''' Returns the path of the cgroup v2 directory child groups are created
+        in, or None. Child groups are opt-in: the NIMP_CGROUP environment
+        variable should point to a cgroup delegated to the current user, for
+        instance with systemd's Delegate= setting, and holding no process
+        itself, as cgroups v2 only allow processes in leaf groups when
+        controllers are enabled. '''
+    path = os.environ.get('NIMP_CGROUP')
+    if not path:
+        return None
+    with _LOCK:
+        if path not in _PARENT_CGROUP:
+            error = _check_parent_cgroup(path)
+            if error is not None:
+                logging.warning('Unable to use cgroup %s (%s), only accounting child processes', path, error)
+            _PARENT_CGROUP[path] = path if error is None else None
+        return _PARENT_CGROUP[path]
+
+
+def create(name):
+    ''' Creates a child control group of the cgroup set with NIMP_CGROUP.
+        Returns None if it isn't set or usable, see get_parent_cgroup. '''
+    parent = get_parent_cgroup()
+    if parent is None:
+        return None
+
+    with _LOCK:
+        _COUNTER[0] += 1
+        group_name = 'nimp-%d-%d-%s' % (os.getpid(), _COUNTER[0], re.sub(r'[^\w.-]', '_', name))
+
+    path = os.path.join(parent, group_name)
+    try:
+        os.mkdir(path)
+    except OSError as ex:
+        logging.debug('Unable to create cgroup %s: %s', path, ex)
+        return None
+    return ControlGroup(path)
+
+
+class ControlGroup():
+    ''' A cgroup v2 directory in which child processes can be moved '''
+    def __init__(self, path):
+        self.path = path
+
+    def get_controllers(self):
+        ''' Returns the controllers enabled for this group, i.e. enabled in
+            the cgroup.subtree_control file of its parent '''
+        content = self._read('cgroup.controllers')
+        return content.split() if content is not None else []
+
+    def add_process(self, pid):
+        ''' Moves a process (and its future children) into this group '''
+        return self._write('cgroup.procs', str(pid))
+
+    def set_memory_limit(self, limit):
+        ''' Sets the maximum memory, in bytes, used by processes of this group '''
+        return self._write('memory.max', str(limit))
+
+    def set_cpu_limit(self, cpus, period=100000):
+        ''' Limits processes of this group to given number of CPUs, which can
+            be fractional '''
+        # The kernel refuses quotas below one millisecond
+        return self._write('cpu.max', '%d %d' % (max(1000, int(cpus * period)), period))
+
+    def get_stats(self):
+        ''' Returns CPU, memory and I/O statistics of this group. Only the
+            values exposed by the controllers enabled for this group are
+            returned. '''
+        stats = {}
+
+        cpu_stat = self._read_keyed('cpu.stat')
+        if 'user_usec' in cpu_stat:
+            stats['user_time'] = cpu_stat['user_usec'] / 1000000
+        if 'system_usec' in cpu_stat:
+            stats['system_time'] = cpu_stat['system_usec'] / 1000000
+
+        memory_peak = self._read('memory.peak')
+        if memory_peak is not None:
+            stats['max_memory'] = int(memory_peak)
+
+        io_stat = self._read('io.stat')
+        if io_stat is not None:
+            read_bytes = 0
+            written_bytes = 0
+            for device_line in io_stat.splitlines():
+                device_stat = _parse_keys(device_line.split()[1:], '=')
+                read_bytes += device_stat.get('rbytes', 0)
+                written_bytes += device_stat.get('wbytes', 0)
+            stats['read_bytes'] = read_bytes
+            stats['written_bytes'] = written_bytes
+
+        return stats
+
+    def destroy(self):
+        ''' Removes this group. Fails silently if some processes are still
+            running in it. '''
+        try:
+            os.rmdir(self.path)
+        except OSError as ex:
+            logging.debug('Unable to remove cgroup %s: %s', self.path, ex)
+
+    def _read(self, file_name):
+        try:
+            with open(os.path.join(self.path, file_name)) as group_file:
+                return group_file.read().strip()
+        except OSError:
+            return None
+
+    def _read_keyed(self, file_name):
+        content = self._read(file_name)
+        if content is None:
+            return {}
+        return _parse_keys(content.split('\n'), ' ')
+
+    def _write(self, file_name, value):
+        try:
+            with open(os.path.join(self.path, file_name), 'w') as group_file:
+                group_file.write(value)
+            return True
+        except OSError as ex:
+            logging.debug('Unable to write %s to %s/%s: %s', value, self.path, file_name, ex)
+            return False
+
+
+def _parse_keys(entries, separator):
+    result = {}
+    for entry in entries:
+        key, _, value = entry.partition(separator)
+        try:
+            result[key.strip()] = int(value)
+        except ValueError:
+            pass
+    return result
+
+
+def _check_parent_cgroup(path):
+    # Returns why a directory can't be used to create child groups, or None
+    if not os.path.isfile(os.path.join(path, 'cgroup.controllers')):
+        return 'not a cgroup v2 directory'
+    for file_name in [ 'cgroup.procs', 'cgroup.subtree_control' ]:
+        if not os.access(os.path.join(path, file_name), os.W_OK):
+            return '%s is not writable, the cgroup is not delegated' % file_name
+    if not os.access(path, os.W_OK):
+        return 'not writable'
+    try:
+        with open(os.path.join(path, 'cgroup.procs')) as procs:
+            if procs.read().strip():
+                return 'it already holds processes'
+    except OSError as ex:
+        return str(ex)
+    return None
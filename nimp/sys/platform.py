@@ -35,3 +35,7 @@ def is_msys():
 def is_osx():
     ''' Returns True if the platform is OS X. '''
     return platform.system() == 'Darwin'
+
+def is_linux():
+    ''' Returns True if the platform is Linux. '''
+    return platform.system() == 'Linux'
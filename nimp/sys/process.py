@@ -27,17 +27,56 @@ import logging
 import locale
 import os
 import os.path
+import shutil
 import struct
 import subprocess
+import tempfile
 import threading
 import time
 
+import nimp.log
+import nimp.sys.cache
 import nimp.sys.platform
+import nimp.sys.scheduling
+import nimp.sys.usage
+
+# Number of characters of captured output kept in memory for each stream
+# before spilling to a temporary file
+CAPTURE_MEMORY_LIMIT = 16 * 1024 * 1024 # pylint: disable = invalid-name
+
+# Size of the blocks read from stdout when capturing binary output
+_BINARY_READ_SIZE = 64 * 1024 # pylint: disable = invalid-name
 
 
 def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
-         capture_output=False, capture_debug=False, hide_output=False, simulate=False):
-    ''' Calls a process redirecting its output to nimp's output '''
+         capture_output=False, capture_debug=False, hide_output=False, simulate=False,
+         stream_capture=False, capture_limit=CAPTURE_MEMORY_LIMIT, capture_binary=False,
+         cache_ttl=None, cache_env=(), cache_key=None,
+         nice=None, ionice=None, affinity=None, memory_limit=None, cpu_limit=None,
+         log_file=None):
+    ''' Calls a process redirecting its output to nimp's output.
+
+        If capture_output is set, returns a tuple containing the exit code,
+        stdout and stderr. Captured output above capture_limit characters is
+        spilled to disk. If stream_capture is also set, stdout and stderr are
+        returned as OutputBuffer objects that can be iterated line by line,
+        and that the caller should close once done with them.
+
+        If capture_binary is also set, stdout is captured as raw bytes and
+        isn't logged. It is returned as a bytes object, or as a binary file
+        object positioned at its start if stream_capture is set.
+
+        Read-only commands can set cache_ttl to reuse successful captured
+        results for that many seconds. Results are cached per command line,
+        working directory, stdin, values of the cache_env environment
+        variables and cache_key.
+
+        The nice, ionice, affinity, memory_limit and cpu_limit arguments
+        override the scheduling defaults set in nimp.sys.scheduling.
+
+        If log_file is set, or if the NIMP_COMMAND_LOG_DIR environment
+        variable is set and output isn't hidden, output is also written to a
+        compressed log file (see nimp.log.CompressedLogWriter). '''
     command = _sanitize_command(command)
     if not hide_output:
         logging.info('Running "%s" in "%s"', ' '.join(command), os.path.abspath(cwd))
@@ -45,26 +84,61 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
     if simulate:
         return 0
 
+    use_cache = cache_ttl is not None and capture_output and not capture_binary and nimp.sys.cache.is_enabled()
+    if use_cache:
+        cached_result = nimp.sys.cache.load(command, cwd, cache_env, stdin, cache_key)
+        if cached_result is not None:
+            if not hide_output:
+                logging.info('Using cached result (exit code %d)', cached_result[0])
+            if stream_capture:
+                return (cached_result[0],
+                        OutputBuffer.from_text(cached_result[1], capture_limit),
+                        OutputBuffer.from_text(cached_result[2], capture_limit))
+            return cached_result
+
     if capture_debug and not hide_output and nimp.sys.platform.is_windows():
         _disable_win32_dialogs()
         debug_pipe = _OutputDebugStringLogger()
     else:
         debug_pipe = None
 
+    usage = nimp.sys.usage.ResourceUsage(command, cwd)
+    scheduling = nimp.sys.scheduling.get_settings(nice=nice, ionice=ionice, affinity=affinity,
+                                                  memory_limit=memory_limit, cpu_limit=cpu_limit)
+    if scheduling:
+        logging.debug('Child process scheduling: %s', scheduling)
+    # Limits are set before the child joins its cgroup, and other settings
+    # are applied by wrapper commands that exec the actual command, so that
+    # it never runs unconstrained
+    cgroup = usage.create_cgroup()
+    nimp.sys.scheduling.apply_limits(scheduling, cgroup)
+    prefix = nimp.sys.scheduling.get_command_prefix(scheduling, cgroup)
+    if prefix and not _is_executable(command[0], cwd):
+        # Wrappers would fail with exit code 127, report it like Popen does
+        logging.error('No such file or directory: \'%s\'', command[0])
+        usage.discard()
+        return 1
+
     # The bufsize = 1 is important; if we don’t bufferise the output, we’re
     # going to make the callee lag a lot. Using 1 or 1024 or 65536 does not
     # make any noticeable difference, though.
     try:
-        process = subprocess.Popen(command,
+        process = subprocess.Popen(prefix + command,
                                    cwd     = cwd,
                                    stdout  = subprocess.PIPE,
                                    stderr  = subprocess.PIPE,
                                    stdin   = subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
-                                   bufsize = 1)
+                                   bufsize = 1,
+                                   creationflags = nimp.sys.scheduling.get_creation_flags(scheduling))
     except FileNotFoundError as ex:
         logging.error(ex)
+        usage.discard()
         return 1
 
+    usage.attach(process.pid)
+    if scheduling:
+        nimp.sys.scheduling.apply(process, scheduling, cgroup)
+
     if debug_pipe:
         debug_pipe.attach(process.pid)
         debug_pipe.start()
@@ -74,12 +148,27 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
                   process.stderr,
                   debug_pipe.output if debug_pipe else None ]
 
-    all_captures = [ [] if capture_output else None,
-                     [] if capture_output else None,
+    if not capture_output:
+        stdout_capture = None
+    elif capture_binary:
+        stdout_capture = tempfile.SpooledTemporaryFile(max_size=capture_limit) # pylint: disable = consider-using-with
+    else:
+        stdout_capture = OutputBuffer(capture_limit)
+
+    all_captures = [ stdout_capture,
+                     OutputBuffer(capture_limit) if capture_output else None,
                      None ]
 
     debug_info = [ False ]
 
+    output_batcher = _OutputBatcher(process.pid, command)
+
+    command_log = None
+    if log_file is not None or not hide_output:
+        command_log = nimp.log.open_command_log(command, log_file)
+        if command_log is not None and not hide_output:
+            logging.info('Writing output to %s', command_log.file_path)
+
     def _heartbeat_worker(heartbeat):
         last_time = time.monotonic()
         while process is not None:
@@ -88,18 +177,27 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
                 last_time += heartbeat
             time.sleep(0.050)
 
+    def _flush_worker():
+        while process is not None:
+            time.sleep(0.050)
+            output_batcher.flush()
+
     def _input_worker(in_pipe, data):
         in_pipe.write(data)
         in_pipe.close()
 
     def _output_worker(index):
         in_pipe = all_pipes[index]
-        capture_array = all_captures[index]
+        capture_buffer = all_captures[index]
         if in_pipe is None:
             return
+        if index == 0 and capture_binary:
+            for data in iter(lambda: in_pipe.read(_BINARY_READ_SIZE), b''):
+                if capture_buffer is not None:
+                    capture_buffer.write(data)
+            return
         force_ascii = locale.getpreferredencoding().lower() != 'utf-8'
         while process is not None:
-            logger = logging.getLogger('child_processes')
             # Try to decode as UTF-8 with BOM first; if it fails, try CP850 on
             # Windows, or UTF-8 with BOM and error substitution elsewhere. If
             # it fails again, try CP850 with error substitution.
@@ -114,8 +212,11 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
                     except UnicodeError:
                         pass
 
-                if capture_array is not None:
-                    capture_array.append(line)
+                if capture_buffer is not None:
+                    capture_buffer.write(line)
+
+                if command_log is not None:
+                    command_log.write(line)
 
                 # Stop reading data from stdout if data has arrived on OutputDebugString
                 if index == 2:
@@ -126,7 +227,7 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
                     return
 
                 if not hide_output:
-                    logger.info(line.strip('\n').strip('\r'))
+                    output_batcher.add(line.strip('\n').strip('\r'))
 
             # Sleep for 10 milliseconds if there was no data,
             # or we’ll hog the CPU.
@@ -140,6 +241,10 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
     if stdin is not None:
         all_workers.append(threading.Thread(target=_input_worker, args=(process.stdin, stdin.encode(encoding))))
 
+    # Log output by blocks, at least every 50 milliseconds
+    if not hide_output:
+        all_workers.append(threading.Thread(target=_flush_worker))
+
     # Send keepalive to stderr if requested
     if heartbeat > 0:
         all_workers.append(threading.Thread(target = _heartbeat_worker, args = (heartbeat, )))
@@ -148,7 +253,7 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
         thread.start()
 
     try:
-        exit_code = process.wait()
+        exit_code = usage.wait(process)
     finally:
         process = None
         # For some reason, must be done _before_ threads are joined, or
@@ -158,15 +263,133 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
             debug_pipe = None
         for thread in all_workers:
             thread.join()
+        output_batcher.flush()
+        if command_log is not None:
+            command_log.close()
 
     if not hide_output:
         logging.info('Finished with exit code %d (0x%08x)', exit_code, exit_code)
+        usage.log()
+    usage.save()
 
     if capture_output:
-        return exit_code, ''.join(all_captures[0]), ''.join(all_captures[1])
+        if capture_binary:
+            all_captures[0].seek(0)
+            if stream_capture:
+                return exit_code, all_captures[0], all_captures[1]
+            with all_captures[0] as output, all_captures[1] as error:
+                return exit_code, output.read(), error.getvalue()
+        if use_cache and exit_code == 0:
+            nimp.sys.cache.store(command, cwd, cache_ttl,
+                                 (exit_code, all_captures[0].getvalue(), all_captures[1].getvalue()),
+                                 cache_env, stdin, cache_key)
+        if stream_capture:
+            return exit_code, all_captures[0], all_captures[1]
+        with all_captures[0] as output, all_captures[1] as error:
+            return exit_code, output.getvalue(), error.getvalue()
     return exit_code
 
 
+class OutputBuffer():
+    ''' Stores captured lines of output in memory until they reach max_size
+        characters, then moves them to a temporary file '''
+    def __init__(self, max_size=CAPTURE_MEMORY_LIMIT):
+        self._max_size = max_size
+        self._lines = []
+        self._size = 0
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_type, value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self.lines()
+
+    @staticmethod
+    def from_text(content, max_size=CAPTURE_MEMORY_LIMIT):
+        ''' Returns a buffer containing the lines of given string '''
+        result = OutputBuffer(max_size)
+        lines = content.split('\n')
+        for line in lines[:-1]:
+            result.write(line + '\n')
+        if lines[-1] != '':
+            result.write(lines[-1])
+        return result
+
+    @property
+    def spilled(self):
+        ''' Returns True if this buffer was moved to a temporary file '''
+        return self._file is not None
+
+    def write(self, line):
+        ''' Appends a line to this buffer '''
+        if self._file is not None:
+            self._file.write(line)
+            return
+
+        self._lines.append(line)
+        self._size += len(line)
+        if self._max_size is not None and self._size > self._max_size:
+            # Only split on \n when reading back, as the lines given here
+            # were split the same way
+            self._file = tempfile.TemporaryFile(mode='w+', encoding='utf-8',
+                                                errors='surrogatepass', newline='\n')
+            self._file.writelines(self._lines)
+            self._lines = None
+
+    def lines(self):
+        ''' Iterates over the lines written so far, line endings included '''
+        if self._file is None:
+            return iter(self._lines)
+        self._file.flush()
+        self._file.seek(0)
+        return iter(self._file.readline, '')
+
+    def getvalue(self):
+        ''' Returns the whole content of this buffer as a single string '''
+        return ''.join(self.lines())
+
+    def close(self):
+        ''' Releases the temporary file backing this buffer, if any '''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._lines = []
+        self._size = 0
+
+
+class _OutputBatcher():
+    ''' Groups lines output by a child process to send them to the logging
+        system by blocks '''
+    def __init__(self, pid=None, argv=None, max_lines=256):
+        self._pid = pid
+        self._argv = argv
+        self._max_lines = max_lines
+        self._lines = []
+        self._lock = threading.Lock()
+
+    def add(self, line):
+        ''' Adds a line, logging the current block if it is full '''
+        with self._lock:
+            self._lines.append(line)
+            if len(self._lines) >= self._max_lines:
+                self._flush()
+
+    def flush(self):
+        ''' Logs pending lines '''
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._lines:
+            lines = self._lines
+            self._lines = []
+            nimp.log.log_child_lines(lines, self._pid, self._argv)
+
+
 def _sanitize_command(command):
     new_command = []
     for it in command:
@@ -188,6 +411,13 @@ def _sanitize_command(command):
     return new_command
 
 
+def _is_executable(program, cwd):
+    # Paths are relative to the working directory of the child, like Popen
+    if os.path.dirname(program):
+        return os.access(os.path.join(cwd, program), os.X_OK)
+    return shutil.which(program) is not None
+
+
 if nimp.sys.platform.is_windows():
     _KERNEL32 = ctypes.windll.kernel32 if hasattr(ctypes, 'windll') else None # pylint: disable = invalid-name
     _KERNEL32.MapViewOfFile.restype = ctypes.c_void_p
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Scheduling priority, CPU affinity and resource limits of child processes '''
+
+import contextlib
+import ctypes
+import logging
+import os
+import platform
+import re
+import shutil
+import subprocess
+import threading
+
+import nimp.sys.platform
+
+# I/O scheduling classes, as defined by the Linux ioprio_set system call
+IO_CLASSES = { 'realtime': 1, 'best-effort': 2, 'idle': 3 } # pylint: disable = invalid-name
+
+_SETTINGS = [ 'nice', 'ionice', 'affinity', 'memory_limit', 'cpu_limit' ] # pylint: disable = invalid-name
+
+_IOPRIO_WHO_PROCESS = 1 # pylint: disable = invalid-name
+_IOPRIO_CLASS_SHIFT = 13 # pylint: disable = invalid-name
+_IOPRIO_SET_SYSCALLS = { 'x86_64': 251, 'i386': 289, 'i686': 289, # pylint: disable = invalid-name
+                         'aarch64': 30, 'armv7l': 314, 'ppc64le': 273 }
+
+_SIZE_SUFFIXES = { '': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4 } # pylint: disable = invalid-name
+
+_DEFAULTS = {} # pylint: disable = invalid-name
+_OVERRIDES = threading.local()
+_IO_PRIORITY_SYSCALL = [] # pylint: disable = invalid-name
+_TOOLS = {} # pylint: disable = invalid-name
+
+
+def set_defaults(**settings):
+    ''' Sets scheduling settings applied to all child processes, unless
+        overridden. Accepted settings are:
+
+        - nice: niceness increment, from -20 (highest priority) to 19
+        - ionice: I/O class, optionally followed by a level from 0 to 7, for
+          instance 'idle' or 'best-effort:7' (Linux only)
+        - affinity: CPUs the process can run on, either a list of indices or
+          a string such as '0-3,6'
+        - memory_limit: maximum memory of the process tree, in bytes or as a
+          string such as '8G' (Linux cgroups v2 only)
+        - cpu_limit: maximum number of CPUs used by the process tree, for
+          instance 1.5 (Linux cgroups v2 only) '''
+    _DEFAULTS.clear()
+    _DEFAULTS.update(_normalize(settings))
+
+
+def load_config(env):
+    ''' Reads default settings from the process_nice, process_ionice,
+        process_affinity, process_memory_limit and process_cpu_limit values
+        of .nimp.conf '''
+    settings = { name: getattr(env, 'process_' + name)
+                 for name in _SETTINGS if hasattr(env, 'process_' + name) }
+    try:
+        set_defaults(**settings)
+    except ValueError as ex:
+        logging.error('Invalid child process scheduling configuration: %s', ex)
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def override(**settings):
+    ''' Overrides default settings for processes started by the current thread
+        within this context, e.g. to run a background task at low priority '''
+    settings = _normalize(settings)
+    stack = _get_override_stack()
+    stack.append(settings)
+    try:
+        yield
+    finally:
+        stack.remove(settings)
+
+
+def get_settings(**settings):
+    ''' Returns the settings to apply to a new process: defaults, then thread
+        overrides, then given settings that aren't None '''
+    result = dict(_DEFAULTS)
+    for override_settings in _get_override_stack():
+        result.update(override_settings)
+    result.update(_normalize(settings))
+    return result
+
+
+def get_creation_flags(settings):
+    ''' Returns the Popen creation flags to use on Windows, where priority
+        classes are set when the process is created '''
+    nice = settings.get('nice')
+    if nice is None or not nimp.sys.platform.is_windows():
+        return 0
+    if nice >= 15:
+        return subprocess.IDLE_PRIORITY_CLASS
+    if nice >= 5:
+        return subprocess.BELOW_NORMAL_PRIORITY_CLASS
+    if nice <= -15:
+        return subprocess.HIGH_PRIORITY_CLASS
+    if nice <= -5:
+        return subprocess.ABOVE_NORMAL_PRIORITY_CLASS
+    return 0
+
+
+def get_command_prefix(settings, cgroup=None):
+    ''' Returns the arguments to prepend to a command so that it starts with
+        given scheduling settings. The nice, ionice and taskset tools apply
+        them, then execute the next arguments in the same process, so that
+        neither the command nor its children ever run unconstrained. A shell
+        first moves itself to given cgroup, so that all of the process tree is
+        accounted for and limited. Settings whose tool isn't installed are
+        applied by apply once the process started. '''
+    if nimp.sys.platform.is_windows():
+        return []
+
+    prefix = []
+    if cgroup is not None and _find_tool('sh') is not None:
+        procs_path = os.path.join(cgroup.path, 'cgroup.procs')
+        script = 'echo 0 2>/dev/null >"$0" || echo "nimp: unable to join cgroup $0" >&2; exec "$@"'
+        prefix += [ _find_tool('sh'), '-c', script, procs_path ]
+    if settings.get('nice') is not None and _find_tool('nice') is not None:
+        # Increments are relative to nimp's own niceness
+        prefix += [ _find_tool('nice'), '-n', str(settings['nice']) ]
+    if settings.get('ionice') is not None and _find_tool('ionice') is not None:
+        io_class, level = settings['ionice']
+        prefix += [ _find_tool('ionice'), '-c', str(IO_CLASSES[io_class]) ]
+        if io_class != 'idle':
+            prefix += [ '-n', str(level) ]
+    if settings.get('affinity') is not None and _find_tool('taskset') is not None:
+        prefix += [ _find_tool('taskset'), '-c', ','.join(str(cpu) for cpu in settings['affinity']) ]
+    return prefix
+
+
+def apply(process, settings, cgroup=None):
+    ''' Applies scheduling settings that get_command_prefix couldn't apply
+        before the process started, e.g. on Windows or when tools are missing,
+        to a freshly started process. Settings that can't be applied on this
+        platform are logged and ignored. '''
+    if nimp.sys.platform.is_windows():
+        # Priority classes are set with get_creation_flags
+        if settings.get('affinity') is not None:
+            _try_apply('CPU affinity', _set_win32_affinity, process, settings['affinity'])
+        return
+
+    if cgroup is not None and _find_tool('sh') is None and not cgroup.add_process(process.pid):
+        logging.warning('Unable to move child process to %s', cgroup.path)
+
+    if settings.get('nice') is not None and _find_tool('nice') is None:
+        _try_apply('nice level', _set_nice, process.pid, settings['nice'])
+
+    if settings.get('ionice') is not None and _find_tool('ionice') is None:
+        if nimp.sys.platform.is_linux():
+            _try_apply('I/O priority', _set_io_priority, process.pid, *settings['ionice'])
+        else:
+            logging.debug('I/O priority is only supported on Linux')
+
+    if settings.get('affinity') is not None and _find_tool('taskset') is None:
+        if hasattr(os, 'sched_setaffinity'):
+            _try_apply('CPU affinity', os.sched_setaffinity, process.pid, settings['affinity'])
+        else:
+            logging.debug('CPU affinity is not supported on this platform')
+
+
+def apply_limits(settings, cgroup):
+    ''' Sets the memory and CPU limits of the cgroup a process is about to
+        join. Limits that can't be set are logged as warnings. '''
+    limits = [ (name, controller, setter) for name, controller, setter
+               in [ ('memory_limit', 'memory', 'set_memory_limit'), ('cpu_limit', 'cpu', 'set_cpu_limit') ]
+               if settings.get(name) is not None ]
+    if not limits:
+        return
+    if cgroup is None:
+        logging.warning('Memory and CPU limits need a delegated cgroup set with NIMP_CGROUP, ignoring them')
+        return
+
+    controllers = cgroup.get_controllers()
+    for name, controller, setter in limits:
+        if controller not in controllers:
+            logging.warning('The %s controller is not enabled in the cgroup.subtree_control file of %s, '
+                            'ignoring %s', controller, os.path.dirname(cgroup.path), name.replace('_', ' '))
+        elif not getattr(cgroup, setter)(settings[name]):
+            logging.warning('Unable to set %s of %s', name.replace('_', ' '), cgroup.path)
+
+
+def parse_cpu_list(value):
+    ''' Parses a CPU list such as '0-3,6' into a sorted list of indices '''
+    cpus = set()
+    for item in value.split(','):
+        match = re.fullmatch(r'\s*(\d+)\s*(?:-\s*(\d+)\s*)?', item)
+        if match is None:
+            raise ValueError('Invalid CPU list "%s"' % value)
+        first = int(match.group(1))
+        last = int(match.group(2)) if match.group(2) is not None else first
+        cpus.update(range(first, last + 1))
+    return sorted(cpus)
+
+
+def parse_size(value):
+    ''' Parses a size in bytes, such as 1073741824, '512M' or '8G' '''
+    if isinstance(value, int):
+        return value
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', str(value), re.IGNORECASE)
+    if match is None:
+        raise ValueError('Invalid size "%s"' % value)
+    return int(float(match.group(1)) * _SIZE_SUFFIXES[match.group(2).upper()])
+
+
+def _normalize(settings):
+    result = {}
+    for name, value in settings.items():
+        if name not in _SETTINGS:
+            raise ValueError('Unknown scheduling setting "%s"' % name)
+        if value is None:
+            continue
+        if name == 'nice':
+            value = int(value)
+            if not -20 <= value <= 19:
+                raise ValueError('Nice level should be between -20 and 19')
+        elif name == 'ionice':
+            value = _parse_io_priority(value)
+        elif name == 'affinity':
+            value = parse_cpu_list(value) if isinstance(value, str) else sorted(set(value))
+            if not value:
+                raise ValueError('CPU affinity should contain at least one CPU')
+        elif name == 'memory_limit':
+            value = parse_size(value)
+        elif name == 'cpu_limit':
+            value = float(value)
+            if value <= 0:
+                raise ValueError('CPU limit should be positive')
+        result[name] = value
+    return result
+
+
+def _parse_io_priority(value):
+    if isinstance(value, tuple):
+        io_class, level = value
+    else:
+        io_class, _, level = str(value).partition(':')
+        level = int(level) if level else 4
+    if io_class not in IO_CLASSES:
+        raise ValueError('Unknown I/O class "%s", should be one of %s' % (io_class, ', '.join(IO_CLASSES)))
+    if not 0 <= level <= 7:
+        raise ValueError('I/O priority level should be between 0 and 7')
+    return io_class, level
+
+
+def _get_override_stack():
+    if not hasattr(_OVERRIDES, 'stack'):
+        _OVERRIDES.stack = []
+    return _OVERRIDES.stack
+
+
+def _try_apply(description, function, *args):
+    try:
+        function(*args)
+    except (OSError, ValueError) as ex:
+        logging.warning('Unable to set %s of child process: %s', description, ex)
+
+
+def _find_tool(name):
+    # Returns the path of a tool used to start processes, or None
+    if name not in _TOOLS:
+        _TOOLS[name] = shutil.which(name)
+    return _TOOLS[name]
+
+
+def _set_nice(pid, increment):
+    # Increments are relative to nimp's own niceness, like the nice command
+    niceness = os.getpriority(os.PRIO_PROCESS, 0) + increment
+    os.setpriority(os.PRIO_PROCESS, pid, min(19, max(-20, niceness)))
+
+
+def _get_io_priority_syscall():
+    # Returns the C library and the ioprio_set system call number, or None
+    # when not on Linux or on unknown architectures
+    if not _IO_PRIORITY_SYSCALL:
+        syscall_number = _IOPRIO_SET_SYSCALLS.get(platform.machine()) if nimp.sys.platform.is_linux() else None
+        libc = ctypes.CDLL(None, use_errno=True) if syscall_number is not None else None
+        _IO_PRIORITY_SYSCALL.append((libc, syscall_number) if syscall_number is not None else None)
+    return _IO_PRIORITY_SYSCALL[0]
+
+
+def _set_io_priority(pid, io_class, level):
+    syscall = _get_io_priority_syscall()
+    if syscall is not None:
+        libc, syscall_number = syscall
+        priority = (IO_CLASSES[io_class] << _IOPRIO_CLASS_SHIFT) | level
+        if libc.syscall(syscall_number, _IOPRIO_WHO_PROCESS, pid, priority) == 0:
+            return
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    raise OSError('ionice executable was not found and ioprio_set is unknown on %s' % platform.machine())
+
+
+def _set_win32_affinity(process, cpus):
+    mask = 0
+    for cpu in cpus:
+        mask |= 1 << cpu
+    #pylint: disable=protected-access
+    if not ctypes.windll.kernel32.SetProcessAffinityMask(int(process._handle), ctypes.c_size_t(mask)):
+        raise OSError('SetProcessAffinityMask failed')
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Resource usage accounting for child processes '''
+
+import json
+import logging
+import os
+import os.path
+import threading
+import time
+
+import nimp.sys.cgroup
+import nimp.sys.platform
+
+_SIDECAR_LOCK = threading.Lock() # pylint: disable = invalid-name
+
+
+class ResourceUsage():
+    ''' Measures the CPU time, memory, I/O and wall time consumed by a child
+        process. On Linux, the whole process tree is also measured through a
+        dedicated cgroup when a delegated cgroup is set with NIMP_CGROUP, see
+        nimp.sys.cgroup.get_parent_cgroup. '''
+    def __init__(self, command, cwd):
+        self.command = command
+        self.cwd = os.path.abspath(cwd)
+        self.pid = None
+        self.exit_code = None
+        self.wall_time = None
+        self.process = None
+        self.tree = None
+        self._start_time = time.monotonic()
+        self._cgroup = None
+
+    def create_cgroup(self):
+        ''' Creates the control group the process should join when it starts,
+            if cgroups are enabled, see nimp.sys.scheduling.get_command_prefix '''
+        if nimp.sys.platform.is_linux():
+            self._cgroup = nimp.sys.cgroup.create(os.path.basename(self.command[0]))
+        return self._cgroup
+
+    def attach(self, pid):
+        ''' Starts monitoring given process '''
+        self.pid = pid
+
+    def discard(self):
+        ''' Releases resources when the process couldn't be started '''
+        if self._cgroup is not None:
+            self._cgroup.destroy()
+            self._cgroup = None
+
+    @property
+    def cgroup(self):
+        ''' Returns the control group of the monitored process tree, if any '''
+        return self._cgroup
+
+    def wait(self, process):
+        ''' Waits for the monitored process to end and returns its exit code '''
+        try:
+            rusage = None
+            if hasattr(os, 'wait4'):
+                try:
+                    _, status, rusage = os.wait4(process.pid, 0)
+                    process.returncode = _get_exit_code(status)
+                except ChildProcessError:
+                    # Already reaped, fall back to Popen
+                    pass
+            self.exit_code = process.wait()
+            self.wall_time = time.monotonic() - self._start_time
+
+            if rusage is not None:
+                # ru_maxrss is in kilobytes on Linux, and in bytes on OS X
+                max_rss = rusage.ru_maxrss if nimp.sys.platform.is_osx() else rusage.ru_maxrss * 1024
+                self.process = { 'user_time': rusage.ru_utime,
+                                 'system_time': rusage.ru_stime,
+                                 'max_memory': max_rss,
+                                 'read_blocks': rusage.ru_inblock,
+                                 'written_blocks': rusage.ru_oublock }
+            if self._cgroup is not None:
+                self.tree = self._cgroup.get_stats()
+        finally:
+            if self._cgroup is not None:
+                self._cgroup.destroy()
+                self._cgroup = None
+
+        return self.exit_code
+
+    def log(self):
+        ''' Logs collected resource usage '''
+        if self.process is not None:
+            logging.info('Resource usage: %.2fs user, %.2fs system, %.2fs wall time, '
+                         '%s peak memory, %d blocks read, %d blocks written',
+                         self.process['user_time'], self.process['system_time'], self.wall_time,
+                         _format_size(self.process['max_memory']),
+                         self.process['read_blocks'], self.process['written_blocks'])
+        elif self.wall_time is not None:
+            logging.info('Resource usage: %.2fs wall time', self.wall_time)
+
+        if self.tree:
+            details = []
+            if 'user_time' in self.tree:
+                details.append('%.2fs user, %.2fs system' % (self.tree['user_time'], self.tree['system_time']))
+            if 'max_memory' in self.tree:
+                details.append('%s peak memory' % _format_size(self.tree['max_memory']))
+            if 'read_bytes' in self.tree:
+                details.append('%s read, %s written' % (_format_size(self.tree['read_bytes']),
+                                                        _format_size(self.tree['written_bytes'])))
+            logging.info('Process tree resource usage: %s', ', '.join(details))
+
+    def to_dict(self):
+        ''' Returns collected resource usage as a JSON serializable dict '''
+        return { 'command': self.command,
+                 'cwd': self.cwd,
+                 'pid': self.pid,
+                 'exit_code': self.exit_code,
+                 'end_time': time.time(),
+                 'wall_time': self.wall_time,
+                 'process': self.process,
+                 'tree': self.tree }
+
+    def save(self):
+        ''' Appends collected resource usage to the JSON lines file set in the
+            NIMP_RESOURCE_USAGE_FILE environment variable, if any '''
+        sidecar_path = os.environ.get('NIMP_RESOURCE_USAGE_FILE')
+        if not sidecar_path:
+            return
+        line = json.dumps(self.to_dict()) + '\n'
+        with _SIDECAR_LOCK:
+            try:
+                with open(sidecar_path, 'a') as sidecar:
+                    sidecar.write(line)
+            except OSError as ex:
+                logging.warning('Unable to write resource usage to %s: %s', sidecar_path, ex)
+
+
+def _get_exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _format_size(size):
+    return '%.1f MiB' % (size / (1024 * 1024))
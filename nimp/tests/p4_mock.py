@@ -0,0 +1,815 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Perforce mocks for unit tests '''
+
+import argparse
+import contextlib
+import hashlib
+import io
+import marshal
+import os
+import types
+
+import nimp.sys.process
+import nimp.tests.utils
+import nimp.utils.p4_backend
+
+class _MockChangelist:
+    def __init__(self, number, description):
+        self.files = {}
+        self.number = number
+        self.description = description
+        self.status = 'pending'
+
+class P4Mock(nimp.tests.utils.MockCommand):
+    ''' Mocks p4 command '''
+
+    def __init__(self):
+        super(P4Mock, self).__init__('p4')
+        # Filename -> (action, head_action) dictionary)
+        self._changelists = {}
+        self._files = {}
+        self._current_changelist = 0
+        # Arguments and input of the commands run so far
+        self.commands = []
+        self.inputs = []
+        # Workspace reported by p4 info, and its view mappings
+        self.client_name = 'test_client'
+        self.client_view = [ '//test_client/... //test_client/...' ]
+        self._parser = argparse.ArgumentParser(prog = 'p4')
+        self._init_args(self._parser)
+
+    def add_changelist(self, description, *files_content):
+        ''' Adds a fake changelist to this p4 mock '''
+        if not self._changelists:
+            cl_number = '400'
+        else:
+            cl_number = str(int(max(self._changelists.keys(), key=int)) + 1)
+        changelist = _MockChangelist(cl_number, description)
+        changelist.status = 'submitted'
+        self._changelists[cl_number] = changelist
+        for filename, file_content in files_content:
+            if filename not in self._files:
+                self._files[filename] = []
+            revisions = self._files[filename]
+            new_rev = len(revisions)
+            revisions.append(file_content)
+            changelist.files[filename] = (new_rev, None)
+        return cl_number
+
+    def get_result(self, command, stdin=None):
+        self.commands.append(command)
+        self.inputs.append(stdin)
+        args = self._parser.parse_args(command)
+
+        if args.x not in ['-', None]:
+            assert False, 'Wrong -x parameter format'
+
+        should_have_stdin = args.x == '-'
+        should_have_stdin = should_have_stdin or (hasattr(args, 'i') and args.i)
+
+        if should_have_stdin and stdin is None:
+            assert False, '-x or -i flag provided but no stdin'
+        elif not should_have_stdin and stdin is not None:
+            assert False, 'stdin provided but no -x or -i flag'
+        result = args.command_to_run(args, stdin)
+        if args.G and not isinstance(result[1], bytes):
+            return (result[0], P4Mock._get_marshal_output(*result), '')
+        return result
+
+    @staticmethod
+    def _get_marshal_output(result, output, error):
+        ''' Converts tagged output and errors to what p4 -G would output '''
+        # Messages of failed commands are errors, others warnings
+        severity = 3 if result != 0 else 2
+        records = []
+        record = {}
+        for line in output.split('\n') + ['']:
+            if line.startswith('... '):
+                key, _, value = line[4:].partition(' ')
+                record[key.encode()] = value.encode()
+            elif record:
+                record[b'code'] = b'stat'
+                records.append(record)
+                record = {}
+            elif line.strip():
+                records.append({b'code': b'info', b'data': line.encode(), b'level': 0})
+        for line in error.split('\n'):
+            if line.strip():
+                records.append({b'code': b'error', b'data': (line + '\n').encode(),
+                                b'severity': severity, b'generic': 17})
+
+        result = io.BytesIO()
+        for it in records:
+            marshal.dump(it, result, 0)
+        return result.getvalue()
+
+    def _init_args(self, parser):
+        for flag in ['-z', '-c', '-H', '-p', '-P', '-u', '-x']:
+            parser.add_argument(flag)
+        parser.add_argument('-G', action = 'store_true')
+
+        subparsers  = parser.add_subparsers(title='Commands')
+        self._init_infos(subparsers)
+        P4Mock._init_user(subparsers)
+        self._init_add(subparsers)
+        self._init_change(subparsers)
+        self._init_client(subparsers)
+        self._init_changes(subparsers)
+        self._init_delete(subparsers)
+        self._init_describe(subparsers)
+        self._init_edit(subparsers)
+        self._init_files(subparsers)
+        self._init_fstat(subparsers)
+        self._init_print(subparsers)
+        self._init_reconcile(subparsers)
+        self._init_revert(subparsers)
+        self._init_submit(subparsers)
+        self._init_sync(subparsers)
+        self._init_where(subparsers)
+
+    def _get_file_status(self, filename):
+        for _, change in reversed(sorted(self._changelists.items())):
+            for name_it, (rev, local_status) in change.files.items():
+                if name_it == filename:
+                    head_revision = None
+                    head_status = None
+                    if name_it in self._files:
+                        head_revision = self._files[name_it][rev]
+                        head_status = 'delete' if head_revision is None else 'add'
+                    return rev, head_status, local_status
+
+        return 0, None, None
+
+    def _init_add(self, subparsers):
+        def _add_command(args, stdin):
+            # TODO : Add ouput
+            if args.changelist not in self._changelists:
+                return (1, '', 'Changelist %s doesn\'t exists' % args.changelist)
+
+            changelist = self._changelists[args.changelist]
+
+            if changelist.status != 'pending':
+                return (1, '', 'Change %s is already committed.' % args.changelist)
+
+            files = list(args.files)
+            if stdin is not None:
+                files += [ it for it in stdin.split('\n') if it ]
+            for it in files:
+                rev, _, _ = self._get_file_status(it)
+                changelist.files[it] = (rev, 'add')
+            return (0, '', '')
+
+        parser = subparsers.add_parser('add')
+        parser.add_argument('-c', '--changelist', default = 'default')
+        parser.add_argument('-f', action = 'store_true')
+        parser.add_argument('files', nargs='*')
+        parser.set_defaults(command_to_run = _add_command)
+
+    def _init_change(self, subparsers):
+        #pylint: disable=inconsistent-return-statements
+        def _change_command(args, stdin):
+            if hasattr(args, 'd') and args.d is not None:
+                if args.d not in self._changelists:
+                    return (1, '', 'Change %s unknown.' % args.d)
+                change = self._changelists[args.d]
+                if change.files:
+                    error = 'Change %s has %i open file(s) associated with it and can\'t be deleted.'
+                    error = error % (change.number, len(change.files))
+                    return (1, '', error)
+                del self._changelists[args.d]
+                return (0, 'Change %s deleted.' % args.d, '')
+            if args.i:
+                # TODO : Add better checks on C.L specification
+                desc_lines = None
+                for line in stdin.split('\n'):
+                    if desc_lines is not None:
+                        desc_lines.append(line.strip())
+                    elif line.startswith('Description'):
+                        desc_lines = []
+
+                description = '\n'.join(desc_lines)
+                if not self._changelists:
+                    cl_number = '400'
+                else:
+                    cl_number = str(int(max(self._changelists.keys(), key=int)) + 1)
+                self._changelists[cl_number] = _MockChangelist(cl_number, description)
+                return (0, 'Change %s created.' % cl_number, '')
+            assert False, 'Not supported by mock'
+
+        parser = subparsers.add_parser('change')
+        parser.add_argument('-d')
+        parser.add_argument('-i', action = 'store_true')
+        parser.set_defaults(command_to_run = _change_command)
+
+    def _init_client(self, subparsers):
+        def _client_command(args, _):
+            assert args.o, 'Not supported by mock'
+            stdout = ('... Client test_client\n'
+                      '... Root /p4\n')
+            for index, mapping in enumerate(self.client_view):
+                stdout += '... View%d %s\n' % (index, mapping)
+            return (0, stdout, '')
+
+        parser = subparsers.add_parser('client')
+        parser.add_argument('-o', action = 'store_true')
+        parser.set_defaults(command_to_run = _client_command)
+
+    def _init_changes(self, subparsers):
+        def _changes_command(args, _):
+            output = []
+            change_id = 0
+            for _, changelist in reversed(sorted(self._changelists.items())):
+                if args.status is None or args.status.strip() == changelist.status:
+                    template = ('... change %s\n'
+                                '... time 1464522677\n'
+                                '... user test_user\n'
+                                '... client test_client\n'
+                                '... status %s\n'
+                                '... changeType public\n'
+                                '... desc %s\n\n')
+                    output.append(template % (changelist.number, changelist.status, changelist.description))
+                if int(args.m) > 0 and change_id >= int(args.m):
+                    break
+                change_id += 1
+            return (0, '\n\n'.join(output), '')
+
+        parser = subparsers.add_parser('changes')
+        parser.add_argument('-c', '--changes_client')
+        parser.add_argument('-l', action = 'store_true')
+        parser.add_argument('-m', default = 0)
+        parser.add_argument('-s', '--status', choices = ['pending', 'submitted', 'shelved'])
+        parser.add_argument('paths', nargs='*')
+        parser.set_defaults(command_to_run = _changes_command)
+
+    def _init_delete(self, subparsers):
+        def _delete_command(args, stdin):
+            if args.changelist not in self._changelists:
+                return (1, '', 'Changelist %s doesn\'t exists' % args.changelist)
+
+            changelist = self._changelists[args.changelist]
+
+            if changelist.status != 'pending':
+                return (1, '', 'Change %s is already committed.' % args.changelist)
+
+            files = []
+            if args.files is not None:
+                files += args.files
+            if stdin is not None:
+                files += [ it for it in stdin.split('\n') if it ]
+            for it in files:
+                rev, _, _ = self._get_file_status(it)
+                changelist.files[it] = (rev, 'delete')
+                os.remove(it)
+            return (0, '', '')
+
+        parser = subparsers.add_parser('delete')
+        parser.add_argument('-c', '--changelist', default = 'default')
+        parser.add_argument('files', nargs='*')
+        parser.set_defaults(command_to_run = _delete_command)
+
+    def _init_describe(self, subparsers):
+        def _describe_command(args, _):
+            output = ''
+            for cl_number in args.changelists:
+                if cl_number not in self._changelists:
+                    return (1, '', '%s - no such changelist.' % cl_number)
+                changelist = self._changelists[cl_number]
+                output += ('... change %s\n'
+                           '... user test_user\n'
+                           '... client test_client\n'
+                           '... time 1464647491\n'
+                           '... desc %s\n'
+                           '... status %s\n'
+                           '... changeType public\n') % (cl_number, changelist.description, changelist.status)
+                file_id = 0
+                for filename, (rev, local_action) in changelist.files.items():
+                    rel_path = os.path.relpath(filename, '/p4')
+                    output += '... depotFile%i //test_client/%s\n' % (file_id, rel_path)
+                    output += '... action%i %s\n' % (file_id, local_action)
+                    output += '... type%i binary\n' % file_id
+                    output += '... rev%i %i\n' % (file_id, rev)
+                    file_id += 1
+                output += '\n'
+            return (0, output, '')
+
+        parser = subparsers.add_parser('describe')
+        parser.add_argument('-s', action = 'store_true')
+        parser.add_argument('changelists', nargs = '+')
+        parser.set_defaults(command_to_run = _describe_command)
+
+    def _init_edit(self, subparsers):
+        def _edit_command(args, stdin):
+            if args.changelist not in self._changelists:
+                return (1, '', 'Changelist %s doesn\'t exists' % args.changelist)
+            changelist = self._changelists[args.changelist]
+
+            if changelist.status != 'pending':
+                return (1, '', 'Change %s is already committed.' % args.changelist)
+
+            files = list(args.files)
+            if stdin is not None:
+                files += stdin.split('\n')
+            stderr = []
+            stdout = []
+            result = 0
+            for it in files:
+                rev, head_status, _ = self._get_file_status(it)
+
+                if head_status != 'add' or not os.path.exists(it):
+                    stderr.append('%s - file(s) not on client.' % it)
+                    continue
+
+                changelist.files[it] = (rev, 'edit')
+                rel_path = os.path.relpath(it, '/p4')
+                stdout.append('//test_client/%s - opened for edit' % rel_path)
+
+            result = 1 if stderr else 0
+            return (result, '\n'.join(stdout), '\n'.join(stderr))
+
+        parser = subparsers.add_parser('edit')
+        parser.add_argument('-c', '--changelist', default = 'default')
+        parser.add_argument('files', nargs='*')
+        parser.set_defaults(command_to_run = _edit_command)
+
+    def _init_files(self, subparsers):
+        def _files_command(args, _):
+            output = []
+            for depot_file, (filename, rev, cl_number) in sorted(self._get_depot_revisions(args.file_range).items()):
+                output.append('... depotFile %s\n... rev %d\n... change %s\n... action %s\n'
+                              % (depot_file, rev + 1, cl_number, self._get_revision_action(filename, rev)))
+            return (0, '\n'.join(output), '')
+
+        parser = subparsers.add_parser('files')
+        parser.add_argument('file_range')
+        parser.set_defaults(command_to_run = _files_command)
+
+    def _get_depot_revisions(self, file_spec):
+        # Returns depot file -> (local file, revision index, changelist) of
+        # last revisions of files matching <path>@<last> or
+        # <path>@<first>,@<last>, path being a file or ending with ...
+        path, _, revisions = file_spec.partition('@')
+        revisions = [ int(it.lstrip('@')) for it in revisions.split(',') ]
+        first, last = revisions if len(revisions) == 2 else (0, revisions[0])
+        prefix = path[:-len('...')] if path.endswith('...') else None
+        result = {}
+        for cl_number, changelist in sorted(self._changelists.items()):
+            if changelist.status != 'submitted' or not first <= int(cl_number) <= last:
+                continue
+            for filename, (rev, _) in changelist.files.items():
+                depot_file = '//test_client/%s' % os.path.relpath(filename, '/p4')
+                if depot_file == path or (prefix is not None and depot_file.startswith(prefix)):
+                    result[depot_file] = (filename, rev, cl_number)
+        return result
+
+    def _get_revision_action(self, filename, rev):
+        if self._files[filename][rev] is None:
+            return 'delete'
+        return 'add' if rev == 0 else 'edit'
+
+    def _init_fstat(self, subparsers):
+        def _get_file_fstat(filename):
+            stdout = ''
+            stderr = ''
+            if filename.startswith('//test_client/'):
+                filename = '/p4/' + filename[len('//test_client/'):]
+            if not filename.startswith('/p4'):
+                filename = os.path.join('/p4', filename)
+            if filename.endswith('/...'):
+                dirname = filename[:-4]
+                for root, _, filenames in os.walk(dirname):
+                    for child in sorted(filenames):
+                        child_file = os.path.join(root, child)
+                        child_file = os.path.relpath(child_file, '/p4')
+                        file_stdout, file_stderr = _get_file_fstat(child_file)
+                        stdout += file_stdout
+                        stderr += file_stderr
+            else:
+                if not filename.startswith('/p4') :
+                    return '', '%s - file(s) not in client view\n\n' % filename
+
+                rev, head_status, local_status = self._get_file_status(filename)
+
+                if head_status is None and local_status is None:
+                    return '', '%s - no such file(s).\n\n' % filename
+
+                stdout = ('... depotFile //test_client/%s\n'
+                          '... clientFile %s\n'
+                          '... isMapped\n'
+                          '... headType text\n'
+                          '... headTime 1462880462\n'
+                          '... headRev %s\n'
+                          '... headChange 408051\n'
+                          '... headModTime 1454408928\n'
+                          '... haveRev %s\n')
+                stdout = stdout % (os.path.relpath(filename, '/p4'),
+                                   filename,
+                                   rev,
+                                   rev)
+                if head_status is not None:
+                    stdout += '... headAction %s\n' % head_status
+                if local_status is not None:
+                    stdout += '... action %s\n' % local_status
+                stdout += '\n'
+            return stdout, stderr
+
+        def _fstat_command(args, stdin):
+            stdout = ''
+            stderr = ''
+            files = []
+
+            if args.O == 'l':
+                # Only supports depot revisions
+                for file_spec in args.files:
+                    for depot_file, (filename, rev, _) in sorted(self._get_depot_revisions(file_spec).items()):
+                        content = (self._files[filename][rev] or '').encode()
+                        stdout += ('... depotFile %s\n... headAction %s\n... headRev %d\n'
+                                   '... digest %s\n... fileSize %d\n\n'
+                                   % (depot_file, self._get_revision_action(filename, rev), rev + 1,
+                                      hashlib.md5(content).hexdigest().upper(), len(content)))
+                return (0, stdout, stderr)
+
+            if args.e is not None:
+                files = [filename for filename, _ in self._changelists[args.e].files.items()]
+            else:
+                if args.files is not None:
+                    files += args.files
+                if stdin is not None:
+                    files += stdin.split('\n')
+
+            for it in files:
+                file_stdout, file_stderr = _get_file_fstat(it)
+                stdout += file_stdout
+                stderr += file_stderr
+            return (0, stdout, stderr)
+
+        parser = subparsers.add_parser('fstat')
+        parser.add_argument('-O')
+        parser.add_argument('-e')
+        parser.add_argument('-T')
+        parser.add_argument('files', nargs='*')
+        parser.set_defaults(command_to_run = _fstat_command)
+
+    def _init_infos(self, subparsers):
+        def _infos_command(*_):
+            return (0,
+                    ('... userName test_user\n'
+                     '... clientName %s\n'
+                     '... clientRoot /p4root\n'
+                     '... clientCwd /p4root\n'
+                     '... clientHost test_host\n'
+                     '... serverAddress test_server:1666\n' % self.client_name),
+                    '')
+        parser = subparsers.add_parser('info')
+        parser.set_defaults(command_to_run = _infos_command)
+
+    def _init_print(self, subparsers):
+        def _print_command(args, stdin):
+            # Only supports p4 -G print of depot file revisions, outputs
+            # contents in two chunks
+            assert args.G
+            records = []
+            for file_spec in list(args.files) + (stdin.split('\n') if stdin is not None else []):
+                depot_file, _, rev = file_spec.partition('#')
+                filename = '/p4/' + depot_file[len('//test_client/'):]
+                if filename not in self._files or not 0 < int(rev) <= len(self._files[filename]):
+                    records.append({ b'code': b'error', b'data': b'%s - no such file(s).\n' % file_spec.encode(),
+                                     b'severity': 2, b'generic': 17 })
+                    continue
+                content = (self._files[filename][int(rev) - 1] or '').encode()
+                records.append({ b'code': b'stat', b'depotFile': depot_file.encode(), b'rev': rev.encode(),
+                                 b'type': b'text' })
+                records.append({ b'code': b'text', b'data': content[:len(content) // 2] })
+                records.append({ b'code': b'text', b'data': content[len(content) // 2:] })
+            return (0, b''.join(marshal.dumps(it, 0) for it in records), '')
+
+        parser = subparsers.add_parser('print')
+        parser.add_argument('files', nargs='*')
+        parser.set_defaults(command_to_run = _print_command)
+
+    def _init_reconcile(self, subparsers):
+        def _reconcile_command(args, stdin):
+            assert args.c in self._changelists
+            changelist = self._changelists[args.c]
+            paths_to_reconcile = list(args.files)
+            if stdin is not None:
+                paths_to_reconcile += stdin.split('\n')
+            files_to_reconcile = set()
+
+            for filename, _ in self._files.items():
+                for path in paths_to_reconcile:
+                    if path.startswith(filename):
+                        files_to_reconcile.add(filename)
+
+            for path in paths_to_reconcile:
+                if path.endswith('/...'):
+                    directory = path[:-4]
+                    for root, _, filenames in os.walk(directory):
+                        for child in filenames:
+                            child_file = os.path.join(root, child)
+                            files_to_reconcile.add(child_file)
+                else:
+                    files_to_reconcile.add(path)
+
+            for file_it in files_to_reconcile:
+                rev, head_action, action = self._get_file_status(file_it)
+                if head_action != 'delete' and action != 'delete' and not os.path.exists(file_it):
+                    changelist.files[file_it] = (rev, 'delete')
+                    continue
+
+                if not os.path.exists(file_it):
+                    continue
+
+                if head_action is None and action is None:
+                    changelist.files[file_it] = (rev, 'add')
+                    continue
+
+                with open(file_it, 'r') as file:
+                    file_content = file.read()
+
+                if file_content != self._files[file_it][rev]:
+                    changelist.files[file_it] = (rev, 'edit')
+
+            return (0, '', '')
+
+        parser = subparsers.add_parser('reconcile')
+        parser.add_argument('-c')
+        parser.add_argument('-a', action = 'store_true')
+        parser.add_argument('-f', action = 'store_true')
+        parser.add_argument('files', nargs='*')
+        parser.set_defaults(command_to_run = _reconcile_command)
+
+    def _init_revert(self, subparsers):
+        def _revert(path, args):
+            ''' Reverts given path '''
+            if path == '//...':
+                for cl_number, changelist in self._changelists.items():
+                    if args.changelist is not None and cl_number != args.changelist:
+                        continue
+                    if changelist.status == 'pending':
+                        for cl_file, _ in list(changelist.files.items()):
+                            _revert(cl_file, args)
+                        assert not changelist.files
+            else:
+                for cl_number, changelist in self._changelists.items():
+                    if args.changelist is not None and cl_number != args.changelist:
+                        continue
+                    if changelist.status == 'pending' and path in changelist.files:
+                        del changelist.files[path]
+                    rev, _, _ = self._get_file_status(path)
+                    head_content = None
+                    if path in self._files:
+                        revisions = self._files[path]
+                        if len(revisions) > rev and revisions[rev] is not None:
+                            head_content = revisions[rev]
+
+                    if args.a:
+                        with open(path, 'r') as file_content:
+                            if head_content is None or file_content.read() != head_content:
+                                continue
+
+                    if head_content is None:
+                        os.remove(path)
+                    else:
+                        with open(path, 'w') as file_content:
+                            file_content.write(head_content)
+
+        def _revert_command(args, stdin):
+            paths = []
+            if args.paths is not None:
+                paths += args.paths
+            if stdin is not None:
+                paths += stdin.split('\n')
+            for path in paths:
+                _revert(path, args)
+            return (0, '', '')
+
+        parser = subparsers.add_parser('revert')
+        parser.add_argument('-c', '--changelist', default = None)
+        parser.add_argument('-a', action = 'store_true')
+        parser.add_argument('paths', nargs='*')
+        parser.set_defaults(command_to_run = _revert_command)
+
+    def _init_submit(self, subparsers):
+        def _submit_command(args, _):
+            if args.c is not None:
+                assert args.c in self._changelists
+                changelist = self._changelists[args.c]
+                if not changelist.files:
+                    return (0, '', 'No files to submit.')
+                for filename, (_, action) in changelist.files.items():
+                    if action != 'delete':
+                        with open(filename, 'r') as content_file:
+                            content = content_file.read()
+                    else:
+                        content = None
+                    if filename not in self._files:
+                        self._files[filename] = []
+                    revisions = self._files[filename]
+                    rev_id = len(revisions)
+                    revisions.append(content)
+                    changelist.files[filename] = (rev_id, None)
+                    changelist.status = 'submitted'
+                return (0, '', '')
+            return (1, '', '')
+
+        parser = subparsers.add_parser('submit')
+        parser.add_argument('-c')
+        parser.add_argument('-f')
+        parser.set_defaults(command_to_run = _submit_command)
+
+    def _init_sync(self, subparsers):
+        def _sync_range(file_range, output):
+            filename = None
+            revision = None
+            if file_range is not None:
+                if '@' in file_range:
+                    filename, revision = tuple(file_range.split('@'))
+                elif file_range.startswith('/'):
+                    filename = file_range
+                else:
+                    revision = file_range
+            synced_files = set()
+            for cl_number, change in reversed(sorted(self._changelists.items())):
+                if revision is None or int(cl_number) <= int(revision):
+                    for name_it, (rev, _) in change.files.items():
+                        if filename is not None and filename != '' and name_it != filename:
+                            continue
+
+                        if name_it in synced_files:
+                            continue
+
+                        if name_it not in self._files:
+                            continue
+
+
+                        head_revision = self._files[name_it][rev]
+
+                        if head_revision is None and os.path.exists(name_it):
+                            os.remove(name_it)
+                            output.append('... clientFile %s\n... rev %s\n... action deleted\n' % (name_it, rev))
+
+                        elif head_revision is not None:
+                            dirname = os.path.dirname(name_it)
+                            nimp.system.safe_makedirs(dirname)
+                            with open(name_it, 'w') as file_content:
+                                file_content.write(head_revision)
+                            output.append('... clientFile %s\n... rev %s\n... action updated\n' % (name_it, rev))
+                        synced_files.add(name_it)
+            if revision is None:
+                revision = str(int(max(self._changelists.keys(), key=int)))
+            self._current_changelist = revision
+
+        def _sync_command(args, stdin):
+            output = []
+            file_ranges = list(args.file_ranges)
+            if stdin is not None:
+                file_ranges += stdin.split('\n')
+            for file_range in file_ranges or [ None ]:
+                _sync_range(file_range, output)
+            return (0, '\n'.join(output), '')
+
+        parser = subparsers.add_parser('sync')
+        parser.add_argument('-f')
+        parser.add_argument('--parallel')
+        parser.add_argument('file_ranges', nargs='*')
+        parser.set_defaults(command_to_run = _sync_command)
+
+    @staticmethod
+    def _init_user(subparsers):
+        #pylint: disable=inconsistent-return-statements
+        def _user_command(args, _):
+            if args.o:
+                return (0,
+                        ('... User test_user\n'
+                         '... Email test@test.test\n'
+                         '... Update 2013/06/12 15:33:16\n'
+                         '... Access 2016/05/31 00:09:46\n'
+                         '... FullName Test User\n'
+                         '... Password ******\n'
+                         '... Type standard\n'),
+                        '')
+            assert False, 'Not supported by mock'
+
+        parser = subparsers.add_parser('user')
+        parser.add_argument('-o', action ='store_true')
+        parser.set_defaults(command_to_run = _user_command)
+
+    @staticmethod
+    def _init_where(subparsers):
+        def _where_command(args, stdin):
+            files = list(args.files)
+            if stdin is not None:
+                files += stdin.split('\n')
+            stdout = []
+            stderr = []
+            for it in files:
+                if not it.startswith('//test_client/'):
+                    stderr.append('%s - file(s) not in client view.' % it)
+                    continue
+                rel_path = it[len('//test_client/'):]
+                stdout.append('... depotFile %s\n'
+                              '... clientFile //test_client/%s\n'
+                              '... path /p4/%s\n' % (it, rel_path, rel_path))
+            return (0, '\n'.join(stdout), '\n'.join(stderr))
+
+        parser = subparsers.add_parser('where')
+        parser.add_argument('files', nargs='*')
+        parser.set_defaults(command_to_run = _where_command)
+
+@contextlib.contextmanager
+def mock_p4():
+    ''' Returns a p4 mock '''
+    with nimp.tests.utils.mock_filesystem():
+        p4_mock = P4Mock()
+        with nimp.tests.utils.mock_capture_process_output(p4_mock):
+            yield p4_mock
+
+class P4PythonException(Exception):
+    ''' Mocks P4Python's P4Exception '''
+
+class P4PythonMock():
+    ''' Mocks P4Python's P4 class, running commands with the p4 mock '''
+    connections = 0
+
+    def __init__(self):
+        self.port = None
+        self.user = None
+        self.password = None
+        self.client = None
+        self.exception_level = 2
+        self.input = None
+        self.errors = []
+        self.warnings = []
+        self._connected = False
+
+    def connect(self):
+        ''' Opens the connection '''
+        P4PythonMock.connections += 1
+        self._connected = True
+
+    def connected(self):
+        ''' Tells if the connection is open '''
+        return self._connected
+
+    def run(self, *args):
+        ''' Returns command results as P4Python does, dictionaries for
+            records and strings for messages '''
+        assert self._connected
+        command = [ 'p4', '-G' ]
+        for flag, value in [ ('-p', self.port), ('-u', self.user), ('-P', self.password), ('-c', self.client) ]:
+            if value is not None:
+                command += [ flag, value ]
+        stdin, self.input = self.input, None
+        _, output, _ = nimp.sys.process.call(command + list(args), stdin = stdin,
+                                             capture_output = True, capture_binary = True)
+
+        results = []
+        self.errors = []
+        self.warnings = []
+        for record in nimp.utils.p4_backend.read_marshal_records(io.BytesIO(output)):
+            if record['code'] == 'error':
+                messages = self.errors if record['severity'] >= 3 else self.warnings
+                messages.append(record['data'])
+            elif record['code'] in [ 'info', 'text' ]:
+                results.append(record['data'])
+            elif record['code'] == 'binary':
+                results.append(record['data'].encode('utf-8', 'surrogateescape'))
+            else:
+                # Indexed fields are returned as lists
+                del record['code']
+                result = {}
+                for key, value in record.items():
+                    name = key.rstrip('0123456789')
+                    if name != key:
+                        result.setdefault(name, []).append(value)
+                    else:
+                        result[key] = value
+                results.append(result)
+        if self.errors and self.exception_level >= 2:
+            raise P4PythonException(self.errors[0])
+        return results
+
+P4PYTHON_MODULE = types.ModuleType('P4') # pylint: disable = invalid-name
+P4PYTHON_MODULE.P4 = P4PythonMock
+P4PYTHON_MODULE.P4Exception = P4PythonException
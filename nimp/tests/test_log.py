@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Logging helpers unit tests '''
+
+import gzip
+import json
+import logging
+import os
+import os.path
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import zlib
+
+import nimp.log
+import nimp.sys.process
+
+class _CompressedLogWriterTests(unittest.TestCase):
+
+    def test_rotation(self):
+        ''' Logs should rotate by size and index their flush points '''
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cook.log')
+            lines = ['line %d %s\n' % (i, os.urandom(8).hex()) for i in range(2000)]
+            with nimp.log.CompressedLogWriter(path, 'gzip', max_size=4096, flush_interval=0) as writer:
+                for i, line in enumerate(lines):
+                    writer.write(line)
+                    if i % 100 == 0:
+                        time.sleep(0.01)
+
+            parts = [path + '.gz']
+            while os.path.exists(path + '.%d.gz' % len(parts)):
+                parts.append(path + '.%d.gz' % len(parts))
+            self.assertGreater(len(parts), 1)
+            content = ''
+            for part in parts:
+                with gzip.open(part, 'rt') as part_file:
+                    part_content = part_file.read()
+                with open(part + '.idx') as index_file:
+                    index = [json.loads(entry) for entry in index_file]
+                self.assertEqual(index[0]['line'], content.count('\n'))
+
+                # Decompression can start from any flush point
+                with open(part, 'rb') as part_file:
+                    data = part_file.read()
+                for entry in index[1:]:
+                    tail = zlib.decompressobj(-zlib.MAX_WBITS).decompress(data[entry['compressed_offset']:])
+                    self.assertEqual(tail.decode('utf-8'), part_content[entry['offset']:])
+                content += part_content
+            self.assertEqual(content, ''.join(lines))
+
+    def test_call(self):
+        ''' call should tee child output to NIMP_COMMAND_LOG_DIR '''
+        with tempfile.TemporaryDirectory() as directory:
+            command = [sys.executable, '-c', 'for i in range(100): print(i)']
+            with unittest.mock.patch.dict(os.environ, {'NIMP_COMMAND_LOG_DIR': directory}):
+                self.assertEqual(nimp.sys.process.call(command), 0)
+            log_files = [name for name in os.listdir(directory) if not name.endswith('.idx')]
+            self.assertEqual(len(log_files), 1)
+            if log_files[0].endswith('.gz'):
+                with gzip.open(os.path.join(directory, log_files[0]), 'rt') as log_file:
+                    self.assertEqual(log_file.read().split(), [str(i) for i in range(100)])
+
+class _RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.batches = 0
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+    def emit_lines(self, lines, source=None): # pylint: disable = unused-argument
+        self.batches += 1
+        self.messages.extend(lines)
+
+class _LogQueueTests(unittest.TestCase):
+
+    def test_queue(self):
+        ''' Queued records and lines should be handled in order '''
+        logger = logging.getLogger('nimp.tests.log_queue')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        handler = _RecordingHandler()
+        logger.addHandler(handler)
+
+        log_queue = nimp.log.LogQueue(16)
+        log_queue.attach(logger)
+        log_queue.start()
+        try:
+            message = ['mutable']
+            logger.info('record %s', message)
+            message.append('changed')
+            queue_handler = logger.handlers[0]
+            for i in range(100):
+                queue_handler.emit_lines(['line %d' % i])
+            logger.warning('done')
+            log_queue.flush()
+            self.assertEqual(len(handler.messages), 102)
+        finally:
+            log_queue.stop()
+            logger.removeHandler(handler)
+
+        self.assertListEqual(handler.messages,
+                             ["record ['mutable']"] + ['line %d' % i for i in range(100)] + ['done'])
+        self.assertListEqual(logger.handlers, [])
+
+    def test_drop(self):
+        ''' Lines dropped by concurrent threads should all be reported '''
+        logger = logging.getLogger('nimp.tests.log_queue_drop')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        handler = _RecordingHandler()
+        release = threading.Event()
+        def _emit_lines(lines, source = None): # pylint: disable = unused-argument
+            # Keeps the queue full until all threads are done
+            release.wait()
+            handler.messages.extend(lines)
+        handler.emit_lines = _emit_lines
+        logger.addHandler(handler)
+
+        log_queue = nimp.log.LogQueue(2, drop = True)
+        log_queue.attach(logger)
+        log_queue.start()
+        try:
+            queue_handler = logger.handlers[0]
+            def _emit():
+                for i in range(200):
+                    queue_handler.emit_lines(['line %d' % i])
+            threads = [ threading.Thread(target = _emit) for _ in range(4) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            release.set()
+        finally:
+            log_queue.stop()
+            logger.removeHandler(handler)
+
+        lines = [ message for message in handler.messages if message.startswith('line ') ]
+        dropped = [ int(message.split()[0]) for message in handler.messages if 'dropped' in message ]
+        self.assertEqual(len(lines) + sum(dropped), 800)
+
+class _JsonFormatterTests(unittest.TestCase):
+
+    def test_format(self):
+        ''' Records and child lines should be formatted as JSON objects '''
+        formatter = nimp.log.JsonFormatter()
+        with nimp.log.phase('cook'):
+            record = logging.makeLogRecord({ 'msg': 'hello %s', 'args': ('world',),
+                                             'levelname': 'WARNING', 'created': 12.5 })
+            self.assertDictEqual(json.loads(formatter.format(record)),
+                                 { 'time': 12.5, 'level': 'WARNING', 'source': 'nimp',
+                                   'phase': 'cook', 'message': 'hello world' })
+
+        source = { 'time': 13.5, 'pid': 42, 'argv': ['cook', '-x'], 'phase': 'cook' }
+        lines = formatter.format_lines(['first', 'second "quoted"'], source)
+        self.assertListEqual([ json.loads(line) for line in lines ], [
+            { 'time': 13.5, 'level': 'INFO', 'source': 'child', 'pid': 42,
+              'argv': ['cook', '-x'], 'phase': 'cook', 'message': message }
+            for message in ['first', 'second "quoted"'] ])
+        self.assertIsNone(nimp.log.get_phase())
@@ -22,553 +22,85 @@
 
 ''' System utilities unit tests '''
 
-import contextlib
+import io
+import marshal
 import os
+import sys
 import unittest
 import unittest.mock
-import argparse
 
+import nimp.commands.p4
+import nimp.environment
+import nimp.sys.process
+import nimp.tests.p4_mock
 import nimp.tests.utils
 import nimp.utils.p4
-
-class _MockChangelist:
-    def __init__(self, number, description):
-        self.files = {}
-        self.number = number
-        self.description = description
-        self.status = 'pending'
-
-class P4Mock(nimp.tests.utils.MockCommand):
-    ''' Mocks p4 command '''
-
-    def __init__(self):
-        super(P4Mock, self).__init__('p4')
-        # Filename -> (action, head_action) dictionary)
-        self._changelists = {}
-        self._files = {}
-        self._current_changelist = 0
-        self._parser = argparse.ArgumentParser(prog = 'p4')
-        self._init_args(self._parser)
-
-    def add_changelist(self, description, *files_content):
-        ''' Adds a fake changelist to this p4 mock '''
-        if not self._changelists:
-            cl_number = '400'
-        else:
-            cl_number = str(int(max(self._changelists.keys(), key=int)) + 1)
-        changelist = _MockChangelist(cl_number, description)
-        changelist.status = 'submitted'
-        self._changelists[cl_number] = changelist
-        for filename, file_content in files_content:
-            if filename not in self._files:
-                self._files[filename] = []
-            revisions = self._files[filename]
-            new_rev = len(revisions)
-            revisions.append(file_content)
-            changelist.files[filename] = (new_rev, None)
-        return cl_number
-
-    def get_result(self, command, stdin=None):
-        args = self._parser.parse_args(command)
-
-        if args.x not in ['-', None]:
-            assert False, 'Wrong -x parameter format'
-
-        should_have_stdin = args.x == '-'
-        should_have_stdin = should_have_stdin or (hasattr(args, 'i') and args.i)
-
-        if should_have_stdin and stdin is None:
-            assert False, '-x or -i flag provided but no stdin'
-        elif not should_have_stdin and stdin is not None:
-            assert False, 'stdin provided but no -x or -i flag'
-        return args.command_to_run(args, stdin)
-
-    def _init_args(self, parser):
-        for flag in ['-z', '-c', '-H', '-p', '-P', '-u', '-x']:
-            parser.add_argument(flag)
-
-        subparsers  = parser.add_subparsers(title='Commands')
-        P4Mock._init_infos(subparsers)
-        P4Mock._init_user(subparsers)
-        self._init_add(subparsers)
-        self._init_change(subparsers)
-        self._init_changes(subparsers)
-        self._init_delete(subparsers)
-        self._init_describe(subparsers)
-        self._init_edit(subparsers)
-        self._init_fstat(subparsers)
-        self._init_reconcile(subparsers)
-        self._init_revert(subparsers)
-        self._init_submit(subparsers)
-        self._init_sync(subparsers)
-
-    def _get_file_status(self, filename):
-        for _, change in reversed(sorted(self._changelists.items())):
-            for name_it, (rev, local_status) in change.files.items():
-                if name_it == filename:
-                    head_revision = None
-                    head_status = None
-                    if name_it in self._files:
-                        head_revision = self._files[name_it][rev]
-                        head_status = 'delete' if head_revision is None else 'add'
-                    return rev, head_status, local_status
-
-        return 0, None, None
-
-    def _init_add(self, subparsers):
-        def _add_command(args, _):
-            # TODO : Add ouput
-            if args.changelist not in self._changelists:
-                return (1, '', 'Changelist %s doesn\'t exists' % args.changelist)
-
-            changelist = self._changelists[args.changelist]
-
-            if changelist.status != 'pending':
-                return (1, '', 'Change %s is already committed.' % args.changelist)
-
-            for it in args.files:
-                rev, _, _ = self._get_file_status(it)
-                changelist.files[it] = (rev, 'add')
-            return (0, '', '')
-
-        parser = subparsers.add_parser('add')
-        parser.add_argument('-c', '--changelist', default = 'default')
-        parser.add_argument('files', nargs='+')
-        parser.set_defaults(command_to_run = _add_command)
-
-    def _init_change(self, subparsers):
-        #pylint: disable=inconsistent-return-statements
-        def _change_command(args, stdin):
-            if hasattr(args, 'd') and args.d is not None:
-                if args.d not in self._changelists:
-                    return (1, '', 'Change %s unknown.' % args.d)
-                change = self._changelists[args.d]
-                if change.files:
-                    error = 'Change %s has %i open file(s) associated with it and can\'t be deleted.'
-                    error = error % (change.number, len(change.files))
-                    return (1, '', error)
-                del self._changelists[args.d]
-                return (0, 'Change %s deleted.' % args.d, '')
-            if args.i:
-                # TODO : Add better checks on C.L specification
-                desc_lines = None
-                for line in stdin.split('\n'):
-                    if desc_lines is not None:
-                        desc_lines.append(line.strip())
-                    elif line.startswith('Description'):
-                        desc_lines = []
-
-                description = '\n'.join(desc_lines)
-                if not self._changelists:
-                    cl_number = '400'
-                else:
-                    cl_number = str(int(max(self._changelists.keys(), key=int)) + 1)
-                self._changelists[cl_number] = _MockChangelist(cl_number, description)
-                return (0, 'Change %s created.' % cl_number, '')
-            assert False, 'Not supported by mock'
-
-        parser = subparsers.add_parser('change')
-        parser.add_argument('-d')
-        parser.add_argument('-i', action = 'store_true')
-        parser.set_defaults(command_to_run = _change_command)
-
-    def _init_changes(self, subparsers):
-        def _changes_command(args, _):
-            output = []
-            change_id = 0
-            for _, changelist in reversed(sorted(self._changelists.items())):
-                if args.status is None or args.status.strip() == changelist.status:
-                    template = ('... change %s\n'
-                                '... time 1464522677\n'
-                                '... user test_user\n'
-                                '... client test_client\n'
-                                '... status %s\n'
-                                '... changeType public\n'
-                                '... desc %s\n\n')
-                    output.append(template % (changelist.number, changelist.status, changelist.description))
-                if int(args.m) > 0 and change_id >= int(args.m):
-                    break
-                change_id += 1
-            return (0, '\n\n'.join(output), '')
-
-        parser = subparsers.add_parser('changes')
-        parser.add_argument('-c', '--changes_client')
-        parser.add_argument('-m', default = 0)
-        parser.add_argument('-s', '--status', choices = ['pending', 'submitted', 'shelved'])
-        parser.set_defaults(command_to_run = _changes_command)
-
-    def _init_delete(self, subparsers):
-        def _delete_command(args, stdin):
-            if args.changelist not in self._changelists:
-                return (1, '', 'Changelist %s doesn\'t exists' % args.changelist)
-
-            changelist = self._changelists[args.changelist]
-
-            if changelist.status != 'pending':
-                return (1, '', 'Change %s is already committed.' % args.changelist)
-
-            files = []
-            if args.files is not None:
-                files += args.files
-            if stdin is not None:
-                files += stdin.split('\n')
-            for it in files:
-                rev, _, _ = self._get_file_status(it)
-                changelist.files[it] = (rev, 'delete')
-                os.remove(it)
-            return (0, '', '')
-
-        parser = subparsers.add_parser('delete')
-        parser.add_argument('-c', '--changelist', default = 'default')
-        parser.add_argument('files', nargs='*')
-        parser.set_defaults(command_to_run = _delete_command)
-
-    def _init_describe(self, subparsers):
-        def _describe_command(args, _):
-            cl_number = args.changelist[0]
-            changelist = self._changelists[cl_number]
-            if cl_number not in self._changelists:
-                return (1, '', '%s - no such changelist.' % cl_number)
-            output = ('... change %s\n'
-                      '... user test_user\n'
-                      '... client test_client\n'
-                      '... time 1464647491\n'
-                      '... desc %s\n'
-                      '... status pending\n'
-                      '... changeType public\n\n') % (cl_number, changelist.description)
-            file_id = 0
-            for filename, (rev, local_action) in changelist.files.items():
-                rel_path = os.path.relpath(filename, '/p4')
-                output += '... depotFile%i //test_client/%s\n' % (file_id, rel_path)
-                output += '... action%i %s\n' % (file_id, local_action)
-                output += '... type%i binary\n' % file_id
-                output += '... rev%i 1\n' % rev
-                file_id += 1
-            return (0, output, '')
-
-        parser = subparsers.add_parser('describe')
-        parser.add_argument('changelist', nargs = 1)
-        parser.set_defaults(command_to_run = _describe_command)
-
-    def _init_edit(self, subparsers):
-        def _edit_command(args, stdin):
-            if args.changelist not in self._changelists:
-                return (1, '', 'Changelist %s doesn\'t exists' % args.changelist)
-            changelist = self._changelists[args.changelist]
-
-            if changelist.status != 'pending':
-                return (1, '', 'Change %s is already committed.' % args.changelist)
-
-            files = args.files + stdin.split('\n')
-            stderr = []
-            stdout = []
-            result = 0
-            for it in files:
-                rev, head_status, _ = self._get_file_status(it)
-
-                if head_status != 'add' or not os.path.exists(it):
-                    stderr.append('%s - file(s) not on client.' % it)
-                    continue
-
-                changelist.files[it] = (rev, 'edit')
-                rel_path = os.path.relpath(it, '/p4')
-                stdout.append('//test_client/%s - opened for edit' % rel_path)
-
-            result = 1 if stderr else 0
-            return (result, '\n'.join(stdout), '\n'.join(stderr))
-
-        parser = subparsers.add_parser('edit')
-        parser.add_argument('-c', '--changelist', default = 'default')
-        parser.add_argument('files', nargs='*')
-        parser.set_defaults(command_to_run = _edit_command)
-
-    def _init_fstat(self, subparsers):
-        def _get_file_fstat(filename):
-            stdout = ''
-            stderr = ''
-            if not filename.startswith('/p4'):
-                filename = os.path.join('/p4', filename)
-            if filename.endswith('/...'):
-                dirname = filename[:-4]
-                for root, _, filenames in os.walk(dirname):
-                    for child in filenames:
-                        child_file = os.path.join(root, child)
-                        child_file = os.path.relpath(child_file, '/p4')
-                        file_stdout, file_stderr = _get_file_fstat(child_file)
-                        stdout += file_stdout
-                        stderr += file_stderr
-            else:
-                if not filename.startswith('/p4') :
-                    return '', '%s - file(s) not in client view\n\n' % filename
-
-                rev, head_status, local_status = self._get_file_status(filename)
-
-                if head_status is None and local_status is None:
-                    return '', '%s - no such file(s).\n\n' % filename
-
-                stdout = ('... depotFile //test_client/%s\n'
-                          '... clientFile %s\n'
-                          '... isMapped\n'
-                          '... headType text\n'
-                          '... headTime 1462880462\n'
-                          '... headRev %s\n'
-                          '... headChange 408051\n'
-                          '... headModTime 1454408928\n'
-                          '... haveRev %s\n')
-                stdout = stdout % (os.path.relpath(filename, '/p4'),
-                                   filename,
-                                   rev,
-                                   rev)
-                if head_status is not None:
-                    stdout += '... headAction %s\n' % head_status
-                if local_status is not None:
-                    stdout += '... action %s\n' % local_status
-                stdout += '\n'
-            return stdout, stderr
-
-        def _fstat_command(args, stdin):
-            stdout = ''
-            stderr = ''
-            files = []
-
-            if args.e is not None:
-                files = [filename for filename, _ in self._changelists[args.e].files.items()]
-            else:
-                if args.files is not None:
-                    files += args.files
-                if stdin is not None:
-                    files += stdin.split('\n')
-
-            for it in files:
-                file_stdout, file_stderr = _get_file_fstat(it)
-                stdout += file_stdout
-                stderr += file_stderr
-            return (0, stdout, stderr)
-
-        parser = subparsers.add_parser('fstat')
-        parser.add_argument('-e')
-        parser.add_argument('files', nargs='*')
-        parser.set_defaults(command_to_run = _fstat_command)
-
-    @staticmethod
-    def _init_infos(subparsers):
-        def _infos_command(*_):
-            return (0,
-                    ('... userName test_user\n'
-                     '... clientName test_client\n'
-                     '... clientRoot /p4root\n'
-                     '... clientCwd /p4root\n'
-                     '... clientHost test_host\n'),
-                    '')
-        parser = subparsers.add_parser('info')
-        parser.set_defaults(command_to_run = _infos_command)
-
-    def _init_reconcile(self, subparsers):
-        def _reconcile_command(args, stdin):
-            assert args.c in self._changelists
-            changelist = self._changelists[args.c]
-            paths_to_reconcile = stdin.split('\n')
-            files_to_reconcile = set()
-
-            for filename, _ in self._files.items():
-                for path in paths_to_reconcile:
-                    if path.startswith(filename):
-                        files_to_reconcile.add(filename)
-
-            for path in paths_to_reconcile:
-                if path.endswith('/...'):
-                    directory = path[:-4]
-                    for root, _, filenames in os.walk(directory):
-                        for child in filenames:
-                            child_file = os.path.join(root, child)
-                            files_to_reconcile.add(child_file)
-                else:
-                    files_to_reconcile.add(path)
-
-            for file_it in files_to_reconcile:
-                rev, head_action, action = self._get_file_status(file_it)
-                if head_action != 'delete' and action != 'delete' and not os.path.exists(file_it):
-                    changelist.files[file_it] = (rev, 'delete')
-                    continue
-
-                if not os.path.exists(file_it):
-                    continue
-
-                if head_action is None and action is None:
-                    changelist.files[file_it] = (rev, 'add')
-                    continue
-
-                with open(file_it, 'r') as file:
-                    file_content = file.read()
-
-                if file_content != self._files[file_it][rev]:
-                    changelist.files[file_it] = (rev, 'edit')
-
-            return (0, '', '')
-
-        parser = subparsers.add_parser('reconcile')
-        parser.add_argument('-c')
-        parser.set_defaults(command_to_run = _reconcile_command)
-
-    def _init_revert(self, subparsers):
-        def _revert(path, args):
-            ''' Reverts given path '''
-            if path == '//...':
-                for cl_number, changelist in self._changelists.items():
-                    if args.changelist is not None and cl_number != args.changelist:
-                        continue
-                    if changelist.status == 'pending':
-                        for cl_file, _ in list(changelist.files.items()):
-                            _revert(cl_file, args)
-                        assert not changelist.files
-            else:
-                for cl_number, changelist in self._changelists.items():
-                    if args.changelist is not None and cl_number != args.changelist:
-                        continue
-                    if changelist.status == 'pending' and path in changelist.files:
-                        del changelist.files[path]
-                    rev, _, _ = self._get_file_status(path)
-                    head_content = None
-                    if path in self._files:
-                        revisions = self._files[path]
-                        if len(revisions) > rev and revisions[rev] is not None:
-                            head_content = revisions[rev]
-
-                    if args.a:
-                        with open(path, 'r') as file_content:
-                            if head_content is None or file_content.read() != head_content:
-                                continue
-
-                    if head_content is None:
-                        os.remove(path)
-                    else:
-                        with open(path, 'w') as file_content:
-                            file_content.write(head_content)
-
-        def _revert_command(args, stdin):
-            paths = []
-            if args.paths is not None:
-                paths += args.paths
-            if stdin is not None:
-                paths += stdin.split('\n')
-            for path in paths:
-                _revert(path, args)
-            return (0, '', '')
-
-        parser = subparsers.add_parser('revert')
-        parser.add_argument('-c', '--changelist', default = None)
-        parser.add_argument('-a', action = 'store_true')
-        parser.add_argument('paths', nargs='*')
-        parser.set_defaults(command_to_run = _revert_command)
-
-    def _init_submit(self, subparsers):
-        def _submit_command(args, _):
-            if args.c is not None:
-                assert args.c in self._changelists
-                changelist = self._changelists[args.c]
-                if not changelist.files:
-                    return (0, '', 'No files to submit.')
-                for filename, (_, action) in changelist.files.items():
-                    if action != 'delete':
-                        with open(filename, 'r') as content_file:
-                            content = content_file.read()
-                    else:
-                        content = None
-                    if filename not in self._files:
-                        self._files[filename] = []
-                    revisions = self._files[filename]
-                    rev_id = len(revisions)
-                    revisions.append(content)
-                    changelist.files[filename] = (rev_id, None)
-                    changelist.status = 'submitted'
-                return (0, '', '')
-            return (1, '', '')
-
-        parser = subparsers.add_parser('submit')
-        parser.add_argument('-c')
-        parser.add_argument('-f')
-        parser.set_defaults(command_to_run = _submit_command)
-
-    def _init_sync(self, subparsers):
-        def _sync_command(args, _):
-            filename = None
-            revision = None
-            synced_files = set()
-            if args.file_range is not None:
-                if '@' in args.file_range:
-                    filename, revision = tuple(args.file_range.split('@'))
-                else:
-                    filename = None
-                    revision = args.file_range
-            for cl_number, change in reversed(sorted(self._changelists.items())):
-                if revision is None or int(cl_number) <= int(revision):
-                    for name_it, (rev, _) in change.files.items():
-                        if filename is not None and filename != '' and name_it != filename:
-                            continue
-
-                        if name_it in synced_files:
-                            continue
-
-                        if name_it not in self._files:
-                            continue
-
-
-                        head_revision = self._files[name_it][rev]
-
-                        if head_revision is None and os.path.exists(name_it):
-                            os.remove(name_it)
-
-                        elif head_revision is not None:
-                            dirname = os.path.dirname(name_it)
-                            nimp.system.safe_makedirs(dirname)
-                            with open(name_it, 'w') as file_content:
-                                file_content.write(head_revision)
-                        synced_files.add(name_it)
-            if revision is None:
-                revision = str(int(max(self._changelists.keys(), key=int)))
-            self._current_changelist = revision
-            return (0, '', '')
-
-        parser = subparsers.add_parser('sync')
-        parser.add_argument('-f')
-        parser.add_argument('file_range', nargs='?')
-        parser.set_defaults(command_to_run = _sync_command)
-
-    @staticmethod
-    def _init_user(subparsers):
-        #pylint: disable=inconsistent-return-statements
-        def _user_command(args, _):
-            if args.o:
-                return (0,
-                        ('... User test_user'
-                         '... Email test@test.test'
-                         '... Update 2013/06/12 15:33:16'
-                         '... Access 2016/05/31 00:09:46'
-                         '... FullName Test User'
-                         '... Password ******'
-                         '... Type standard'),
-                        '')
-            assert False, 'Not supported by mock'
-
-        parser = subparsers.add_parser('user')
-        parser.add_argument('-o', action ='store_true')
-        parser.set_defaults(command_to_run = _user_command)
-
-@contextlib.contextmanager
-def mock_p4():
-    ''' Returns a p4 mock '''
-    with nimp.tests.utils.mock_filesystem():
-        p4_mock = P4Mock()
-        with nimp.tests.utils.mock_capture_process_output(p4_mock):
-            yield p4_mock
+import nimp.utils.p4_backend
+import nimp.utils.p4_manifest
+
+class _RecordParsingTests(unittest.TestCase):
+
+    def test_read_tagged_records(self):
+        ''' Tagged output should be parsed record by record, missing fields
+            and multiline values included '''
+        output = ('... change 401\n'
+                  '... desc First line\n'
+                  '\n'
+                  'Third line\n'
+                  '\n'
+                  '... status pending\n'
+                  '... depotFile0 //depot/a\n'
+                  '... action0 edit\n'
+                  '... depotFile1 //depot/b\n'
+                  '... action1 add\n'
+                  '\n'
+                  '... change 402\n'
+                  '... status pending\n'
+                  '\n')
+        lines = nimp.sys.process.OutputBuffer.from_text(output)
+        records = list(nimp.utils.p4_backend.read_tagged_records(lines))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['desc'], 'First line\n\nThird line')
+        self.assertEqual(records[1], { 'change': '402', 'status': 'pending' })
+        self.assertListEqual(list(nimp.utils.p4_backend.get_indexed_values(records[0], 'depotFile', 'action')),
+                             [ ('//depot/a', 'edit'), ('//depot/b', 'add') ])
+
+        records = list(nimp.utils.p4_backend.read_tagged_records(lines, [ 'change', 'depotFile' ]))
+        self.assertListEqual(records, [ { 'change': '401', 'depotFile0': '//depot/a', 'depotFile1': '//depot/b' },
+                                        { 'change': '402' } ])
+
+    def test_read_marshal_records(self):
+        ''' Records should be decoded whatever the blocks they span '''
+        records = [ { b'code': b'stat', b'depotFile': b'//depot/file_%d' % i, b'headRev': i }
+                    for i in range(20) ]
+        records.append({ b'code': b'error', b'data': 'caf\xe9'.encode('utf-8'), b'severity': 3 })
+        data = b''.join(marshal.dumps(record, 0) for record in records)
+
+        for block_size in [ 1, 7, 1024 ]:
+            with unittest.mock.patch('nimp.utils.p4_backend._MARSHAL_BLOCK_SIZE', block_size):
+                result = list(nimp.utils.p4_backend.read_marshal_records(io.BytesIO(data)))
+                self.assertEqual(len(result), 21)
+                self.assertEqual(result[3], { 'code': 'stat', 'depotFile': '//depot/file_3', 'headRev': 3 })
+                self.assertEqual(result[20]['data'], 'caf\xe9')
+
+                result = list(nimp.utils.p4_backend.read_marshal_records(io.BytesIO(data), ['depotFile']))
+                self.assertEqual(result[3], { 'depotFile': '//depot/file_3' })
+                self.assertEqual(result[20], {})
+
+        with self.assertRaises(EOFError):
+            list(nimp.utils.p4_backend.read_marshal_records(io.BytesIO(data[:-1])))
 
 class _P4Tests(unittest.TestCase):
     def __init__(self, test):
         super(_P4Tests, self).__init__(test)
-        self._p4 = nimp.utils.p4.P4(port = 'test_port',
-                                    user = 'test_user',
-                                    password = 'test_password',
-                                    client = 'test_client')
+        self._p4 = self._create_p4(port = 'test_port',
+                                   user = 'test_user',
+                                   password = 'test_password',
+                                   client = 'test_client')
+
+    @staticmethod
+    def _create_p4(**kwargs):
+        return nimp.utils.p4.P4(**kwargs)
 
     def _assert_action_is(self, filename, action):
         files_status = list(self._p4.get_files_status(filename))
@@ -582,7 +114,7 @@ class _P4Tests(unittest.TestCase):
 
     def test_add(self):
         ''' Checks if adding files to perforce is working '''
-        with mock_p4():
+        with nimp.tests.p4_mock.mock_p4():
             nimp.tests.utils.create_file('/p4/file_1', 'rev_1')
             nimp.tests.utils.create_file('/p4/file_2', 'rev_1')
             cl_number = self._p4.get_or_create_changelist('test_cl')
@@ -598,7 +130,7 @@ class _P4Tests(unittest.TestCase):
 
     def test_delete(self):
         ''' deletes should delete files '''
-        with mock_p4() as mock:
+        with nimp.tests.p4_mock.mock_p4() as mock:
             mock.add_changelist('test changelist',
                                 ('/p4/file_1', 'rev 1'),
                                 ('/p4/file_2', 'rev 1'))
@@ -615,7 +147,7 @@ class _P4Tests(unittest.TestCase):
 
     def test_clean_workspace(self):
         ''' clean_workspace should revert all files and delete pending changelist '''
-        with mock_p4() as mock:
+        with nimp.tests.p4_mock.mock_p4() as mock:
             mock.add_changelist('test changelist',
                                 ('/p4/file_1', 'rev_1'),
                                 ('/p4/file_2', 'rev_2'),
@@ -638,7 +170,7 @@ class _P4Tests(unittest.TestCase):
 
     def test_get_or_create_changelist(self):
         ''' get_or_create_changelist should create a new changelist '''
-        with mock_p4():
+        with nimp.tests.p4_mock.mock_p4():
             self.assertListEqual([], list(self._p4.get_pending_changelists()))
             cl_number = self._p4.get_or_create_changelist('changelist description')
             pending_cls = self._p4.get_pending_changelists()
@@ -650,9 +182,48 @@ class _P4Tests(unittest.TestCase):
             already_existing_cl = self._p4.get_or_create_changelist('changelist description')
             self.assertEqual(already_existing_cl, cl_number)
 
+    def test_metadata_cache(self):
+        ''' Metadata should be queried once, until changelists are modified '''
+        def _count(mock, name):
+            return len([ it for it in mock.commands if name in it ])
+
+        with nimp.tests.p4_mock.mock_p4() as mock:
+            cl_1 = self._p4.get_or_create_changelist('cl 1')
+            cl_2 = self._p4.get_or_create_changelist('cl 2')
+            mock.commands.clear()
+
+            for _ in range(3):
+                self.assertEqual(self._p4.get_workspace(), 'test_client')
+                self.assertEqual(self._p4.get_user(), 'test_user')
+                self.assertEqual(self._p4.get_or_create_changelist('cl 2'), cl_2)
+                self.assertEqual(self._p4.get_changelist_description(cl_1), 'cl 1')
+            self.assertEqual(_count(mock, 'info'), 0)
+            self.assertEqual(_count(mock, 'user'), 0)
+            self.assertEqual(_count(mock, 'changes'), 1)
+            self.assertEqual(_count(mock, 'describe'), 0)
+
+            self.assertTrue(self._p4.delete_changelist(cl_1))
+            self.assertListEqual(list(self._p4.get_pending_changelists()), [cl_2])
+            self.assertEqual(_count(mock, 'changes'), 2)
+
+            env = nimp.environment.Environment()
+            env.p4port = 'test_port'
+            self.assertIs(nimp.utils.p4.get_client(env), nimp.utils.p4.get_client(env))
+
+    def test_info_cache(self):
+        ''' Server availability should never be read from the disk cache '''
+        p4 = self._create_p4(port = 'test_port', client = 'test_client')
+        with nimp.tests.p4_mock.mock_p4():
+            # pylint: disable = protected-access
+            with unittest.mock.patch.object(p4._backend, 'run', wraps = p4._backend.run) as run:
+                self.assertEqual(p4.get_server_address(), 'test_server:1666')
+                self.assertEqual(p4.get_workspace(), 'test_client')
+            self.assertListEqual([ call.kwargs['cache_ttl'] for call in run.call_args_list ],
+                                 [ None, nimp.utils.p4._INFO_CACHE_TTL ])
+
     def test_delete_changelist(self):
         ''' delete_changelist should delete pending changelist '''
-        with mock_p4():
+        with nimp.tests.p4_mock.mock_p4():
             cl_number = self._p4.get_or_create_changelist('changelist description')
             self.assertTrue(self._p4.delete_changelist(cl_number))
             self.assertListEqual([], list(self._p4.get_pending_changelists()))
@@ -667,7 +238,7 @@ class _P4Tests(unittest.TestCase):
     def test_get_files_status(self):
         ''' get_file_status should return correct file status '''
         # /... should be added to the end of a file if it's a directory
-        with mock_p4() as mock:
+        with nimp.tests.p4_mock.mock_p4() as mock:
             mock.add_changelist('test changelist',
                                 ('/p4/file_1', 'rev_1'),
                                 ('/p4/file_2', 'rev_1'),
@@ -706,7 +277,7 @@ class _P4Tests(unittest.TestCase):
 
     def test_edit(self):
         ''' edit should open correct files for edit'''
-        with mock_p4() as mock:
+        with nimp.tests.p4_mock.mock_p4() as mock:
             mock.add_changelist('test_changelist',
                                 ('/p4/file_1', 'rev_1'),
                                 ('/p4/file_2', 'rev_1'))
@@ -727,11 +298,65 @@ class _P4Tests(unittest.TestCase):
             self.assertFalse(self._p4.edit(cl_number, '/p4/file_1'))
             self.assertFalse(self._p4.edit(cl_number, '/p4/file_2'))
 
+    def test_file_batches(self):
+        ''' add_files, edit_files and delete_files should run by batches bound
+            to the changelist, and report errors of all batches '''
+        with nimp.tests.p4_mock.mock_p4() as mock, unittest.mock.patch('nimp.utils.p4.FILE_BATCH_SIZE', 2):
+            files = [ '/p4/file_%d' % i for i in range(5) ]
+            for it in files:
+                nimp.tests.utils.create_file(it, 'rev 1')
+            cl_number = self._p4.get_or_create_changelist('test changelist')
+            mock.commands.clear()
+
+            self.assertListEqual(self._p4.add_files(cl_number, iter(files)), [])
+            self.assertEqual(len(mock.commands), 3)
+            self.assertTrue(all('-c' in it and cl_number in it for it in mock.commands))
+            for it in files:
+                self._assert_action_is(it, 'add')
+
+            self.assertTrue(self._p4.submit(cl_number))
+            self._p4.sync()
+            errors = self._p4.edit_files(cl_number, files)
+            self.assertEqual(len(errors), 3)
+            self.assertTrue(all('already committed' in it for it in errors))
+
+            cl_number = self._p4.get_or_create_changelist('test changelist')
+            self.assertListEqual(self._p4.delete_files(cl_number, files[:3]), [])
+            for it in files[:3]:
+                self._assert_action_is(it, 'delete')
+
+    def test_file_batch_errors(self):
+        ''' Batches should be retried when the server times out, and fail on
+            exit codes and files that can't be written '''
+        with nimp.tests.p4_mock.mock_p4(), unittest.mock.patch('nimp.utils.p4.FILE_BATCH_SIZE', 2):
+            files = [ '/p4/file_%d' % i for i in range(5) ]
+            for it in files:
+                nimp.tests.utils.create_file(it, 'rev 1')
+            cl_number = self._p4.get_or_create_changelist('test changelist')
+
+            backend = self._p4._backend # pylint: disable = protected-access
+            run = backend.run
+            results = [ (0, '', 'Operation took too long \n') ]
+            def _run(args, **kwargs):
+                if results:
+                    return results.pop(0)
+                return run(args, **kwargs)
+
+            with unittest.mock.patch.object(backend, 'run', side_effect = _run) as run_mock:
+                self.assertListEqual(self._p4.add_files(cl_number, files), [])
+                self.assertEqual(run_mock.call_count, 4)
+                for it in files:
+                    self._assert_action_is(it, 'add')
+
+                results += [ (0, '', '/p4/file_0 - can\'t clobber writable file\n'), (1, '', '') ]
+                errors = self._p4.add_files(cl_number, files)
+                self.assertListEqual(sorted(errors), [ '/p4/file_0 - can\'t clobber writable file', 'p4 add failed' ])
+
     def test_reconcile(self):
         ''' reconcile should get a coherent workspace status '''
         # files opened for edit and deleted on disk should be reverted then
         # deleted in perforce in order to have a good state
-        with mock_p4() as mock:
+        with nimp.tests.p4_mock.mock_p4() as mock:
             mock.add_changelist('test_changelist',
                                 ('/p4/file_1', 'rev 1'),
                                 ('/p4/file_2', 'rev 1'),
@@ -761,18 +386,82 @@ class _P4Tests(unittest.TestCase):
                                   ('/p4/file_2', 'add', 'delete'),
                                   ('/p4/file_3', 'add', 'edit')])
 
+    def test_reconcile_manifest(self):
+        ''' reconcile should only send files modified since they were
+            synced or submitted when the have-manifest is enabled '''
+        with nimp.tests.p4_mock.mock_p4() as mock, unittest.mock.patch.dict('os.environ', { 'NIMP_CACHE_DIR': '/cache' }):
+            p4 = self._create_p4(client = 'test_client', use_manifest = True)
+            mock.add_changelist('test_changelist',
+                                ('/p4/dir/file_1', 'rev 1'),
+                                ('/p4/dir/file_2', 'rev 1'),
+                                ('/p4/dir/file_3', 'rev 1'))
+            self.assertTrue(p4.sync('/p4/dir/file_1', '/p4/dir/file_2', '/p4/dir/file_3'))
+            cl_number = p4.get_or_create_changelist('test')
+
+            def _reconcile():
+                mock.commands.clear()
+                mock.inputs.clear()
+                self.assertTrue(p4.reconcile(cl_number, '/p4/dir'))
+                # Paths are read from stdin by the command line client, and
+                # given as arguments with P4Python
+                return [ stdin.split('\n') if stdin is not None else [ it for it in command if it.startswith('/') ]
+                         for command, stdin in zip(mock.commands, mock.inputs) if 'reconcile' in command ]
+
+            # The first reconcile is a full one
+            self.assertListEqual(_reconcile(), [ [ '/p4/dir/...' ] ])
+            self.assertListEqual(_reconcile(), [])
+
+            with open('/p4/dir/file_1', 'w') as file_content:
+                file_content.write('rev 2')
+            os.utime('/p4/dir/file_2', (0, 0))
+            os.remove('/p4/dir/file_3')
+            nimp.tests.utils.create_file('/p4/dir/file_4', 'rev 1')
+            self.assertListEqual(sorted(_reconcile()[0]),
+                                 [ '/p4/dir/file_1', '/p4/dir/file_3', '/p4/dir/file_4' ])
+
+            # Manifests are persisted, and submitted files are recorded
+            p4 = self._create_p4(client = 'test_client', use_manifest = True)
+            self.assertTrue(p4.submit(cl_number))
+            self.assertListEqual(_reconcile(), [])
+
+            with unittest.mock.patch('nimp.utils.p4_manifest.MANIFEST_FULL_RECONCILE_INTERVAL', -1):
+                self.assertListEqual(_reconcile(), [ [ '/p4/dir/...' ] ])
+
+    def test_reconcile_manifest_seed(self):
+        ''' A full reconcile should record unopened files of workspaces
+            synced without the have-manifest '''
+        with nimp.tests.p4_mock.mock_p4() as mock, unittest.mock.patch.dict('os.environ', { 'NIMP_CACHE_DIR': '/cache' }):
+            mock.add_changelist('test_changelist',
+                                ('/p4/dir/file_1', 'rev 1'),
+                                ('/p4/dir/file_2', 'rev 1'))
+            self.assertTrue(self._create_p4(client = 'test_client').sync('/p4/dir/file_1', '/p4/dir/file_2'))
+
+            p4 = self._create_p4(client = 'test_client', use_manifest = True)
+            cl_number = p4.get_or_create_changelist('test')
+            with open('/p4/dir/file_2', 'w') as file_content:
+                file_content.write('rev 2')
+            self.assertTrue(p4.reconcile(cl_number, '/p4/dir'))
+
+            # Opened files are not recorded, and are reconciled again
+            mock.commands.clear()
+            mock.inputs.clear()
+            self.assertTrue(p4.reconcile(cl_number, '/p4/dir'))
+            reconciled = [ stdin.split('\n') if stdin is not None else [ it for it in command if it.startswith('/') ]
+                           for command, stdin in zip(mock.commands, mock.inputs) if 'reconcile' in command ]
+            self.assertListEqual(reconciled, [ [ '/p4/dir/file_2' ] ])
+
     def test_describe(self):
         ''' describe should return changelist description'''
         # files opened for edit and deleted on disk should be reverted then
         # deleted in perforce in order to have a good state
-        with mock_p4():
+        with nimp.tests.p4_mock.mock_p4():
             cl_number = self._p4.get_or_create_changelist('test description')
             result = self._p4.get_changelist_description(cl_number)
             self.assertEqual(result, 'test description')
 
     def test_sync(self):
         ''' describe should return changelist description'''
-        with mock_p4() as mock:
+        with nimp.tests.p4_mock.mock_p4() as mock:
             rev_1 = mock.add_changelist('test_changelist',
                                         ('/p4/file_1', 'rev 1'),
                                         ('/p4/file_2', 'rev 1'),
@@ -820,9 +509,131 @@ class _P4Tests(unittest.TestCase):
             with open('/p4/file_3', 'r') as file_content:
                 self.assertEqual(file_content.read(), 'rev 1')
 
+    def test_sync_files(self):
+        ''' sync_files should sync files by batches and report each of them '''
+        with nimp.tests.p4_mock.mock_p4() as mock:
+            files = [ '/p4/file_%d' % i for i in range(5) ]
+            rev_1 = mock.add_changelist('test_changelist', *[ (it, 'rev 1') for it in files ])
+            mock.add_changelist('test_changelist', *[ (it, 'rev 2') for it in files[:3] ])
+            mock.commands.clear()
+
+            result = list(self._p4.sync_files(files, cl_number = rev_1, parallel = 'threads=4', batch_size = 2))
+            self.assertListEqual(result, [ (it, 'updated', None) for it in files ])
+            self.assertEqual(len(mock.commands), 3)
+            self.assertIn('--parallel=threads=4', mock.commands[0])
+
+            result = list(self._p4.sync_files(files[:3]))
+            self.assertListEqual(result, [ (it, 'updated', None) for it in files[:3] ])
+            with open('/p4/file_0', 'r') as file_content:
+                self.assertEqual(file_content.read(), 'rev 2')
+
+    def test_get_changed_files(self):
+        ''' get_changed_files should return local files changed in a range of
+            changelists, and cache them '''
+        with nimp.tests.p4_mock.mock_p4() as mock, unittest.mock.patch.dict('os.environ', { 'NIMP_CACHE_DIR': '/cache' }):
+            cl_1 = mock.add_changelist('test_changelist',
+                                       ('/p4/file_1', 'rev 1'),
+                                       ('/p4/file_2', 'rev 1'),
+                                       ('/p4/dir/file_3', 'rev 1'))
+            cl_2 = mock.add_changelist('test_changelist',
+                                       ('/p4/file_2', None),
+                                       ('/p4/dir/file_3', 'rev 2'))
+            cl_3 = mock.add_changelist('test_changelist',
+                                       ('/p4/dir/file_4', 'rev 1'))
+            os.environ.pop('NIMP_NO_COMMAND_CACHE', None)
+
+            self.assertListEqual(self._p4.get_changed_files(cl_1),
+                                 [ ('/p4/dir/file_3', 'edit'), ('/p4/dir/file_4', 'add'), ('/p4/file_2', 'delete') ])
+            self.assertListEqual(self._p4.get_changed_files(cl_1, cl_2, root = '//test_client/dir/...'),
+                                 [ ('/p4/dir/file_3', 'edit') ])
+            self.assertListEqual(self._p4.get_changed_files(cl_3), [])
+
+            mock.commands.clear()
+            self.assertListEqual(self._p4.get_changed_files(cl_1, cl_2, root = '//test_client/dir/...'),
+                                 [ ('/p4/dir/file_3', 'edit') ])
+            self.assertFalse([ it for it in mock.commands if 'files' in it or 'where' in it ])
+
+            # Cached results are only valid for the same workspace view
+            mock.client_view.append('-//test_client/dir/... //test_client/dir/...')
+            p4 = self._create_p4()
+            p4.get_changed_files(cl_1, cl_2, root = '//test_client/dir/...')
+            self.assertTrue([ it for it in mock.commands if 'files' in it ])
+
+    def test_changed_files_command(self):
+        ''' changed-files should write nothing but the file list to stdout '''
+        with nimp.tests.p4_mock.mock_p4() as mock, unittest.mock.patch.dict('nimp.utils.p4._CLIENTS', clear = True):
+            cl_1 = mock.add_changelist('test_changelist', ('/p4/file_1', 'rev 1'))
+            mock.add_changelist('test_changelist', ('/p4/file_1', 'rev 2'), ('/p4/file_2', 'rev 1'))
+
+            hidden = []
+            call = nimp.sys.process.call
+            def _call(command, **kwargs):
+                hidden.append(kwargs.get('hide_output', False))
+                return call(command, **kwargs)
+
+            env = nimp.environment.Environment()
+            for key, value in [ ('since', int(cl_1)), ('until', None), ('root', '//...'),
+                                ('actions', True), ('output', None) ]:
+                setattr(env, key, value)
+            output = io.StringIO()
+            with unittest.mock.patch('nimp.sys.process.call', side_effect = _call), \
+                 unittest.mock.patch('sys.stdout', output):
+                self.assertTrue(nimp.commands.p4._ChangedFiles().run(env)) # pylint: disable = protected-access
+            self.assertEqual(output.getvalue(), 'edit /p4/file_1\nadd /p4/file_2\n')
+            self.assertTrue(hidden)
+            self.assertTrue(all(hidden))
+
+    def test_fetch_files(self):
+        ''' fetch_files should write depot files at a revision, skipping
+            files that are already up to date '''
+        with nimp.tests.p4_mock.mock_p4() as mock:
+            cl_1 = mock.add_changelist('test_changelist',
+                                       ('/p4/tools/file_1', 'rev 1'),
+                                       ('/p4/tools/dir/file_2', 'rev 1'),
+                                       ('/p4/tools/file_3', 'rev 1'),
+                                       ('/p4/other/file_4', 'rev 1'))
+            cl_2 = mock.add_changelist('test_changelist',
+                                       ('/p4/tools/file_1', 'rev 2'),
+                                       ('/p4/tools/file_3', None))
+
+            def _fetch(file_spec):
+                mock.commands.clear()
+                self.assertListEqual(self._p4.fetch_files(file_spec, '/fetch'), [])
+                return len([ it for it in mock.commands if 'print' in it ])
+
+            # Each of the three files is printed by one of the jobs
+            self.assertEqual(_fetch('//test_client/tools/...@%s' % cl_1), 3)
+            with open('/fetch/dir/file_2', 'r') as file_content:
+                self.assertEqual(file_content.read(), 'rev 1')
+            self.assertTrue(os.path.exists('/fetch/file_3'))
+            self.assertFalse(os.path.exists('/fetch/file_4'))
+
+            self.assertEqual(_fetch('//test_client/tools/...@%s' % cl_1), 0)
+            self.assertEqual(_fetch('//test_client/tools/...@%s' % cl_2), 1)
+            with open('/fetch/file_1', 'r') as file_content:
+                self.assertEqual(file_content.read(), 'rev 2')
+
+            self.assertEqual(len(self._p4.fetch_files('//test_client/tools/file_3@%s' % cl_1, '/single')), 0)
+            self.assertListEqual(os.listdir('/single'), [ 'file_3' ])
+
+    def test_fetch_command(self):
+        ''' fetch should work on machines without a workspace '''
+        with nimp.tests.p4_mock.mock_p4() as mock, unittest.mock.patch.dict('nimp.utils.p4._CLIENTS', clear = True):
+            cl_1 = mock.add_changelist('test_changelist', ('/p4/tools/file_1', 'rev 1'))
+            mock.client_name = '*unknown*'
+
+            env = nimp.environment.Environment()
+            env.file_spec = '//test_client/tools/...@%s' % cl_1
+            env.destination = '/fetch'
+            self.assertFalse(nimp.utils.p4.check_for_p4(env))
+            self.assertTrue(nimp.utils.p4.check_for_p4_server(env))
+            self.assertTrue(nimp.commands.p4._Fetch().run(env)) # pylint: disable = protected-access
+            with open('/fetch/file_1', 'r') as file_content:
+                self.assertEqual(file_content.read(), 'rev 1')
+
     def test_is_file_versionned(self):
         ''' describe should return changelist description'''
-        with mock_p4() as mock:
+        with nimp.tests.p4_mock.mock_p4() as mock:
             mock.add_changelist('test_changelist',
                                 ('/p4/file_1', 'rev 1'),
                                 ('/p4/file_2', 'rev 1'),
@@ -845,7 +656,7 @@ class _P4Tests(unittest.TestCase):
 
     def test_get_last_synced_changelist(self):
         ''' describe should return changelist description'''
-        with mock_p4() as mock:
+        with nimp.tests.p4_mock.mock_p4() as mock:
             mock.add_changelist('test_changelist', ('/p4/file_1', 'rev 1'))
             cl_number = mock.add_changelist('test_changelist', ('/p4/file_1', 'rev 2'))
             self._p4.sync()
@@ -853,7 +664,7 @@ class _P4Tests(unittest.TestCase):
 
     def test_revert_changelist(self):
         ''' should rever only files in specified changelist '''
-        with mock_p4() as mock:
+        with nimp.tests.p4_mock.mock_p4() as mock:
             mock.add_changelist('test_changelist',
                                 ('/p4/file_1', 'rev 1'),
                                 ('/p4/file_2', 'rev 1'))
@@ -881,7 +692,7 @@ class _P4Tests(unittest.TestCase):
 
     def test_revert_unchanged(self):
         ''' should rever only files in specified changelist that have not changed '''
-        with mock_p4() as mock:
+        with nimp.tests.p4_mock.mock_p4() as mock:
             mock.add_changelist('test_changelist',
                                 ('/p4/file_1', 'rev 1'),
                                 ('/p4/file_2', 'rev 1'))
@@ -902,7 +713,7 @@ class _P4Tests(unittest.TestCase):
 
     def test_submit(self):
         ''' test submit '''
-        with mock_p4():
+        with nimp.tests.p4_mock.mock_p4():
             changelist  = self._p4.get_or_create_changelist('test changelist')
 
             nimp.tests.utils.create_file('/p4/file_1', 'rev 1')
@@ -918,7 +729,7 @@ class _P4Tests(unittest.TestCase):
 
     def test_get_modified_files(self):
         ''' test submit '''
-        with mock_p4() as mock:
+        with nimp.tests.p4_mock.mock_p4() as mock:
             cl_1 = mock.add_changelist('test_changelist',
                                        ('/p4/file_1', 'rev 1'),
                                        ('/p4/file_2', 'rev 1'),
@@ -946,3 +757,42 @@ class _P4Tests(unittest.TestCase):
 
             self.assertListEqual([('/test_client/file_3', 'add')],
                                  sorted(cl_3_modified_files))
+
+            mock.commands.clear()
+            with unittest.mock.patch('nimp.utils.p4.DESCRIBE_BATCH_SIZE', 2):
+                modified_files = list(self._p4.get_modified_files(cl_1, cl_2, cl_3))
+                # The second batch only has already found files, and needs no fstat
+                self.assertEqual(len(mock.commands), 3)
+                self.assertListEqual(sorted(modified_files), sorted(cl_1_modified_files))
+
+                modified_files = list(self._p4.get_modified_files(cl_2, cl_3, root = '//test_client/*_3'))
+                self.assertListEqual(modified_files, [('/test_client/file_3', 'add')])
+
+class _P4PythonTests(_P4Tests):
+    ''' Runs P4 tests with the P4Python backend '''
+
+    @staticmethod
+    def _create_p4(**kwargs):
+        with unittest.mock.patch.dict(sys.modules, { 'P4': nimp.tests.p4_mock.P4PYTHON_MODULE }):
+            backend = nimp.utils.p4_backend.P4PythonBackend(kwargs.get('port'), kwargs.get('user'),
+                                                    kwargs.get('password'), kwargs.get('client'))
+        return nimp.utils.p4.P4(backend = backend, **kwargs)
+
+    def test_connection(self):
+        ''' Commands should share a single connection, and P4Python not being
+            installed should fall back to the command line client '''
+        with nimp.tests.p4_mock.mock_p4() as mock:
+            connections = nimp.tests.p4_mock.P4PythonMock.connections
+            self.assertEqual(self._p4.get_workspace(), 'test_client')
+            self.assertEqual(self._p4.get_user(), 'test_user')
+            self.assertEqual(nimp.tests.p4_mock.P4PythonMock.connections, connections + 1)
+            self.assertTrue(all(command[0] == '-G' for command in mock.commands))
+
+            env = nimp.environment.Environment()
+            env.p4client = 'other_client'
+            env.p4backend = 'p4python'
+            with unittest.mock.patch.dict(sys.modules, { 'P4': None }):
+                p4 = nimp.utils.p4.get_client(env)
+            mock.commands.clear()
+            self.assertEqual(p4.get_workspace(), 'test_client')
+            self.assertEqual(mock.commands[0][:2], [ '-z', 'tag' ])
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+''' Process utilities unit tests '''
+
+import json
+import os
+import os.path
+import sys
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import nimp.sys.cache
+import nimp.sys.cgroup
+import nimp.sys.platform
+import nimp.sys.process
+import nimp.sys.scheduling
+import nimp.utils.git
+import nimp.utils.p4_backend
+
+class _OutputBufferTests(unittest.TestCase):
+
+    def test_in_memory(self):
+        ''' Small outputs should stay in memory '''
+        with nimp.sys.process.OutputBuffer(1024) as output:
+            output.write('foo\n')
+            output.write('bar\r\n')
+            self.assertFalse(output.spilled)
+            self.assertListEqual(list(output), ['foo\n', 'bar\r\n'])
+            self.assertEqual(output.getvalue(), 'foo\nbar\r\n')
+
+    def test_spill(self):
+        ''' Outputs larger than the memory limit should move to disk '''
+        with nimp.sys.process.OutputBuffer(16) as output:
+            lines = ['line %d\r\n' % i for i in range(10)]
+            lines.append('bad\rline\n')
+            for line in lines:
+                output.write(line)
+            self.assertTrue(output.spilled)
+            self.assertListEqual(list(output), lines)
+            self.assertEqual(output.getvalue(), ''.join(lines))
+
+    def test_call_stream_capture(self):
+        ''' call should return buffers when stream_capture is set '''
+        command = [sys.executable, '-c', 'for i in range(100): print(i)']
+        result, output, error = nimp.sys.process.call(command, capture_output=True, stream_capture=True,
+                                                      capture_limit=64, hide_output=True)
+        with output, error:
+            self.assertEqual(result, 0)
+            self.assertTrue(output.spilled)
+            self.assertListEqual([int(line) for line in output], list(range(100)))
+            self.assertEqual(error.getvalue(), '')
+
+        result, output, _ = nimp.sys.process.call(command, capture_output=True, hide_output=True)
+        self.assertEqual(output.split(), [str(i) for i in range(100)])
+
+    def test_call_capture_binary(self):
+        ''' Binary output should be captured untouched, and be readable as a
+            stream of p4 -G records '''
+        script = ('import marshal, sys\n'
+                  'for i in range(1000): marshal.dump({b"depotFile": b"//f/%d\\r\\n" % i, b"rev": i},'
+                  ' sys.stdout.buffer, 0)')
+        command = [sys.executable, '-c', script]
+        result, output, error = nimp.sys.process.call(command, capture_output=True, stream_capture=True,
+                                                      capture_binary=True, capture_limit=64, hide_output=True)
+        with output, error:
+            self.assertEqual(result, 0)
+            records = list(nimp.utils.p4_backend.read_marshal_records(output))
+        self.assertEqual(len(records), 1000)
+        self.assertEqual(records[999], { 'depotFile': '//f/999\r\n', 'rev': 999 })
+
+        _, output, _ = nimp.sys.process.call(command, capture_output=True, capture_binary=True, hide_output=True)
+        self.assertIsInstance(output, bytes)
+        self.assertTrue(output.startswith(b'{'))
+
+class _ResourceUsageTests(unittest.TestCase):
+
+    def test_sidecar(self):
+        ''' Resource usage should be appended to NIMP_RESOURCE_USAGE_FILE '''
+        with tempfile.TemporaryDirectory() as directory:
+            sidecar_path = os.path.join(directory, 'usage.jsonl')
+            command = [sys.executable, '-c', 'import sys; sys.exit(3)']
+            with unittest.mock.patch.dict(os.environ, {'NIMP_RESOURCE_USAGE_FILE': sidecar_path}):
+                self.assertEqual(nimp.sys.process.call(command, hide_output=True), 3)
+                self.assertEqual(nimp.sys.process.call(command, hide_output=True), 3)
+
+            with open(sidecar_path) as sidecar:
+                records = [json.loads(line) for line in sidecar]
+            self.assertEqual(len(records), 2)
+            self.assertEqual(records[0]['command'], command)
+            self.assertEqual(records[0]['exit_code'], 3)
+            self.assertGreaterEqual(records[0]['wall_time'], 0)
+            if hasattr(os, 'wait4'):
+                self.assertGreater(records[0]['process']['max_memory'], 0)
+
+    def test_cgroup_opt_in(self):
+        ''' Child cgroups should only be created in a delegated cgroup set
+            with NIMP_CGROUP, which holds no process itself '''
+        with tempfile.TemporaryDirectory() as directory:
+            for file_name in [ 'cgroup.controllers', 'cgroup.procs', 'cgroup.subtree_control' ]:
+                with open(os.path.join(directory, file_name), 'w') as cgroup_file:
+                    cgroup_file.write('42\n' if file_name == 'cgroup.procs' else '')
+
+            with unittest.mock.patch.dict(os.environ, {'NIMP_CGROUP': ''}):
+                self.assertIsNone(nimp.sys.cgroup.create('test'))
+            with unittest.mock.patch.dict(os.environ, {'NIMP_CGROUP': directory}), \
+                 unittest.mock.patch.dict('nimp.sys.cgroup._PARENT_CGROUP', clear = True):
+                self.assertIsNone(nimp.sys.cgroup.create('test'))
+
+            with open(os.path.join(directory, 'cgroup.procs'), 'w') as cgroup_file:
+                cgroup_file.write('')
+            with unittest.mock.patch.dict(os.environ, {'NIMP_CGROUP': directory}), \
+                 unittest.mock.patch.dict('nimp.sys.cgroup._PARENT_CGROUP', clear = True):
+                group = nimp.sys.cgroup.create('test')
+                self.assertIsNotNone(group)
+                self.assertEqual(os.path.dirname(group.path), directory)
+                group.destroy()
+
+class _CommandCacheTests(unittest.TestCase):
+
+    def test_cache(self):
+        ''' Successful results should be reused until they expire '''
+        with tempfile.TemporaryDirectory() as directory:
+            counter_path = os.path.join(directory, 'counter')
+            script = ('import os\n'
+                      'with open(%r, "a") as counter: counter.write("x")\n'
+                      'print(os.path.getsize(%r))\n') % (counter_path, counter_path)
+            command = [sys.executable, '-c', script]
+            environment = {'NIMP_CACHE_DIR': os.path.join(directory, 'cache')}
+            with unittest.mock.patch.dict(os.environ, environment):
+                os.environ.pop('NIMP_NO_COMMAND_CACHE', None)
+                for _ in range(2):
+                    result, output, _ = nimp.sys.process.call(command, capture_output=True,
+                                                              hide_output=True, cache_ttl=60)
+                    self.assertEqual((result, output.strip()), (0, '1'))
+
+                result, output, error = nimp.sys.process.call(command, capture_output=True, stream_capture=True,
+                                                              hide_output=True, cache_ttl=60)
+                with output, error:
+                    self.assertListEqual(list(output), ['1\n'])
+
+                # A different key or an expired entry runs the command again
+                _, output, _ = nimp.sys.process.call(command, capture_output=True, hide_output=True,
+                                                     cache_ttl=60, cache_key='other')
+                self.assertEqual(output.strip(), '2')
+                self.assertEqual(len(nimp.sys.cache.get_entries()), 2)
+                with unittest.mock.patch('time.time', return_value=time.time() + 120):
+                    self.assertEqual(nimp.sys.cache.clear(expired_only=True), 2)
+                _, output, _ = nimp.sys.process.call(command, capture_output=True, hide_output=True, cache_ttl=60)
+                self.assertEqual(output.strip(), '3')
+
+    def test_git_head_state(self):
+        ''' git results should be keyed on the HEAD of worktrees and
+            submodules, whose .git is a file '''
+        with tempfile.TemporaryDirectory() as directory:
+            git_dir = os.path.join(directory, 'repo', '.git', 'worktrees', 'tree')
+            os.makedirs(git_dir)
+            with open(os.path.join(git_dir, 'HEAD'), 'w') as head:
+                head.write('ref: refs/heads/master\n')
+            worktree = os.path.join(directory, 'tree')
+            os.makedirs(os.path.join(worktree, 'subdir'))
+            with open(os.path.join(worktree, '.git'), 'w') as git_file:
+                git_file.write('gitdir: ../repo/.git/worktrees/tree\n')
+
+            #pylint: disable = protected-access
+            current_directory = os.getcwd()
+            try:
+                os.chdir(os.path.join(worktree, 'subdir'))
+                state = nimp.utils.git._get_head_state()
+                self.assertEqual(state[0], os.path.realpath(git_dir))
+                self.assertIsNotNone(state[1])
+
+                with open(os.path.join(worktree, '.git'), 'w') as git_file:
+                    git_file.write('gitdir: ../missing\n')
+                self.assertIsNone(nimp.utils.git._get_head_state())
+            finally:
+                os.chdir(current_directory)
+
+class _SchedulingTests(unittest.TestCase):
+
+    def test_settings(self):
+        ''' Scheduling settings should be validated and merged '''
+        self.assertListEqual(nimp.sys.scheduling.parse_cpu_list('0-2, 5,1'), [0, 1, 2, 5])
+        self.assertEqual(nimp.sys.scheduling.parse_size('1.5G'), 3 * 512 * 1024 * 1024)
+        self.assertRaises(ValueError, nimp.sys.scheduling.get_settings, ionice='slow')
+        self.assertRaises(ValueError, nimp.sys.scheduling.get_settings, nice=42)
+
+        with nimp.sys.scheduling.override(nice=10, ionice='best-effort:7'):
+            settings = nimp.sys.scheduling.get_settings(nice=5, memory_limit='512M')
+        self.assertDictEqual(settings, { 'nice': 5,
+                                         'ionice': ('best-effort', 7),
+                                         'memory_limit': 512 * 1024 * 1024 })
+        self.assertDictEqual(nimp.sys.scheduling.get_settings(), {})
+
+    @unittest.skipUnless(hasattr(os, 'sched_setaffinity'), 'requires sched_setaffinity')
+    def test_call(self):
+        ''' Priority and affinity should be set before the child runs, and
+            be inherited by its own children '''
+        script = ('import os, subprocess, sys; print(os.nice(0), sorted(os.sched_getaffinity(0)));'
+                  'sys.stdout.flush(); subprocess.call([sys.executable, "-c", "import os; print(os.nice(0))"])')
+        cpu = min(os.sched_getaffinity(0))
+        _, output, _ = nimp.sys.process.call([sys.executable, '-c', script], capture_output=True,
+                                             hide_output=True, nice=3, affinity=[cpu])
+        self.assertEqual(output.split('\n')[:2], [ '%d [%d]' % (os.nice(0) + 3, cpu), str(os.nice(0) + 3) ])
+
+    def test_command_prefix(self):
+        ''' Commands should be wrapped with tools applying scheduling settings '''
+        cgroup = unittest.mock.Mock()
+        cgroup.path = '/sys/fs/cgroup/nimp/child'
+        settings = nimp.sys.scheduling.get_settings(nice=5, ionice='idle', affinity='0-2')
+        with unittest.mock.patch('nimp.sys.platform.is_windows', return_value=False), \
+             unittest.mock.patch('nimp.sys.scheduling._find_tool', side_effect=lambda name: name):
+            prefix = nimp.sys.scheduling.get_command_prefix(settings, cgroup)
+            self.assertListEqual(nimp.sys.scheduling.get_command_prefix({}), [])
+        self.assertListEqual(prefix[:2], [ 'sh', '-c' ])
+        self.assertListEqual(prefix[3:], [ '/sys/fs/cgroup/nimp/child/cgroup.procs',
+                                           'nice', '-n', '5', 'ionice', '-c', '3', 'taskset', '-c', '0,1,2' ])
+
+    @unittest.skipIf(nimp.sys.platform.is_windows(), 'requires POSIX wrappers')
+    def test_missing_command(self):
+        ''' Missing commands should be reported even when wrapped '''
+        with self.assertLogs(level = 'ERROR'):
+            self.assertEqual(nimp.sys.process.call([ 'nimp-missing-command' ], hide_output=True, nice=1), 1)
+
+    def test_limits(self):
+        ''' Limits should be reported when they can't be set '''
+        cgroup = unittest.mock.Mock()
+        cgroup.path = '/sys/fs/cgroup/nimp/child'
+        cgroup.get_controllers.return_value = [ 'cpu' ]
+        with self.assertLogs(level = 'WARNING') as logs:
+            nimp.sys.scheduling.apply_limits({ 'memory_limit': 1024, 'cpu_limit': 2.0 }, cgroup)
+            nimp.sys.scheduling.apply_limits({ 'memory_limit': 1024 }, None)
+        self.assertIn('memory controller is not enabled', logs.output[0])
+        self.assertIn('NIMP_CGROUP', logs.output[1])
+        cgroup.set_cpu_limit.assert_called_once_with(2.0)
+        cgroup.set_memory_limit.assert_not_called()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Summary handlers unit tests '''
+
+import io
+import json
+import logging
+import os
+import os.path
+import re
+import tempfile
+import types
+import unittest
+import unittest.mock
+
+import nimp.commands.dev
+import nimp.environment
+import nimp.log
+import nimp.summary
+import nimp.unreal
+
+class _PatternMatcherTests(unittest.TestCase):
+
+    def _check(self, patterns, lines):
+        patterns = [re.compile(pattern) for pattern in patterns]
+        matcher = nimp.summary.PatternMatcher(patterns)
+        for line in lines:
+            expected = None
+            for index, pattern in enumerate(patterns):
+                match = pattern.match(line)
+                if match is not None:
+                    expected = (index, match.group(0), match.groupdict())
+                    break
+            result = matcher.match(line)
+            if result is not None:
+                result = (result[0], result[1].group(0), result[1].groupdict())
+            self.assertEqual(result, expected, line)
+        return matcher
+
+    def test_match(self):
+        ''' Matcher should return the first matching pattern '''
+        lines = [ 'foo.cpp:12:3: error: bad',
+                  'foo.cpp:12:3: warning: meh',
+                  'Foo.cs(1,2) : error CS0001: bad',
+                  '[Error]\tboom',
+                  'nothing to see here',
+                  'error: not at the right place' ]
+        matcher = self._check([ r'[\/\w\W\-. ]+:\d+:\d+: (fatal )?error: (?P<message>.*)',
+                                r'[\/\w\W\-.: ]+:\d+:\d+: warning: (?P<message>.*)',
+                                r'[\/\w\W\-. ]+\(\d+,\d+\) : error [A-Z\d]+: .*',
+                                r'\[Error\]\t.*' ], lines)
+        self.assertListEqual(matcher._keywords, [') : error ', ': warning: ', '[Error]\t', 'error: ']) # pylint: disable = protected-access
+
+    def test_literal_groups(self):
+        ''' Escaped parentheses and sets should not be renamed as groups '''
+        lines = [ 'f(P<x>: error: bad', 'fP<x>: error: bad', 'fP<_p0_x>: error: bad', '(?P<a: warning: meh' ]
+        matcher = self._check([ r'f\(?P<x>: error: (?P<message>.*)',
+                                r'[(?P<a]+: warning: (?P<message>.*)' ], lines)
+        self.assertIsNotNone(matcher._combined) # pylint: disable = protected-access
+
+    def test_fallback(self):
+        ''' Patterns without keywords or with back references should still work '''
+        self._check([ r'(\w+) \1', r'.*' ], [ 'foo foo', 'foo bar' ])
+        self._check([ r'(?i)error', r'warning' ], [ 'ERROR', 'warning', 'none' ])
+
+        # Strings aren't prefiltered when the regular expression parser
+        # internals are unavailable
+        with unittest.mock.patch('nimp.summary._REGEX_PARSER_MEMBERS', [ 'NO_SUCH_OPCODE' ]):
+            matcher = self._check([ r'.*error: (?P<message>.*)' ], [ 'foo: error: bad', 'nothing' ])
+        self.assertIsNone(matcher._keywords) # pylint: disable = protected-access
+
+
+class _DefaultSummaryHandlerTests(unittest.TestCase):
+
+    def _run(self, env, lines, handler_type = nimp.summary.DefaultSummaryHandler):
+        root_handlers = list(logging.root.handlers)
+        child_logger = logging.getLogger(nimp.log.CHILD_PROCESSES_LOGGER)
+        child_handlers = list(child_logger.handlers)
+        try:
+            with handler_type(env) as handler:
+                for line in lines:
+                    handler.emit_lines([line])
+                    yield handler
+        finally:
+            logging.root.handlers = root_handlers
+            child_logger.handlers = child_handlers
+
+    def test_summary(self):
+        ''' Summary should contain errors with their context '''
+        lines = ['line %d' % i for i in range(10)] + ['foo.cpp:1:2: error: bad', 'after']
+        with tempfile.TemporaryDirectory() as directory:
+            env = types.SimpleNamespace(summary=os.path.join(directory, 'summary.txt'), verbose=False)
+            handlers = list(self._run(env, lines))
+            with open(env.summary) as summary_file:
+                summary = summary_file.read()
+            self.assertEqual(summary, '\n *********************************************\n'
+                                      '[  NOTIF  ] line 6\n[  NOTIF  ] line 7\n'
+                                      '[  NOTIF  ] line 8\n[  NOTIF  ] line 9\n'
+                                      '[  ERROR  ] foo.cpp:1:2: error: bad\n'
+                                      '[  NOTIF  ] after\n')
+            self.assertTrue(handlers[-1].has_errors())
+
+            # Live summaries are written as soon as errors are found
+            env.summary_live = True
+            for index, handler in enumerate(self._run(env, lines)):
+                handler.flush()
+                with open(env.summary) as summary_file:
+                    self.assertEqual(summary_file.read() != '', index >= 10)
+            with open(env.summary) as summary_file:
+                self.assertEqual(summary_file.read(), summary)
+
+    def test_json(self):
+        ''' JSON summaries should count repeated messages '''
+        lines = ['start', 'a.cpp:1:2: warning: unused', 'between', 'a.cpp:1:2: warning: unused',
+                 'b.cpp:3:4: error: bad', 'a.cpp:1:2: warning: unused']
+        with tempfile.TemporaryDirectory() as directory:
+            env = types.SimpleNamespace(summary=os.path.join(directory, 'summary.jsonl'), verbose=False)
+            for index, _ in enumerate(self._run(env, lines, nimp.summary.JsonSummaryHandler)):
+                if index == 2:
+                    logging.warning('Unrelated nimp message')
+            with open(env.summary) as summary_file:
+                entries = [json.loads(line) for line in summary_file]
+        self.assertListEqual(entries, [
+            { 'level': 'warning', 'message': 'a.cpp:1:2: warning: unused', 'count': 3,
+              'first_line': 2, 'last_line': 6, 'context': ['start'] },
+            { 'level': 'warning', 'message': 'Unrelated nimp message', 'count': 1,
+              'first_line': 3, 'last_line': 3, 'context': ['between'] },
+            { 'level': 'error', 'message': 'b.cpp:3:4: error: bad', 'count': 1,
+              'first_line': 5, 'last_line': 5, 'context': [] },
+        ])
+
+class _UnrealSummaryHandlerTests(unittest.TestCase):
+
+    def test_assets(self):
+        ''' Messages should be grouped by asset, rewritten by hints and capped '''
+        hints = { 'Missing {file}': [ r'.*Can\'t find file (?P<file>\S+)' ] }
+        env = types.SimpleNamespace(summary=None, unreal_summary_hints=hints)
+        handler = nimp.unreal.UnrealSummaryHandler(env)
+        handler.emit_lines([ 'a.cpp:1:2: warning: early',
+                             '[1/3] Loading /Game/A...',
+                             'x.cpp:1:2: error: Can\'t find file Foo' ])
+        handler.emit_lines([ '[2/3] Loading /Game/B...' ])
+        handler.emit_lines([ '[3/3] Loading /Game/C...' ])
+        handler.emit_lines([ 'c.cpp:%d:2: warning: w' % i for i in range(150) ])
+
+        summary = io.StringIO()
+        handler._write_summary(summary) # pylint: disable = protected-access
+        lines = summary.getvalue().split('\n')
+        self.assertListEqual(lines[:3], [ 'Game/A :', ' * ERROR   : Missing Foo', '' ])
+        self.assertEqual(lines[3], 'Game/C :')
+        self.assertEqual(lines.index(' * 50 more messages not shown'), 104)
+        self.assertListEqual(lines[-4:], [ 'Unknown location :', ' * WARNING : a.cpp:1:2: warning: early', '', '' ])
+
+class _AnalyzeLogTests(unittest.TestCase):
+
+    def test_replay(self):
+        ''' Analyzing a log by parts should give the same summary as live handlers '''
+        lines = []
+        for i in range(3000):
+            if i % 397 == 0:
+                lines.append('x.cpp:%d:2: error: bad %d' % (i, i % 3))
+            elif i % 101 == 0:
+                lines.append('y.cpp(%d): warning C4996: old\r' % i)
+            elif i % 13 == 0:
+                lines.append('[%d/3000] Loading /Game/Asset%d...' % (i, i))
+            else:
+                lines.append('LogCook: Display: line %d' % i)
+
+        with tempfile.TemporaryDirectory() as directory:
+            log_path = os.path.join(directory, 'cook.log')
+            with open(log_path, 'w', newline = '') as log_file:
+                log_file.write('\n'.join(lines) + '\n')
+
+            for summary_format in [ 'default', 'json', 'unreal' ]:
+                env = types.SimpleNamespace(summary = None, summary_format = summary_format)
+                expected = io.StringIO()
+                handler = nimp.environment.create_summary_handler(env)
+                handler.emit_lines([ line.strip('\r') for line in lines ])
+                handler.write_summary(expected)
+
+                with unittest.mock.patch('nimp.commands.dev._MIN_CHUNK_SIZE', 4096):
+                    chunks = nimp.commands.dev._split_file(log_path, 4) # pylint: disable = protected-access
+                self.assertGreater(len(chunks), 4)
+                handler = nimp.environment.create_summary_handler(env)
+                patterns = [ (pattern.pattern, pattern.flags) for pattern in handler.get_filter_patterns() ]
+                arguments = [ (log_path, start, end, patterns, index == 0) for index, (start, end) in enumerate(chunks) ]
+                # pylint: disable = protected-access
+                nimp.commands.dev._replay(handler, map(nimp.commands.dev._analyze_chunk, arguments))
+                result = io.StringIO()
+                handler.write_summary(result)
+                self.assertEqual(result.getvalue(), expected.getvalue(), summary_format)
+
+    def test_jobs(self):
+        ''' Default worker count should stay under the Windows process pool limit '''
+        # pylint: disable = protected-access
+        with unittest.mock.patch('os.cpu_count', return_value = 128):
+            with unittest.mock.patch('nimp.sys.platform.is_windows', return_value = True):
+                self.assertEqual(nimp.commands.dev._get_default_jobs(), 61)
+            with unittest.mock.patch('nimp.sys.platform.is_windows', return_value = False):
+                self.assertEqual(nimp.commands.dev._get_default_jobs(), 128)
+        with unittest.mock.patch('os.cpu_count', return_value = None):
+            self.assertEqual(nimp.commands.dev._get_default_jobs(), 1)
+
+    def test_log_file(self):
+        ''' Analyzing a log should not open the nimp log file a second time '''
+        env = types.SimpleNamespace(summary = None, summary_format = 'default')
+        with tempfile.TemporaryDirectory() as directory:
+            log_path = os.path.join(directory, 'nimp.log')
+            with unittest.mock.patch.dict(os.environ, { 'NIMP_LOG_FILE': log_path }):
+                handler = nimp.environment.create_summary_handler(env)
+            self.assertIsNone(handler.log_all_handler)
+            self.assertFalse(os.path.exists(log_path))
@@ -24,6 +24,7 @@
 
 import abc
 import contextlib
+import io
 import os.path
 import unittest.mock
 
@@ -51,14 +52,31 @@ def mock_capture_process_output(*mock_commands):
         assert isinstance(it, MockCommand)
         mock_dict[it.command] = it
 
-    def _mock(directory, command, stdin = None, _ = True):
-        assert directory is not None
+    def _mock(command, cwd = '.', stdin = None, capture_output = False, stream_capture = False,
+              capture_binary = False, **_):
+        assert cwd is not None
         executable = command[0]
         if executable not in mock_dict:
-            return (0, '', '')
-        return mock_dict[executable].get_result(command[1:], stdin = stdin)
+            result = (0, '', '')
+        else:
+            result = mock_dict[executable].get_result(command[1:], stdin = stdin)
+
+        if not capture_output:
+            return result[0]
+        if capture_binary:
+            assert isinstance(result[1], bytes)
+            if stream_capture:
+                return (result[0],
+                        io.BytesIO(result[1]),
+                        nimp.sys.process.OutputBuffer.from_text(result[2]))
+            return result
+        if stream_capture:
+            return (result[0],
+                    nimp.sys.process.OutputBuffer.from_text(result[1]),
+                    nimp.sys.process.OutputBuffer.from_text(result[2]))
+        return result
 
-    with unittest.mock.patch('nimp.system.capture_process_output') as mock:
+    with unittest.mock.patch('nimp.sys.process.call') as mock:
         with unittest.mock.patch('nimp.sys.platform.is_msys') as mock_is_msys:
             mock_is_msys.return_value = False
             mock.side_effect = _mock
@@ -75,8 +93,10 @@ def mock_filesystem():
     ''' Sets up a mock filesystem '''
     patcher = pyfakefs.fake_filesystem_unittest.Patcher()
     patcher.setUp()
-    yield patcher.fs
-    patcher.tearDown()
+    try:
+        yield patcher.fs
+    finally:
+        patcher.tearDown()
 
 def create_file( name, content):
     ''' Creates a file on the fake file system '''
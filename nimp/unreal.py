@@ -352,12 +352,41 @@ _MESSAGE_PATTERNS = [
     (re.compile(r'.*Can\'t find file.* \'\(?P<asset>[^\']\)\'.*'), _cant_find_file)
 ]
 
+# Maximum number of distinct errors and warnings kept for each asset
+_ASSET_MESSAGE_LIMIT = 100 # pylint: disable = invalid-name
+
+class _SummaryHints():
+    """ Rewrites messages matching the unreal_summary_hints patterns """
+    def __init__(self, hints):
+        self._formats = []
+        patterns = []
+        for message_format, format_patterns in hints.items():
+            for pattern in format_patterns:
+                try:
+                    patterns.append(re.compile(pattern))
+                    self._formats.append(message_format)
+                #pylint: disable=broad-except
+                except Exception as ex:
+                    logging.error('Error while compiling pattern %s: %s',
+                                  pattern, ex)
+        self._matcher = nimp.summary.PatternMatcher(patterns)
+
+    def format(self, msg):
+        """ Returns the hint matching msg, or msg itself """
+        result = self._matcher.match(msg)
+        if result is None:
+            return msg
+        index, match = result
+        return self._formats[index].format(**match.groupdict())
+
 class _AssetSummary():
     def __init__(self, hints, asset_name):
         self._hints = hints
         self._asset_name = asset_name
-        self._errors = set()
-        self._warnings = set()
+        # Dictionaries keep messages in order, so that summaries are stable
+        self._errors = {}
+        self._warnings = {}
+        self._dropped_messages = 0
 
     def add_error(self, msg):
         """ Adds a message to this asset's summary """
@@ -376,23 +405,17 @@ class _AssetSummary():
             destination.write(' * ERROR   : %s\n' % error)
         for warning in self._warnings:
             destination.write(' * WARNING : %s\n' % warning)
+        if self._dropped_messages > 0:
+            destination.write(' * %d more messages not shown\n' % self._dropped_messages)
 
         destination.write('\n')
 
     def _add_message(self, msg, destination):
-        for message_format, patterns in self._hints.items():
-            for pattern in patterns:
-                match = pattern.match(msg)
-                if match is not None:
-                    try:
-                        group_dict = match.groupdict()
-                        message = message_format.format(**group_dict)
-                        destination.add(message)
-                        return
-                    finally:
-                        pass
-
-        destination.add(msg)
+        message = self._hints.format(msg)
+        if message not in destination and len(destination) >= _ASSET_MESSAGE_LIMIT:
+            self._dropped_messages += 1
+            return
+        destination[message] = None
 
 class UnrealSummaryHandler(nimp.summary.SummaryHandler):
     """ Default summary handler, showing one line by error / warning and
@@ -401,39 +424,30 @@ class UnrealSummaryHandler(nimp.summary.SummaryHandler):
         super().__init__(env)
         self._summary = ''
         self._asset_summaries = {}
-        self._hints = {}
-        self._load_asset_patterns = {}
-        self._current_asset = None
+        self._hints = _SummaryHints(getattr(env, 'unreal_summary_hints', {}))
+        self._current_asset_name = None
         self._unknown_asset = _AssetSummary(self._hints, 'Unknown location')
         load_asset_patterns = [
             r'.*\[\d+\/\d+\] Loading [\.|\/]*(?P<asset>.*)\.\.\.$'
         ]
 
-        self._load_asset_patterns = [
-            re.compile(it) for it in load_asset_patterns
-        ]
+        # Only lines containing "] Loading " are matched against these
+        self._load_asset_patterns = [ re.compile(it) for it in load_asset_patterns ]
+        self._load_asset_matcher = nimp.summary.PatternMatcher(self._load_asset_patterns)
 
-        if hasattr(env, 'unreal_summary_hints'):
-            for message_format, patterns in env.unreal_summary_hints.items():
-                self._hints[message_format] = []
-                for pattern in patterns:
-                    try:
-                        self._hints[message_format].append(re.compile(pattern))
-                    #pylint: disable=broad-except
-                    except Exception as ex:
-                        logging.error('Error while compiling pattern %s: %s',
-                                      pattern, ex)
+    def get_filter_patterns(self):
+        return super().get_filter_patterns() + self._load_asset_patterns
 
     def _add_notif(self, msg):
         self._update_current_asset(msg)
 
     def _add_warning(self, msg):
-        current_asset = self._update_current_asset(msg)
-        current_asset.add_warning(msg)
+        self._update_current_asset(msg)
+        self._get_current_asset().add_warning(msg)
 
     def _add_error(self, msg):
-        current_asset = self._update_current_asset(msg)
-        current_asset.add_error(msg)
+        self._update_current_asset(msg)
+        self._get_current_asset().add_error(msg)
 
     def _write_summary(self, destination):
         ''' Writes summary to destination '''
@@ -443,20 +457,19 @@ class UnrealSummaryHandler(nimp.summary.SummaryHandler):
         self._unknown_asset.write(destination)
 
     def _update_current_asset(self, msg):
-        for pattern in self._load_asset_patterns:
-            match = pattern.match(msg)
-            if match is not None:
-                group_dict = match.groupdict()
-                assert 'asset' in group_dict
-                asset_name = group_dict['asset']
-                if asset_name not in self._asset_summaries:
-                    asset_summary = _AssetSummary(self._hints, asset_name)
-                    self._asset_summaries[asset_name] = asset_summary
-
-                self._current_asset = self._asset_summaries[asset_name]
-                return self._current_asset
-
-        if self._current_asset is not None:
-            return self._current_asset
-
-        return self._unknown_asset
+        result = self._load_asset_matcher.match(msg)
+        if result is not None:
+            group_dict = result[1].groupdict()
+            assert 'asset' in group_dict
+            self._current_asset_name = group_dict['asset']
+
+    def _get_current_asset(self):
+        # Summaries are only created for assets with messages, as cooks can
+        # load hundreds of thousands of them
+        if self._current_asset_name is None:
+            return self._unknown_asset
+        asset_summary = self._asset_summaries.get(self._current_asset_name)
+        if asset_summary is None:
+            asset_summary = _AssetSummary(self._hints, self._current_asset_name)
+            self._asset_summaries[self._current_asset_name] = asset_summary
+        return asset_summary
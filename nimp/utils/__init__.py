@@ -25,5 +25,7 @@
 __all__ = [
     'git',
     'p4',
+    'p4_backend',
+    'p4_manifest',
     'version',
 ]
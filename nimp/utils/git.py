@@ -22,13 +22,19 @@
 
 ''' Git utilities '''
 
+import os
+import os.path
+
 import nimp.sys.process
 
+# Git queries are cached until HEAD moves, or for one minute at most
+_CACHE_TTL = 60 # pylint: disable = invalid-name
+
 
 def get_branch():
     ''' Get the current active branch '''
     command = 'git branch --contains HEAD'
-    result, output, _ = nimp.sys.process.call(command.split(' '), capture_output=True)
+    result, output, _ = _call(command.split(' '))
     if result != 0:
         return None
     for line in output.splitlines():
@@ -41,7 +47,7 @@ def get_version():
     ''' Build a version string from the date and hash of the last commit '''
     from datetime import datetime, timezone
     command = 'git log -10 --date=short --pretty=format:%ct.%h'
-    result, output, _ = nimp.sys.process.call(command.split(' '), capture_output=True)
+    result, output, _ = _call(command.split(' '))
     if result != 0 or '.' not in output:
         return None
 
@@ -58,3 +64,52 @@ def get_version():
         revision_offset += 1
 
     return '.'.join([date, str(revision_offset), shorthash])
+
+
+def _call(command):
+    cache_key = _get_head_state()
+    cache_ttl = _CACHE_TTL if cache_key is not None else None
+    return nimp.sys.process.call(command, capture_output=True,
+                                 cache_ttl=cache_ttl, cache_key=cache_key)
+
+
+def _get_head_state():
+    # Modification times of HEAD and its reflog change whenever a commit is
+    # made or checked out, so they are used to invalidate cached results
+    directory = os.path.abspath('.')
+    while True:
+        git_dir = os.path.join(directory, '.git')
+        if os.path.exists(git_dir):
+            break
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+    # In worktrees and submodules, .git is a file pointing to the actual
+    # git directory, which holds the HEAD of the checkout
+    if os.path.isfile(git_dir):
+        git_dir = _read_git_file(git_dir)
+        if git_dir is None:
+            return None
+
+    state = []
+    for name in [ 'HEAD', os.path.join('logs', 'HEAD') ]:
+        try:
+            state.append(os.stat(os.path.join(git_dir, name)).st_mtime_ns)
+        except OSError:
+            state.append(None)
+    return [ git_dir ] + state
+
+
+def _read_git_file(path):
+    # Returns the directory a "gitdir: <path>" file points to, or None
+    try:
+        with open(path) as git_file:
+            content = git_file.read().strip()
+    except OSError:
+        return None
+    if not content.startswith('gitdir:'):
+        return None
+    git_dir = os.path.join(os.path.dirname(path), content[len('gitdir:'):].strip())
+    return os.path.normpath(git_dir) if os.path.isdir(git_dir) else None
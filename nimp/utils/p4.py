@@ -23,13 +23,20 @@
 ''' Perforce utilities '''
 
 import argparse
+import concurrent.futures
+import hashlib
+import itertools
+import json
 import logging
 import os
 import os.path
 import re
 
+import nimp.sys.cache
 import nimp.sys.process
 import nimp.system
+import nimp.utils.p4_backend
+import nimp.utils.p4_manifest
 
 _CREATE_CHANGELIST_FORM_TEMPLATE = "\
 Change: new\n\
@@ -39,6 +46,31 @@ Status: pending\n\
 Description:\n\
         {description}"
 
+# Workspace and user names are cached for a short while, since most commands
+# query them several times. Server availability is always checked live.
+_INFO_CACHE_TTL = 60 # pylint: disable = invalid-name
+
+# Commands that don't modify changelists, see P4._before_command
+_READ_ONLY_COMMANDS = [ 'changes', 'describe', 'files', 'fstat', 'have', 'info', 'opened', 'print', 'user', 'where' ] # pylint: disable = invalid-name
+
+# Number of files synced by each p4 sync command
+SYNC_BATCH_SIZE = 5000 # pylint: disable = invalid-name
+
+# Number of files opened by each p4 add, delete, edit or revert command,
+# and number of these commands run at once, see P4._run_file_batches
+FILE_BATCH_SIZE = 2000 # pylint: disable = invalid-name
+FILE_BATCH_JOBS = 4 # pylint: disable = invalid-name
+
+# Number of changelists described by each p4 describe command
+DESCRIBE_BATCH_SIZE = 100 # pylint: disable = invalid-name
+
+# Head actions of files that can't be printed
+_DELETE_ACTIONS = [ 'delete', 'move/delete', 'purge', 'archive' ] # pylint: disable = invalid-name
+
+# Files changed between two submitted changelists are cached this long, in
+# seconds, see P4.get_changed_files
+CHANGED_FILES_CACHE_TTL = 24 * 3600 # pylint: disable = invalid-name
+
 def add_arguments(parser):
     ''' Adds p4port, p4user, p4pass and p4client arguments to a command argument
         parser. Then you can Use :func:`nimp.utils.p4.sanitize` in your
@@ -60,11 +92,20 @@ def add_arguments(parser):
                         help = 'Perforce workspace',
                         type = str)
 
+    parser.add_argument('--p4backend',
+                        help = 'Run Perforce commands with the p4 command line client, or in process with P4Python',
+                        choices = sorted(_BACKENDS.keys()),
+                        default = 'cli')
+
+    parser.add_argument('--p4manifest',
+                        help = 'Keep a manifest of synced files, to only reconcile files modified since',
+                        action = 'store_true')
+
 def check_for_p4(env):
     ''' Checks for perforce availability.
         This will print an error message if perforce can't be used. '''
     p4 = get_client(env)
-    if p4.get_workspace() is None:
+    if p4.get_server_address() is None or p4.get_workspace() is None:
         logging.error(('An error occured while checking Perforce availability. '
                        'Please check that p4 is in your path, and either you '
                        'specified correct p4port, p4client, p4user and p4pass '
@@ -73,6 +114,34 @@ def check_for_p4(env):
         return False
     return True
 
+def check_for_p4_server(env):
+    ''' Checks that the perforce server can be reached, for commands that
+        don't need a workspace. This will print an error message if it
+        can't. '''
+    p4 = get_client(env)
+    if p4.get_server_address() is None:
+        logging.error(('Unable to reach the Perforce server. Please check that '
+                       'p4 is in your path, and that either you specified '
+                       'correct p4port, p4user and p4pass on the command line, '
+                       'or your p4 environment settings are correctly set'))
+        return False
+    return True
+
+
+def _get_depot_path_regex(path):
+    # Returns a compiled regex matching depot files against a path using
+    # ... and * wildcards. Case sensitivity depends on the server, matching
+    # is case insensitive to be on the safe side.
+    pattern = ''.join('.*' if part == '...' else '[^/]*' if part == '*' else re.escape(part)
+                      for part in re.split(r'(\.\.\.|\*)', path))
+    return re.compile(pattern + '$', re.IGNORECASE)
+
+def _unescape_filename(name):
+    # Reverts P4._escape_filename, %25 is replaced last
+    return name.replace('%40', '@') \
+               .replace('%23', '#') \
+               .replace('%2A', '*') \
+               .replace('%25', '%')
 
 def get_client(env):
     ''' Returns a p4 client initialized with parameters from the environment.
@@ -83,25 +152,62 @@ def get_client(env):
     user   = env.p4user   if hasattr(env, 'p4user') else None
     pwd    = env.p4pass   if hasattr(env, 'p4pass') else None
     client = env.p4client if hasattr(env, 'p4client') else None
-    return P4(port, user, pwd, client)
+    use_manifest = getattr(env, 'p4manifest', False)
+    backend_name = getattr(env, 'p4backend', None) or 'cli'
+    # Clients are reused for the whole session so that they share their
+    # metadata cache and connection, e.g. between check_for_p4 and the
+    # command itself
+    key = (port, user, pwd, client, use_manifest, backend_name)
+    if key not in _CLIENTS:
+        try:
+            backend = _BACKENDS[backend_name](port, user, pwd, client)
+        except ImportError as ex:
+            logging.warning('%s, using the p4 command line client', ex)
+            backend = nimp.utils.p4_backend.CommandLineBackend(port, user, pwd, client)
+        _CLIENTS[key] = P4(port, user, pwd, client, use_manifest = use_manifest, backend = backend)
+    return _CLIENTS[key]
+
+_CLIENTS = {} # pylint: disable = invalid-name
+_BACKENDS = { # pylint: disable = invalid-name
+    'cli': nimp.utils.p4_backend.CommandLineBackend,
+    'p4python': nimp.utils.p4_backend.P4PythonBackend,
+}
 
 class P4:
     ''' P4 Client '''
     #pylint: disable=too-many-public-methods
 
-    def __init__(self, port = None, user = None, password = None, client = None):
+    def __init__(self, port = None, user = None, password = None, client = None,
+                 use_manifest = False, backend = None):
         self._port = port
-        self._user = user
-        self._password = password
-        self._client = client
+        self._backend = backend if backend is not None else nimp.utils.p4_backend.CommandLineBackend(port, user, password, client)
+        self._use_manifest = use_manifest
+        self._manifest = None
+        # Results of metadata queries, see _get_metadata
+        self._metadata = {}
+        self._changelist_metadata = {}
+
+    @property
+    def hide_output(self):
+        ''' If set, output of p4 commands isn't logged, e.g. to keep it from
+            mixing with results written to stdout '''
+        return self._backend.hide_output
+
+    @hide_output.setter
+    def hide_output(self, value):
+        self._backend.hide_output = value
 
     def add(self, cl_number, path):
         ''' Adds a file to source control '''
-        assert isinstance(cl_number, str)
         assert isinstance(path, str)
+        return not self.add_files(cl_number, [ path ])
+
+    def add_files(self, cl_number, files):
+        ''' Adds files to source control in given changelist, by batches run
+            concurrently. Returns error messages of all batches. '''
+        assert isinstance(cl_number, str)
         # Use -f to allow filenames with # * @ % characters
-        output = self._run('add', '-f', '-c', cl_number, self._escape_filename(path))
-        return output is not None
+        return self._run_file_batches([ 'add', '-f', '-c', cl_number ], files)
 
     def clean_workspace(self):
         ''' Revert and deletes all pending changelists in current workspace '''
@@ -118,9 +224,13 @@ class P4:
 
     def delete(self, cl_number, path):
         ''' Deletes given file in given changelist '''
+        return not self.delete_files(cl_number, [ path ])
+
+    def delete_files(self, cl_number, files):
+        ''' Deletes files in given changelist, by batches run concurrently.
+            Returns error messages of all batches. '''
         assert isinstance(cl_number, str)
-        output = self._run("delete", "-c", cl_number, path)
-        return output is not None
+        return self._run_file_batches([ 'delete', '-c', cl_number ], files, escape = False)
 
     def delete_changelist(self, cl_number):
         ''' Deletes a changelist from client '''
@@ -135,87 +245,61 @@ class P4:
             if os.path.isdir(filename):
                 files[i] = filename + '/...'
 
-        command = self._get_p4_command('-x', '-', 'fstat')
-        _, output, error = nimp.sys.process.call(command, stdin='\n'.join(files), capture_output=True)
-        files_infos = (output .strip()+ '\n\n' + error.strip()).strip().replace('\r', '').split('\n\n')
-
-        for file_info in files_infos:
-            file_info = file_info.strip()
-
-            if file_info == '':
-                continue
-
-            if "no such file(s)" in file_info or "file(s) not in client" in file_info:
-                continue
-
-            if 'is not under client\'s root' in file_info:
-                continue
-
-            file_name_match   = re.search(r"\.\.\.\s*clientFile\s*(.*)", file_info)
-            head_action_match = re.search(r"\.\.\.\s*headAction\s*(\w*)", file_info)
-            action_match      = re.search(r"\.\.\.\s*action\s*(\w*)", file_info)
-
-            assert file_name_match is not None
-
-            file_name = file_name_match.group(1)
-
-            if action_match is not None:
-                action = action_match.group(1)
-            else:
-                action = None
-
-            if head_action_match is not None:
-                head_action = head_action_match.group(1)
-            else:
-                head_action = None
-
-            yield (file_name, head_action, action)
+        for record in self._run_records('-x', '-', 'fstat', stdin='\n'.join(files),
+                                        fields=['clientFile', 'headAction', 'action']):
+            # Errors such as "no such file(s)" or "file(s) not in client"
+            # don't describe any file and are skipped by _run_records
+            assert 'clientFile' in record
+            yield (record['clientFile'], record.get('headAction'), record.get('action'))
 
     def edit(self, cl_number, *files):
         ''' Open given file for input in given changelist '''
+        return not self.edit_files(cl_number, files)
+
+    def edit_files(self, cl_number, files):
+        ''' Opens files for edit in given changelist, by batches run
+            concurrently. Deleted files are ignored. Returns error messages
+            of all batches. '''
         files_to_edit = []
         for file_name, head_action, _ in self.get_files_status(*files):
             if head_action == "delete":
                 logging.debug("Ignoring deleted file %s", file_name)
                 continue
-            logging.debug("Adding file %s to checkout", file_name)
-            files_to_edit.append(self._escape_filename(file_name))
+            files_to_edit.append(file_name)
 
-        edit_input = '\n'.join(files_to_edit)
-        output = self._run('-x', '-', "edit", "-c",
-                           cl_number, stdin=edit_input)
-        return output is not None
+        return self._run_file_batches([ 'edit', '-c', cl_number ], files_to_edit)
 
     def reconcile(self, cl_number, *files):
-        ''' Reconciles given files in given cl '''
+        ''' Reconciles given files in given cl. If the have-manifest is
+            enabled, only files modified since they were synced or submitted
+            are reconciled, except for a periodic full reconcile. '''
+
+        manifest = self._get_manifest()
+        full_reconcile = manifest is None or manifest.needs_full_reconcile()
+        if not full_reconcile:
+            files = list(manifest.get_modified_files(files))
+            logging.info('Reconciling %d files modified since last sync', len(files))
 
         files = [self._escape_filename(x) for x in files]
+        for i, filename in enumerate(files):
+            if os.path.isdir(filename):
+                files[i] = filename + '/...'
         ret = True
 
-        # List all currently edited depot files in our changelist
-        edited_files = []
-        for depot_file, action in self._parse_command_output(['describe', cl_number],
-                                                             r'^\.\.\. depotFile\d* (.*)$',
-                                                             r'^\.\.\. action\d* (.*)$'):
-            if action == 'edit':
-                edited_files.append(depot_file)
-
         # Find edited files that no longer exist on the filesystem
         files_to_delete = []
-        for depot_file, path in self._parse_command_output(['-x', '-', 'where'],
-                                                           r'^\.\.\. depotFile\d* (.*)$',
-                                                           r'^\.\.\. path\d* (.*)$',
-                                                           stdin='\n'.join(edited_files)):
+        for path in self._get_changelist_paths(cl_number, ['edit']):
             if not os.path.exists(path):
                 logging.debug('Manually reverting and deleting checked out and missing file %s', path)
                 files_to_delete.append(path)
 
         # Revert files that no longer belong here and mark them for delete
-        delete_input = '\n'.join(files_to_delete)
-        if self._run('-x', '-', 'revert', stdin=delete_input) is None:
-            ret = False
-        if self._run('-x', '-', 'delete', '-c', cl_number, stdin=delete_input) is None:
-            ret = False
+        if files_to_delete:
+            delete_input = '\n'.join(files_to_delete)
+            if self._run('-x', '-', 'revert', stdin=delete_input) is None:
+                ret = False
+            if self._run('-x', '-', 'delete', '-c', cl_number, stdin=delete_input) is None:
+                ret = False
 
         # Revert unchanged files
         if self._run('revert', '-a', '-c', cl_number) is None:
@@ -223,78 +307,131 @@ class P4:
 
         # Reconcile files with -a: add missing files to checkout if necessary
         #                  and -f: allow usage of # @ % * characters
-        if self._run('-x', '-', 'reconcile', '-f', '-a', '-c', cl_number, stdin='\n'.join(files)) is None:
+        if files and self._run('-x', '-', 'reconcile', '-f', '-a', '-c', cl_number, stdin='\n'.join(files)) is None:
             ret = False
 
+        if ret and full_reconcile and manifest is not None:
+            # Files that aren't opened match their have revision after a full
+            # reconcile, which seeds the manifest of workspaces synced without it
+            if files:
+                manifest.add_missing(self._get_unopened_files(files))
+            manifest.mark_full_reconcile()
+            manifest.save()
+
         return ret
 
+    def _get_unopened_files(self, file_specs):
+        # Yields local paths of synced files that aren't opened in any changelist
+        for record in self._run_records('-x', '-', 'fstat', stdin='\n'.join(file_specs),
+                                        fields=['clientFile', 'haveRev', 'action']):
+            if 'haveRev' in record and 'action' not in record:
+                yield record['clientFile']
+
+    def _get_changelist_paths(self, cl_number, actions=None):
+        # Returns local paths of files in given changelist, only for given
+        # actions if set
+        depot_files = []
+        for record in self._run_tagged('describe', cl_number, fields=['depotFile', 'action']):
+            for depot_file, action in nimp.utils.p4_backend.get_indexed_values(record, 'depotFile', 'action'):
+                if actions is None or action in actions:
+                    depot_files.append(depot_file)
+        if not depot_files:
+            return []
+        return [ record['path'] for record in self._run_tagged('-x', '-', 'where', stdin='\n'.join(depot_files),
+                                                               fields=['path'])
+                 if 'path' in record ]
+
     def get_changelist_description(self, cl_number):
         ''' Returns description of given changelist '''
-        desc, = next(self._parse_command_output(["describe", cl_number], r"\.\.\. desc (.*)"))
-        return desc
+        def _load():
+            for record in self._run_tagged('describe', cl_number, fields=['desc']):
+                return record.get('desc', '').strip()
+            return None
+        return self._get_metadata(('description', cl_number), _load, self._changelist_metadata)
 
     def get_current_changelist(self, path):
         ''' Returns the current changelist for the workspace '''
         perforce_path = (nimp.system.sanitize_path(path) + '/...') if path else '...'
-        cl_number, = next(self._parse_command_output(['changes', '--max', '1', perforce_path + '#have'], r'\.\.\. change (\d+)'))
-        return cl_number
+        record = next(self._run_tagged('changes', '--max', '1', perforce_path + '#have', fields=['change']), {})
+        return record.get('change')
 
     def get_last_synced_changelist(self):
         ''' Returns the last synced changelist '''
-        cl_number, = next(self._parse_command_output(['changes', '-s', 'submitted', '-m 1'], r'\.\.\. change (\d+)'))
-
-        if cl_number is None:
-            return None
-
-        return cl_number
+        record = next(self._run_tagged('changes', '-s', 'submitted', '-m 1', fields=['change']), {})
+        return record.get('change')
 
     def get_or_create_changelist(self, description):
         ''' Creates or returns changelist number if it's not already created '''
-        pending_changelists = self.get_pending_changelists()
-
-        for cl_number in pending_changelists:
-            pending_cl_desc = self.get_changelist_description(cl_number)
-
-            assert pending_cl_desc is not None
-
-            if description.lower() == pending_cl_desc.lower():
-                return cl_number
+        cl_number = self._get_pending_changelists()['index'].get(description.strip().lower())
+        if cl_number is not None:
+            return cl_number
 
         user = self.get_user()
         change_list_form = _CREATE_CHANGELIST_FORM_TEMPLATE.format(user        = user,
                                                                    workspace   = self.get_workspace(),
                                                                    description = description)
 
-        for changelist, in self._parse_command_output(["change", "-i"], r"Change (\d+) created\.", stdin = change_list_form):
-            return changelist
+        output = self._run('change', '-i', stdin = change_list_form)
+        match = re.search(r'Change (\d+) created\.', output or '')
+        return match.group(1) if match is not None else None
 
     def get_pending_changelists(self):
         ''' Returns pending changelists '''
-        workspace = self.get_workspace()
-        assert isinstance(workspace, str)
-        for changelist, in self._parse_command_output(["changes", "-c", workspace, "-s", "pending"], r"\.\.\. change (\d+)"):
-            if changelist is not None:
-                yield changelist
+        yield from self._get_pending_changelists()['descriptions']
+
+    def _get_pending_changelists(self):
+        # Returns pending changelists with their descriptions, and an index
+        # of changelists by lowercase description, all read with a single
+        # command. The most recent changelist wins for a given description.
+        def _load():
+            workspace = self.get_workspace()
+            assert isinstance(workspace, str)
+            descriptions = {}
+            index = {}
+            for record in self._run_records('changes', '-l', '-c', workspace, '-s', 'pending',
+                                            fields=['change', 'desc']):
+                cl_number = record['change']
+                descriptions[cl_number] = record.get('desc', '').strip()
+                index.setdefault(descriptions[cl_number].lower(), cl_number)
+                self._changelist_metadata[('description', cl_number)] = descriptions[cl_number]
+            return { 'descriptions': descriptions, 'index': index }
+        return self._get_metadata('pending_changelists', _load, self._changelist_metadata)
 
     def get_user(self):
         ''' Returns current perforce user '''
-        return next(self._parse_command_output(["user", "-o"], r"^\.\.\. User (.*)$"))[0]
+        def _load():
+            record = next(self._run_tagged('user', '-o', fields=['User'], cache_ttl=_INFO_CACHE_TTL), {})
+            return record.get('User')
+        return self._get_metadata('user', _load)
+
+    def get_server_address(self):
+        ''' Returns the address of the perforce server, or None if it can't
+            be reached. Unlike workspace and user names, it isn't cached
+            across nimp invocations, so that it tells whether the server is
+            currently up. '''
+        def _load():
+            record = next(self._run_tagged('info', fields=['serverAddress']), {})
+            return record.get('serverAddress')
+        return self._get_metadata('server_address', _load)
 
     def get_workspace(self):
         ''' Returns current workspace '''
-        workspace =  next(self._parse_command_output(["info"], r"^\.\.\. clientName (.*)$"))[0]
+        def _load():
+            record = next(self._run_tagged('info', fields=['clientName'], cache_ttl=_INFO_CACHE_TTL), {})
+            return record.get('clientName')
+        workspace = self._get_metadata('workspace', _load)
         if workspace == '*unknown*':
             return None
         return workspace
 
     def is_file_versioned(self, file_path):
         ''' Checks if a file is known by the source control '''
-        command = self._get_p4_command("fstat", file_path)
-        _, output, error = nimp.sys.process.call(command, capture_output=True)
-        # Checks if the file was not added then deleted
-        if re.search(r"\.\.\.\s*headAction\s*delete", output) is not None:
-            return False
-        return "no such file(s)" not in error and "file(s) not in client" not in error
+        # Unknown files only yield "no such file(s)" or "file(s) not in
+        # client" errors, and files that were added then deleted are ignored
+        for record in self._run_records('fstat', file_path, fields=['headAction']):
+            if record.get('headAction') != 'delete':
+                return True
+        return False
 
     def revert(self, *files):
         ''' Reverts given files (regardless of the changelist they're edited in) '''
@@ -303,12 +440,9 @@ class P4:
             if action != "edit":
                 logging.debug("Ignoring not checked out file %s", file_name)
                 continue
-            logging.debug("Adding file %s to revert", file_name)
-            files_to_revert.append(self._escape_filename(file_name))
+            files_to_revert.append(file_name)
 
-        revert_input = '\n'.join(files_to_revert)
-        output = self._run('-x', '-', "revert", stdin=revert_input) is None
-        return output is not None
+        return not self._run_file_batches([ 'revert' ], files_to_revert)
 
     def revert_changelist(self, cl_number):
         ''' Reverts given changelist '''
@@ -323,8 +457,12 @@ class P4:
     def submit(self, cl_number):
         ''' Submits given changelist '''
         logging.info("Submiting changelist %s...", cl_number)
-        command = self._get_p4_command('submit', '-f', 'revertunchanged', '-c', cl_number)
-        _, _, error = nimp.sys.process.call(command, capture_output=True)
+        manifest = self._get_manifest()
+        submitted_paths = self._get_changelist_paths(cl_number) if manifest is not None else []
+
+        args = [ 'submit', '-f', 'revertunchanged', '-c', cl_number ]
+        self._before_command(args)
+        _, _, error = self._backend.run(args)
 
         if error is not None and error != "":
             if "No files to submit." in error:
@@ -333,33 +471,213 @@ class P4:
             logging.error("%s", error)
             return False
 
+        if manifest is not None:
+            manifest.update(submitted_paths)
+            manifest.save()
         return True
 
-    def sync(self, *files, cl_number = None):
+    def sync(self, *files, cl_number = None, parallel = None):
         ''' Udpate given file '''
-        command = ["sync"]
-
-        file_list = [self._escape_filename(x) for x in files]
-        if cl_number is not None:
-            file_list = list(map(file_list, lambda x: '%s@%s' % (x, cl_number)))
-
-        command.extend(file_list)
-
-        command = self._get_p4_command(*command)
-        result, _, error = nimp.sys.process.call(command, capture_output=True, encoding='cp437')
-        if (result != 0 or error != '') and 'file(s) up-to-date' not in error:
-            return False
+        result = True
+        for _, _, error in self.sync_files(files, cl_number = cl_number, parallel = parallel):
+            if error is not None:
+                result = False
+        return result
 
-        return True
+    def sync_files(self, files, cl_number = None, parallel = None, batch_size = SYNC_BATCH_SIZE):
+        ''' Syncs given files, or the whole workspace if there are none, to
+            given changelist or to head revision. File lists are fed to p4 by
+            batches, each of them being synced with given --parallel settings
+            (e.g. "threads=4,batch=8") if any. Yields (file, action, error)
+            tuples as p4 reports them: action is added, updated, deleted...
+            for synced files, and error is set when something failed. '''
+        revision = '@%s' % cl_number if cl_number is not None else ''
+        options = [ '--parallel=%s' % parallel ] if parallel else []
+
+        file_list = [ self._escape_filename(x) + revision for x in files ]
+        if not file_list:
+            batches = [ (['sync'] + options + ([ revision ] if revision else []), None) ]
+        else:
+            batches = [ (['-x', '-', 'sync'] + options, file_list[start:start + batch_size])
+                        for start in range(0, len(file_list), batch_size) ]
+
+        manifest = self._get_manifest()
+        synced_count = 0
+        for args, batch in batches:
+            synced_paths = []
+            stdin = '\n'.join(batch) if batch is not None else None
+            for result in self._sync_batch(args, stdin = stdin):
+                if result[0] is not None:
+                    synced_paths.append(result[0])
+                yield result
+            if manifest is not None:
+                manifest.update(synced_paths)
+            if len(batches) > 1:
+                synced_count += len(batch)
+                logging.info('Synced %d/%d files', synced_count, len(file_list))
+
+        if manifest is not None:
+            manifest.save()
+
+    def _sync_batch(self, args, stdin = None):
+        fields = [ 'clientFile', 'action', 'rev' ]
+        for record in self._run_records(*args, stdin = stdin, fields = fields, include_errors = True):
+            if record.get('code') != 'error':
+                logging.debug('%s#%s - %s', record.get('clientFile'), record.get('rev'), record.get('action'))
+                yield record.get('clientFile'), record.get('action'), None
+                continue
+            message = record.get('data', '').strip()
+            if 'file(s) up-to-date' in message:
+                continue
+            logging.error('%s', message)
+            yield None, None, message
 
     def get_modified_files(self, *cl_numbers, root = '//...'):
-        ''' Returns files modified by given changelists '''
-        for cl_number in cl_numbers:
-            for filename, action in self._parse_command_output(["fstat", "-e", cl_number , root],
-                                                               r"^\.\.\. depotFile(.*)$",
-                                                               r"^\.\.\. headAction(.*)"):
-                filename = os.path.normpath(filename) if filename is not None else ''
-                yield filename, action
+        ''' Returns files modified by given changelists, along with their head
+            action. Each file is returned once. Changelists are described by
+            batches, and head actions of their files read with one fstat per
+            batch, instead of scanning root once per changelist. '''
+        root_regex = _get_depot_path_regex(root)
+        found_files = set()
+        for start in range(0, len(cl_numbers), DESCRIBE_BATCH_SIZE):
+            batch = cl_numbers[start:start + DESCRIBE_BATCH_SIZE]
+            batch_files = []
+            for record in self._run_records('describe', '-s', *batch):
+                for depot_file, in nimp.utils.p4_backend.get_indexed_values(record, 'depotFile'):
+                    if depot_file not in found_files and root_regex.match(depot_file):
+                        found_files.add(depot_file)
+                        batch_files.append(depot_file)
+
+            if not batch_files:
+                continue
+            for record in self._run_records('-x', '-', 'fstat', '-T', 'depotFile,headAction',
+                                            stdin = '\n'.join(batch_files),
+                                            fields = ['depotFile', 'headAction']):
+                yield os.path.normpath(record['depotFile']), record.get('headAction')
+
+    def fetch_files(self, file_spec, destination):
+        ''' Writes files matching a depot file spec, such as
+            //depot/Tools/...@1234, under destination without needing a
+            workspace. Paths are relative to the directory of the spec. Files
+            already there with the same digest are left as is, others are
+            printed by batches run concurrently. Returns error messages. '''
+        path_spec = re.split('[@#]', file_spec)[0]
+        wildcard = min((index for index in (path_spec.find('...'), path_spec.find('*')) if index >= 0),
+                       default = len(path_spec))
+        prefix = path_spec[:path_spec.rfind('/', 0, wildcard) + 1]
+
+        # Local path -> (depot revision, size, digest)
+        files = {}
+        for record in self._run_records('fstat', '-Ol', '-T', 'depotFile,headAction,headRev,digest,fileSize',
+                                        file_spec, fields = [ 'depotFile', 'headAction', 'headRev',
+                                                              'digest', 'fileSize' ]):
+            if 'depotFile' not in record or record.get('headAction') in _DELETE_ACTIONS:
+                continue
+            relative_path = _unescape_filename(record['depotFile'][len(prefix):])
+            local_path = os.path.join(destination, *relative_path.split('/'))
+            files[local_path] = ('%s#%s' % (record['depotFile'], record['headRev']),
+                                 record.get('fileSize'), record.get('digest'))
+
+        paths = list(files)
+        with concurrent.futures.ThreadPoolExecutor(max_workers = nimp.utils.p4_manifest.HASH_JOBS) as executor:
+            up_to_date = executor.map(lambda path: nimp.utils.p4_manifest.has_digest(path, *files[path][1:]), paths)
+            paths = [ path for path, is_up_to_date in zip(paths, list(up_to_date)) if not is_up_to_date ]
+        logging.info('Fetching %d files, %d are up to date', len(paths), len(files) - len(paths))
+        if not paths:
+            return []
+
+        # Batches are split so that all jobs get some
+        local_paths = { files[path][0]: path for path in paths }
+        revisions = list(local_paths)
+        batch_size = min(FILE_BATCH_SIZE, -(-len(revisions) // FILE_BATCH_JOBS))
+        batches = [ revisions[start:start + batch_size] for start in range(0, len(revisions), batch_size) ]
+        with concurrent.futures.ThreadPoolExecutor(max_workers = FILE_BATCH_JOBS) as executor:
+            errors = list(itertools.chain.from_iterable(
+                executor.map(lambda batch: self._print_batch(batch, local_paths), batches)))
+
+        for message in errors:
+            logging.error('%s', message)
+        return errors
+
+    def _print_batch(self, revisions, local_paths):
+        # Writes given depot revisions to their local path. p4 -G print
+        # outputs a stat record per file, followed by records of its content.
+        errors = []
+        output = None
+        path = None
+        try:
+            for record in self._run_records('-x', '-', 'print', stdin = '\n'.join(revisions), include_errors = True):
+                code = record.get('code')
+                if code == 'error':
+                    message = record.get('data', '').strip()
+                    if int(record.get('severity', 3)) >= 3 or 'no such file' in message:
+                        errors.append(message)
+                    continue
+                if code == 'stat':
+                    if output is not None:
+                        output.close()
+                        os.replace(path + '.tmp', path)
+                        output = None
+                    path = local_paths.get('%s#%s' % (record.get('depotFile'), record.get('rev')))
+                    if path is not None:
+                        nimp.system.safe_makedirs(os.path.dirname(path))
+                        output = open(path + '.tmp', 'wb') # pylint: disable = consider-using-with
+                    continue
+                if output is not None and 'data' in record:
+                    output.write(record['data'].encode('utf-8', errors = 'surrogateescape'))
+            if output is not None:
+                output.close()
+                os.replace(path + '.tmp', path)
+                output = None
+        finally:
+            if output is not None:
+                output.close()
+                os.remove(path + '.tmp')
+        return errors
+
+    def get_changed_files(self, since_cl, until_cl = None, root = '//...'):
+        ''' Returns local paths of files under root changed by changelists
+            submitted after since_cl, up to until_cl or the last submitted
+            changelist, along with the action of their last revision in that
+            range. Files outside of the workspace view are left out. As both
+            ends of the range are submitted changelists, results are cached. '''
+        if until_cl is None:
+            record = next(self._run_tagged('changes', '-s', 'submitted', '-m', '1', root, fields=['change']), {})
+            until_cl = record.get('change')
+        if until_cl is None or int(until_cl) <= int(since_cl):
+            return []
+
+        # Results depend on the workspace view, which may change
+        cache_command = [ 'p4', 'changed-files', root, str(since_cl), str(until_cl) ]
+        cache_key = [ self._port, self.get_workspace(), self._get_workspace_spec() ]
+        use_cache = nimp.sys.cache.is_enabled()
+        if use_cache:
+            cached = nimp.sys.cache.load(cache_command, '.', nimp.utils.p4_backend.P4_ENVIRONMENT, extra_key = cache_key)
+            if cached is not None:
+                return [ tuple(it) for it in cached[1] ]
+
+        # Files are listed once, with the action of their last revision in
+        # the range, whatever the number of changelists in it
+        actions = {}
+        file_range = '%s@%d,@%s' % (root, int(since_cl) + 1, until_cl)
+        for record in self._run_records('files', file_range, fields = [ 'depotFile', 'action' ]):
+            if 'depotFile' in record:
+                actions[record['depotFile']] = record.get('action')
+
+        changed_files = []
+        depot_files = list(actions)
+        for start in range(0, len(depot_files), FILE_BATCH_SIZE):
+            batch = depot_files[start:start + FILE_BATCH_SIZE]
+            for record in self._run_records('-x', '-', 'where', stdin = '\n'.join(batch),
+                                            fields = [ 'depotFile', 'path', 'unmap' ]):
+                if 'path' in record and 'unmap' not in record:
+                    changed_files.append((record['path'], actions.get(record['depotFile'])))
+        changed_files.sort()
+
+        if use_cache:
+            nimp.sys.cache.store(cache_command, '.', CHANGED_FILES_CACHE_TTL, (0, changed_files, ''),
+                                 nimp.utils.p4_backend.P4_ENVIRONMENT, extra_key = cache_key)
+        return changed_files
 
     @staticmethod
     def _escape_filename(name):
@@ -369,27 +687,94 @@ class P4:
                    .replace('#', '%23') \
                    .replace('*', '%2A')
 
-    def _get_p4_command(self, *args):
-        command = ['p4', '-z', 'tag']
-        if self._port is not None:
-            command += ['-p', self._port]
-        if self._user is not None:
-            command += ['-u', self._user]
-        if self._password is not None:
-            command += ['-P', self._password]
-        if self._client is not None:
-            command += ['-c', self._client]
-
-        command += list(args)
-        return command
-
-    def _run(self, *args, stdin=None):
-        command = self._get_p4_command(*args)
-
+    def _get_manifest(self):
+        # Returns the have-manifest of the workspace, if enabled
+        if not self._use_manifest:
+            return None
+        if self._manifest is None:
+            key_data = [ self._port or os.environ.get('P4PORT'), self.get_workspace() ]
+            key = hashlib.sha256(json.dumps(key_data).encode('utf-8')).hexdigest()
+            self._manifest = nimp.utils.p4_manifest.HaveManifest(os.path.join(nimp.sys.cache.get_directory(), 'p4', 'manifest-%s.json' % key))
+        return self._manifest
+
+    def _get_workspace_spec(self):
+        # Returns the root and view mappings of the current workspace
+        def _load():
+            record = next(self._run_records('client', '-o', fields=['Root', 'AltRoots', 'View']), None)
+            if record is None:
+                return None
+            return { 'Root': record.get('Root'),
+                     'AltRoots': [ it for it, in nimp.utils.p4_backend.get_indexed_values(record, 'AltRoots') ],
+                     'View': [ it for it, in nimp.utils.p4_backend.get_indexed_values(record, 'View') ] }
+        return self._get_metadata('workspace_spec', _load)
+
+    def _get_metadata(self, key, load, metadata=None):
+        # Metadata is queried once per P4 object. Info, user and workspace
+        # can't change during a session, and are also persisted for a short
+        # while by nimp.sys.process.call. Changelist metadata is cleared
+        # whenever a command that may modify changelists is run.
+        metadata = self._metadata if metadata is None else metadata
+        if key not in metadata:
+            value = load()
+            if value is None:
+                return None
+            metadata[key] = value
+        return metadata[key]
+
+    def _run_file_batches(self, args, files, escape = True):
+        # Runs a "-x -" command on files by batches, several of them at once,
+        # and returns error messages of all failed batches. Batches are
+        # checked like other commands, see _run_command. The command is still
+        # run without files, to report errors about the changelist.
+        files = [ self._escape_filename(it) if escape else it for it in files ]
+        batches = [ files[start:start + FILE_BATCH_SIZE] for start in range(0, len(files), FILE_BATCH_SIZE) ]
+        batches = batches or [ [] ]
+        logging.debug('Running p4 %s on %d files in %d batches', args[0], len(files), len(batches))
+
+        def _run_batch(batch):
+            output, error = self._run_command('-x', '-', *args, stdin = '\n'.join(batch))
+            messages = [ line.strip() for line in error.splitlines() if line.strip() ]
+            if output is not None:
+                # Warnings such as "file(s) not opened on this client"
+                for message in messages:
+                    logging.debug('p4: %s', message)
+                return []
+            return messages or [ 'p4 %s failed' % args[0] ]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = FILE_BATCH_JOBS) as executor:
+            errors = list(itertools.chain.from_iterable(executor.map(_run_batch, batches)))
+
+        for message in errors:
+            logging.error('%s', message)
+        if errors:
+            logging.error('p4 %s failed with %d errors on %d files', args[0], len(errors), len(files))
+        return errors
+
+    def _before_command(self, args):
+        if nimp.utils.p4_backend.get_command_name(args) not in _READ_ONLY_COMMANDS:
+            self._changelist_metadata.clear()
+
+    def _run(self, *args, stdin=None, cache_ttl=None, stream_output=False):
+        # Returns the output of a p4 command, or None if it failed. If
+        # stream_output is set, output is returned as an OutputBuffer the
+        # caller should close.
+        output, _ = self._run_command(*args, stdin=stdin, cache_ttl=cache_ttl, stream_output=stream_output)
+        return output
+
+    def _run_command(self, *args, stdin=None, cache_ttl=None, stream_output=False):
+        # Returns the output of a p4 command, or None if it failed, and its
+        # error messages. Commands are retried when the server times out,
+        # and fail on errors about files that couldn't be written.
+        self._before_command(args)
+
+        error = ''
         for _ in range(5):
-            result, output, error = nimp.sys.process.call(command, stdin=stdin, encoding='cp437', capture_output=True)
+            result, output, error = self._backend.run(args, stdin=stdin, cache_ttl=cache_ttl,
+                                                      stream_output=stream_output)
 
             if 'Operation took too long ' in error:
+                if stream_output:
+                    output.close()
                 continue
 
             has_fatal_errors = False
@@ -400,24 +785,42 @@ class P4:
 
             if result != 0 or has_fatal_errors:
                 logging.info('p4 command failed: %s', error)
-                return None
-
-            return output
-
-    def _parse_command_output(self, command, *patterns, stdin = None):
-        output = self._run(*command, stdin = stdin)
-
-        if output is not None:
-            match_list = []
-
-            for pattern in patterns:
-                matches = list(re.finditer(pattern, output, re.MULTILINE))
-                result = []
-                for match in matches:
-                    match_string = match.group(1)
-                    match_string = match_string.strip()
-                    result.append(match_string)
-                match_list.append(result)
-
-            for elem in zip(*match_list):
-                yield elem
+                if stream_output:
+                    output.close()
+                return None, error
+
+            return output, error
+        return None, error
+
+    def _run_tagged(self, *args, stdin=None, fields=None, cache_ttl=None):
+        ''' Runs a "p4 -z tag" command and yields its output records, parsed
+            line by line as they are read from the captured output. Yields
+            nothing if the command fails. See
+            nimp.utils.p4_backend.read_tagged_records. '''
+        output = self._run(*args, stdin=stdin, cache_ttl=cache_ttl, stream_output=True)
+        if output is None:
+            return
+        with output:
+            yield from nimp.utils.p4_backend.read_tagged_records(output, fields)
+
+    def _run_records(self, *args, stdin=None, fields=None, include_errors=False):
+        ''' Runs a "p4 -G" command and yields its output records, streaming
+            them from the captured output. Error records are logged in debug
+            and skipped, unless include_errors is set. If fields is set,
+            records only contain these, plus code and data for errors. '''
+        status_fields = None
+        if include_errors:
+            fields = None if fields is None else list(fields) + [ 'code', 'data' ]
+        elif fields is not None:
+            status_fields = [ field for field in ('code', 'data') if field not in fields ]
+            fields = list(fields) + status_fields
+
+        self._before_command(args)
+        for record in self._backend.run_records(args, stdin=stdin, fields=fields):
+            # Info records are messages such as "Change 401 created."
+            if record.get('code') == 'info' or (record.get('code') == 'error' and not include_errors):
+                logging.debug('p4: %s', record.get('data', '').strip())
+                continue
+            for field in status_fields or ():
+                record.pop(field, None)
+            yield record
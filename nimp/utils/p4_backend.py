@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Runs perforce commands and parses their output '''
+
+import abc
+import itertools
+import logging
+import marshal
+import threading
+
+import nimp.sys.process
+import nimp.system
+
+# Environment variables the results of p4 commands depend on, when they
+# are cached
+P4_ENVIRONMENT = [ 'P4PORT', 'P4USER', 'P4CLIENT', 'P4CONFIG' ] # pylint: disable = invalid-name
+
+# Size of the blocks "p4 -G" output is decoded from
+_MARSHAL_BLOCK_SIZE = 1024 * 1024 # pylint: disable = invalid-name
+
+
+def read_marshal_records(stream, fields=None):
+    ''' Yields the records written by a "p4 -G" command to a binary stream as
+        dictionaries, decoding keys and string values to str. If fields is
+        set, other fields are left out, which saves decoding them. '''
+    if fields is None:
+        for record in _read_marshal_dicts(stream):
+            yield { _decode_marshal_value(key): _decode_marshal_value(value)
+                    for key, value in record.items() }
+        return
+
+    fields = [ (field, field.encode('utf-8')) for field in fields ]
+    for record in _read_marshal_dicts(stream):
+        result = {}
+        for field, key in fields:
+            value = record.get(key)
+            if value is not None:
+                result[field] = _decode_marshal_value(value)
+        yield result
+
+def _read_marshal_dicts(stream):
+    # marshal.load() reads files a few bytes at a time, which is slow on
+    # large outputs, so records are loaded from blocks with marshal.loads().
+    # It doesn't tell how many bytes it read, but p4 only writes version 0
+    # dictionaries of strings and 32 bit integers: a record takes 2 bytes,
+    # plus 5 bytes per key and value, plus the length of strings.
+    data = b''
+    position = 0
+    while True:
+        block = stream.read(_MARSHAL_BLOCK_SIZE)
+        data = data[position:] + block
+        position = 0
+        with memoryview(data) as view:
+            while position < len(data):
+                try:
+                    record = marshal.loads(view[position:])
+                except EOFError:
+                    break
+                if record.__class__ is not dict:
+                    raise ValueError('Unexpected p4 -G output: %r' % (record, ))
+                values = record.values()
+                try:
+                    values_size = sum(map(len, values))
+                except TypeError:
+                    values_size = sum(len(value) for value in values if value.__class__ is bytes)
+                position += 2 + 10 * len(record) + sum(map(len, record)) + values_size
+                if data[position - 1] != ord('0'):
+                    raise ValueError('Unsupported p4 -G output types: %r' % (record, ))
+                yield record
+        if not block:
+            if position < len(data):
+                raise EOFError('Truncated p4 -G output')
+            return
+
+def read_tagged_records(lines, fields=None):
+    ''' Yields the records of "p4 -z tag" output lines as dictionaries,
+        parsing them one line at a time. Values spanning several lines, such
+        as changelist descriptions, are joined. A record ends when a field it
+        already has appears again. If fields is set, other fields are left
+        out; indexed fields such as depotFile0, depotFile1... are kept along
+        depotFile, see get_indexed_values. '''
+    record = {}
+    keys = set()
+    key = None
+    blank_lines = 0
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.startswith('... '):
+            name, _, value = line[4:].partition(' ')
+            if name in keys:
+                yield record
+                record = {}
+                keys = set()
+            keys.add(name)
+            key = name if fields is None or name.rstrip('0123456789') in fields else None
+            if key is not None:
+                record[key] = value
+            blank_lines = 0
+        elif line == '':
+            blank_lines += 1
+        elif key is not None:
+            record[key] += '\n' * (blank_lines + 1) + line
+            blank_lines = 0
+    if keys:
+        yield record
+
+def get_indexed_values(record, *fields):
+    ''' Yields tuples of the values of indexed fields of a record, e.g. the
+        depotFile0 and action0 values, then depotFile1 and action1 values... '''
+    for index in itertools.count():
+        values = tuple(record.get('%s%d' % (field, index)) for field in fields)
+        if all(value is None for value in values):
+            return
+        yield values
+
+def _decode_marshal_value(value):
+    if value.__class__ is bytes:
+        return value.decode('utf-8', errors='surrogateescape')
+    return value
+
+def get_command_name(args):
+    ''' Returns the name of the p4 command run with given arguments '''
+    args = list(args)
+    while args and args[0].startswith('-'):
+        # -x is the only global option taking a value used here
+        del args[:2 if args[0] == '-x' else 1]
+    return args[0] if args else None
+
+
+class Backend(metaclass=abc.ABCMeta):
+    ''' Runs p4 commands for P4 objects. Commands are given the arguments of
+        the p4 command line client, and "-x -" reads file names from stdin.
+        If hide_output is set, output of commands isn't logged. '''
+
+    hide_output = False
+
+    @abc.abstractmethod
+    def run(self, args, stdin=None, cache_ttl=None, stream_output=False):
+        ''' Runs a command and returns its exit code, its output in "p4 -z
+            tag" format and its error messages. If stream_output is set, the
+            output is returned as an OutputBuffer the caller should close.
+            Results may be reused for cache_ttl seconds if it is set. '''
+
+    @abc.abstractmethod
+    def run_records(self, args, stdin=None, fields=None):
+        ''' Runs a command and yields its output records as they are read,
+            as "p4 -G" would output them: errors and messages are records
+            with an error or info code and a data field. If fields is set,
+            records only contain these, or their indexed variants. '''
+
+
+class CommandLineBackend(Backend):
+    ''' Runs commands with the p4 command line client, one process each '''
+
+    def __init__(self, port=None, user=None, password=None, client=None):
+        self._port = port
+        self._user = user
+        self._password = password
+        self._client = client
+
+    def get_command(self, args, marshal_output=False):
+        ''' Returns the p4 command line for given arguments '''
+        command = ['p4', '-G'] if marshal_output else ['p4', '-z', 'tag']
+        if self._port is not None:
+            command += ['-p', self._port]
+        if self._user is not None:
+            command += ['-u', self._user]
+        if self._password is not None:
+            command += ['-P', self._password]
+        if self._client is not None:
+            command += ['-c', self._client]
+
+        command += list(args)
+        return command
+
+    def run(self, args, stdin=None, cache_ttl=None, stream_output=False):
+        result, output, error = nimp.sys.process.call(self.get_command(args), stdin=stdin, encoding='cp437',
+                                                      capture_output=True, hide_output=self.hide_output,
+                                                      stream_capture=stream_output,
+                                                      cache_ttl=cache_ttl, cache_env=P4_ENVIRONMENT)
+        if stream_output:
+            with error:
+                error = error.getvalue()
+        return result, output, error
+
+    def run_records(self, args, stdin=None, fields=None):
+        result, output, error = nimp.sys.process.call(self.get_command(args, marshal_output=True), stdin=stdin,
+                                                      capture_output=True, hide_output=self.hide_output,
+                                                      stream_capture=True, capture_binary=True)
+        error.close()
+        if result != 0:
+            logging.debug('p4 command exited with code %d', result)
+
+        with output:
+            yield from read_marshal_records(output, fields)
+
+
+class P4PythonBackend(Backend):
+    ''' Runs commands in process with P4Python, through a single connection
+        kept open for the whole session. This saves starting a process and
+        connecting for each command. '''
+
+    def __init__(self, port=None, user=None, password=None, client=None):
+        p4python = nimp.system.try_import('P4')
+        if p4python is None:
+            raise ImportError('P4Python is not installed')
+        self._exception_type = p4python.P4Exception
+        self._connection = p4python.P4()
+        # Errors are read from the connection instead of raised
+        self._connection.exception_level = 0
+        if port is not None:
+            self._connection.port = port
+        if user is not None:
+            self._connection.user = user
+        if password is not None:
+            self._connection.password = password
+        if client is not None:
+            self._connection.client = client
+        # Connections can't run several commands at once
+        self._lock = threading.Lock()
+
+    def run(self, args, stdin=None, cache_ttl=None, stream_output=False):
+        result, records, errors, warnings = self._run(args, stdin)
+        lines = []
+        for record in records:
+            if isinstance(record, dict):
+                lines += [ '... %s %s' % item for item in _flatten_record(record).items() ]
+                lines.append('')
+            else:
+                lines.append(str(record))
+        output = ''.join(line + '\n' for line in lines)
+        error = ''.join(message + '\n' for message in errors + warnings)
+        if stream_output:
+            output = nimp.sys.process.OutputBuffer.from_text(output)
+        return result, output, error
+
+    def run_records(self, args, stdin=None, fields=None):
+        _, records, errors, warnings = self._run(args, stdin)
+        # Contents output by p4 print are strings for text files, and bytes
+        # for binary files
+        message_code = 'text' if get_command_name(args) == 'print' else 'info'
+        for record in records:
+            if isinstance(record, bytes):
+                yield { 'code': 'binary', 'data': _decode_marshal_value(record) }
+                continue
+            if not isinstance(record, dict):
+                yield { 'code': message_code, 'data': str(record) }
+                continue
+            record = _flatten_record(record)
+            if fields is not None:
+                record = { key: value for key, value in record.items() if key.rstrip('0123456789') in fields }
+            record.setdefault('code', 'stat')
+            yield record
+        for severity, messages in [ (3, errors), (2, warnings) ]:
+            for message in messages:
+                yield { 'code': 'error', 'data': message, 'severity': severity }
+
+    def _run(self, args, stdin):
+        # Returns the exit code the command line client would return, output
+        # records and messages, error messages and warning messages
+        args = list(args)
+        if args[:2] == [ '-x', '-' ]:
+            args = args[2:] + [ line for line in (stdin or '').split('\n') if line ]
+            stdin = None
+
+        with self._lock:
+            try:
+                if not self._connection.connected():
+                    self._connection.connect()
+                if stdin is not None:
+                    self._connection.input = stdin
+                records = self._connection.run(*args)
+            except self._exception_type as ex:
+                return 1, [], [ str(ex) ], []
+            errors = [ message.strip() for message in self._connection.errors ]
+            warnings = [ message.strip() for message in self._connection.warnings ]
+        return (1 if errors else 0), records, errors, warnings
+
+
+def _flatten_record(record):
+    # P4Python returns indexed fields such as depotFile0, depotFile1... as
+    # lists, the command line client as separate fields
+    result = {}
+    for key, value in record.items():
+        if isinstance(value, list):
+            for index, item in enumerate(value):
+                result['%s%d' % (key, index)] = item
+        else:
+            result[key] = value
+    return result
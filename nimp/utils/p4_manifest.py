@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Perforce have-manifests, telling which workspace files may have been
+    modified without asking the server '''
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import time
+
+# Have-manifests are ignored and a full reconcile is done at least this
+# often, in seconds, see HaveManifest
+MANIFEST_FULL_RECONCILE_INTERVAL = 24 * 3600 # pylint: disable = invalid-name
+
+# Number of files hashed in parallel, when updating have-manifests or
+# checking files to fetch
+HASH_JOBS = 8 # pylint: disable = invalid-name
+
+
+class HaveManifest():
+    ''' Size, modification time and MD5 digest of workspace files as of their
+        last sync or submit. It tells which files may have been modified since
+        without asking the server, so that only these are reconciled. Files
+        it doesn't know about are always considered modified. '''
+
+    def __init__(self, path):
+        self.path = path
+        self.last_full_reconcile = 0
+        self._files = {}
+        try:
+            with open(path, 'r') as manifest_file:
+                data = json.load(manifest_file)
+            self.last_full_reconcile = data['last_full_reconcile']
+            self._files = data['files']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def update(self, paths):
+        ''' Records the current state of given files, forgetting missing ones '''
+        keys = [ _get_manifest_key(path) for path in paths ]
+        with concurrent.futures.ThreadPoolExecutor(max_workers = HASH_JOBS) as executor:
+            for key, state in zip(keys, executor.map(_get_file_state, keys)):
+                if state is None:
+                    self._files.pop(key, None)
+                else:
+                    self._files[key] = state
+
+    def add_missing(self, paths):
+        ''' Records the current state of given files that aren't known yet '''
+        self.update([ path for path in paths if _get_manifest_key(path) not in self._files ])
+
+    def get_modified_files(self, paths):
+        ''' Yields given files, and files in given directories, that were
+            added, modified or deleted since their state was recorded '''
+        candidates = {}
+        for path in paths:
+            if not os.path.isdir(path):
+                candidates[_get_manifest_key(path)] = path
+                continue
+            for root, _, file_names in os.walk(path):
+                for file_name in file_names:
+                    file_path = os.path.join(root, file_name)
+                    candidates[_get_manifest_key(file_path)] = file_path
+            # Recorded files no longer in the directory were deleted
+            prefix = _get_manifest_key(path) + os.sep
+            for key in self._files:
+                if key.startswith(prefix) and key not in candidates:
+                    candidates[key] = key
+
+        for key, path in candidates.items():
+            if self._is_modified(key):
+                yield path
+
+    def needs_full_reconcile(self):
+        ''' Returns True if the manifest wasn't checked by a full reconcile
+            for MANIFEST_FULL_RECONCILE_INTERVAL seconds '''
+        return time.time() - self.last_full_reconcile > MANIFEST_FULL_RECONCILE_INTERVAL
+
+    def mark_full_reconcile(self):
+        ''' Records that a full reconcile was just done '''
+        self.last_full_reconcile = time.time()
+
+    def save(self):
+        ''' Writes the manifest to disk '''
+        data = { 'last_full_reconcile': self.last_full_reconcile, 'files': self._files }
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok = True)
+            temp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(temp_path, 'w') as manifest_file:
+                json.dump(data, manifest_file)
+            os.replace(temp_path, self.path)
+        except OSError as ex:
+            logging.warning('Unable to write p4 manifest %s: %s', self.path, ex)
+
+    def _is_modified(self, key):
+        recorded = self._files.get(key)
+        if recorded is None:
+            return True
+        try:
+            stat = os.stat(key)
+        except OSError:
+            return True
+        if stat.st_size != recorded[0]:
+            return True
+        if stat.st_mtime_ns == recorded[1]:
+            return False
+        # Touched files are only modified if their content changed
+        state = _get_file_state(key)
+        if state is None or state[2] != recorded[2]:
+            return True
+        self._files[key] = state
+        return False
+
+def _get_manifest_key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+def has_digest(path, size, digest):
+    ''' Tells if a file has given size and MD5 digest, as output by p4 fstat
+        -Ol '''
+    try:
+        if size is not None and os.path.getsize(path) != int(size):
+            return False
+    except OSError:
+        return False
+    state = _get_file_state(path)
+    return state is not None and digest is not None and state[2] == digest.lower()
+
+def _get_file_state(path):
+    # Returns the [size, modification time, digest] of a file, or None if it
+    # doesn't exist
+    try:
+        stat = os.stat(path)
+        digest = hashlib.md5()
+        with open(path, 'rb') as file_content:
+            for block in iter(lambda: file_content.read(1024 * 1024), b''):
+                digest.update(block)
+    except OSError:
+        return None
+    return [ stat.st_size, stat.st_mtime_ns, digest.hexdigest() ]